@@ -1,9 +1,12 @@
 from django.contrib import admin
-from django.db.models import Count, Sum, Max, OuterRef, Subquery
+from django.db.models import Sum
 from django.db.models.functions import TruncDate
 from django.shortcuts import render
 from django.urls import path
+from django.utils.decorators import method_decorator
+from gwz.db import read_from_replica
 from .models import PageVisit
+from .rollups import ONE_DAY, VisitStats, day_start
 from store.models import Order, Product, OrderItem
 import json
 from django.core.serializers.json import DjangoJSONEncoder
@@ -12,12 +15,13 @@ from . import admin_backup
 
 # @admin.register(PageVisit)
 class PageVisitAdmin(admin.ModelAdmin):
-    list_display = ('path', 'timestamp', 'ip_address', 'device_type', 'browser', 'country')
-    list_filter = ('device_type', 'browser', 'timestamp')
+    list_display = ('path', 'timestamp', 'ip_address', 'agent__device_type', 'agent__browser', 'country')
+    list_filter = ('agent__device_type', 'agent__browser', 'timestamp')
     search_fields = ('path', 'ip_address')
     
     change_list_template = 'admin/analytics_dashboard.html'
 
+    @method_decorator(read_from_replica)
     def changelist_view(self, request, extra_context=None):
         from django.utils import timezone
         import datetime
@@ -27,8 +31,9 @@ class PageVisitAdmin(admin.ModelAdmin):
         product_id = request.GET.get('product_id')
         selected_product_name = "All Products"
         
-        today = timezone.now().date()
+        today = timezone.localdate()
         start_date = today.replace(month=1, day=1) # Default start of year
+        end_date = today
         
         if period == 'today':
             start_date = today
@@ -56,46 +61,31 @@ class PageVisitAdmin(admin.ModelAdmin):
         # For simple period implementation, we filter >= start_date.
         # For 'last_year', 'yesterday', 'last_month' we might need an end_date.
         
-        date_kwargs = {'timestamp__date__gte': start_date}
-        order_kwargs = {'created_at__date__gte': start_date}
-        order_item_kwargs = {'order__created_at__date__gte': start_date}
-
         if period == 'yesterday':
-             date_kwargs['timestamp__date__lte'] = start_date
-             order_kwargs['created_at__date__lte'] = start_date
-             order_item_kwargs['order__created_at__date__lte'] = start_date
+             end_date = start_date
         elif period == 'last_month':
              import calendar
              last_month_days = calendar.monthrange(start_date.year, start_date.month)[1]
              end_date = start_date + datetime.timedelta(days=last_month_days-1)
-             date_kwargs['timestamp__date__lte'] = end_date
-             order_kwargs['created_at__date__lte'] = end_date
-             order_item_kwargs['order__created_at__date__lte'] = end_date
         elif period == 'last_year':
              end_date = today.replace(year=today.year-1, month=12, day=31)
-             date_kwargs['timestamp__date__lte'] = end_date
-             order_kwargs['created_at__date__lte'] = end_date
-             order_item_kwargs['order__created_at__date__lte'] = end_date
 
-        # Aggregate daily traffic
-        daily_traffic = (
-            PageVisit.objects.filter(**date_kwargs)
-            .annotate(date=TruncDate('timestamp'))
-            .values('date')
-            .annotate(count=Count('id'))
-            .order_by('date')
-        )
+        # Compare against local-midnight bounds rather than `__date` so the
+        # created_at / timestamp indexes can be used.
+        period_start, period_end = day_start(start_date), day_start(end_date + ONE_DAY)
+        order_kwargs = {'created_at__gte': period_start, 'created_at__lt': period_end}
+        order_item_kwargs = {'order__created_at__gte': period_start, 'order__created_at__lt': period_end}
+
+        # Traffic comes from the daily rollup tables; only the days after the
+        # rollup watermark (normally just today) are read from PageVisit.
+        visit_stats = VisitStats(start_date, end_date)
+        daily_traffic = visit_stats.daily()
         
         # Total visits for percentage calc
-        total_visits_period = PageVisit.objects.filter(**date_kwargs).count() or 1
+        total_visits_period = visit_stats.total() or 1
 
         # Aggregate browser usage
-        browser_usage = (
-            PageVisit.objects.filter(**date_kwargs)
-            .values('browser')
-            .annotate(count=Count('id'))
-            .order_by('-count')
-        )
+        browser_usage = visit_stats.by_dimension('browser')
         browser_usage_list = []
         for b in browser_usage:
             browser_usage_list.append({
@@ -105,19 +95,9 @@ class PageVisitAdmin(admin.ModelAdmin):
             })
         
         # Aggregate device usage
-        device_usage = (
-            PageVisit.objects.filter(**date_kwargs)
-            .values('device_type')
-            .annotate(count=Count('id'))
-            .order_by('-count')
-        )
+        device_usage = visit_stats.by_dimension('device_type')
 
-        os_usage = (
-            PageVisit.objects.filter(**date_kwargs)
-            .values('os')
-            .annotate(count=Count('id'))
-            .order_by('-count')
-        )
+        os_usage = visit_stats.by_dimension('os')
         os_usage_list = []
         for o in os_usage:
             os_usage_list.append({
@@ -127,47 +107,14 @@ class PageVisitAdmin(admin.ModelAdmin):
             })
 
         # Aggregate country usage
-        country_usage = (
-            PageVisit.objects.filter(**date_kwargs)
-            .values('country')
-            .annotate(count=Count('id'))
-            .order_by('-count')
-        )
+        country_usage = visit_stats.by_dimension('country')
 
-        latest_path_sq = PageVisit.objects.filter(ip_address=OuterRef('ip_address')).order_by('-timestamp').values('path')[:1]
-        
-        # Prioritize known country/city info. If latest is Unknown, try to find previous known location.
-        latest_country_sq = PageVisit.objects.filter(
-            ip_address=OuterRef('ip_address')
-        ).exclude(country='Unknown').exclude(country__isnull=True).order_by('-timestamp').values('country')[:1]
-        
-        latest_country_code_sq = PageVisit.objects.filter(
-            ip_address=OuterRef('ip_address')
-        ).exclude(country_code='').exclude(country_code__isnull=True).order_by('-timestamp').values('country_code')[:1]
-        
-        latest_city_sq = PageVisit.objects.filter(ip_address=OuterRef('ip_address')).order_by('-timestamp').values('city')[:1]
-        latest_referer_sq = PageVisit.objects.filter(ip_address=OuterRef('ip_address')).order_by('-timestamp').values('referer')[:1]
-        latest_browser_sq = PageVisit.objects.filter(ip_address=OuterRef('ip_address')).order_by('-timestamp').values('browser')[:1]
-        latest_device_sq = PageVisit.objects.filter(ip_address=OuterRef('ip_address')).order_by('-timestamp').values('device_type')[:1]
-        most_active_visitors = (
-            PageVisit.objects.filter(**date_kwargs)
-            .values('ip_address')
-            .annotate(
-                views=Count('id'),
-                last_view=Max('timestamp'),
-                latest_page=Subquery(latest_path_sq),
-                country=Subquery(latest_country_sq),
-                country_code=Subquery(latest_country_code_sq),
-                city=Subquery(latest_city_sq),
-                referer=Subquery(latest_referer_sq),
-                browser=Subquery(latest_browser_sq),
-                device_type=Subquery(latest_device_sq),
-            )
-            .order_by('-views')[:20]
-        )
+        # Busiest IPs from the rollups, then their latest details within
+        # the period in a single windowed query.
+        top_visitors = visit_stats.add_latest_details(visit_stats.top_visitors(20))
         
         # Enrich visitor data with country codes for flags (fallback for old data)
-        most_active_visitors_list = list(most_active_visitors)
+        most_active_visitors_list = top_visitors
         country_map = {
             'Hong Kong': 'hk', 'China': 'cn', 'Taiwan': 'tw', 'United States': 'us', 'USA': 'us',
             'Japan': 'jp', 'United Kingdom': 'gb', 'UK': 'gb', 'Canada': 'ca', 'Australia': 'au',
@@ -295,9 +242,9 @@ class PageVisitAdmin(admin.ModelAdmin):
         extra_context['os_usage_list'] = os_usage_list
         extra_context['country_labels'] = json.dumps(country_labels, cls=DjangoJSONEncoder)
         extra_context['country_data'] = json.dumps(country_data, cls=DjangoJSONEncoder)
-        extra_context['total_visits'] = PageVisit.objects.count()
+        extra_context['total_visits'] = VisitStats().total()
         # Today Visitors
-        extra_context['today_visits'] = PageVisit.objects.filter(timestamp__date=today).count()
+        extra_context['today_visits'] = PageVisit.objects.filter(timestamp__gte=day_start(today)).count()
         
         extra_context['sales_labels'] = json.dumps(sales_labels, cls=DjangoJSONEncoder)
         extra_context['sales_data'] = json.dumps(sales_amounts, cls=DjangoJSONEncoder)
@@ -0,0 +1,312 @@
+"""
+GeoIP resolution for page visits.
+
+By default visits are geolocated through ipapi.co (cached in django.core.cache).
+When ANALYTICS_GEOIP_DATASET points at a local dataset the lookup is done
+offline instead:
+
+* a CSV file of `network,country_code,country,city` rows (CIDR networks,
+  header optional) is compiled once into a sorted binary range index next to
+  it (`<dataset>.idx`) and memory-mapped, so every worker shares the same pages
+  and a lookup is a binary search over fixed-size records;
+* a MaxMind `.mmdb` file is read with the optional `maxminddb` package.
+
+The HTTP lookup is then only used for addresses missing from the dataset, and
+only if ANALYTICS_GEOIP_HTTP_FALLBACK is enabled.
+"""
+import csv
+import ipaddress
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from urllib.error import URLError, HTTPError
+from urllib.request import urlopen, Request
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+UNKNOWN = ('Unknown', 'Unknown', '')
+
+INDEX_MAGIC = b'GWZGEO01'
+# magic, record count, offset of the JSON label table
+INDEX_HEADER = struct.Struct('>8sIQ')
+# range start, range end (IPv6 / IPv4-mapped, big endian), label number
+INDEX_RECORD = struct.Struct('>16s16sI')
+
+
+def ip_key(ip):
+    """16-byte sort key for an address; IPv4 is mapped into ::ffff:0:0/96."""
+    address = ipaddress.ip_address(ip)
+    if address.version == 4:
+        return ipaddress.IPv6Address((0xffff << 32) | int(address)).packed
+    if address.ipv4_mapped:
+        return ipaddress.IPv6Address((0xffff << 32) | int(address.ipv4_mapped)).packed
+    return address.packed
+
+
+def network_range(network):
+    net = ipaddress.ip_network(network.strip(), strict=False)
+    return ip_key(net.network_address), ip_key(net.broadcast_address)
+
+
+def flatten_ranges(records):
+    """
+    Turn (start, end, label) CIDR ranges, which may nest, into sorted
+    disjoint ranges where the most specific network wins (the later row for
+    duplicates), so a lookup only ever has to check one range.
+    """
+    ranges = []
+
+    def emit(start, end, label):
+        if start > end:
+            return
+        if ranges and ranges[-1][2] == label and ranges[-1][1] + 1 == start:
+            ranges[-1] = (ranges[-1][0], end, label)
+        else:
+            ranges.append((start, end, label))
+
+    # Networks either nest or are disjoint; outer ones sort first
+    ordered = sorted(
+        ((int.from_bytes(start, 'big'), int.from_bytes(end, 'big'), label) for start, end, label in records),
+        key=lambda record: (record[0], -record[1]),
+    )
+    open_ranges = []
+    cursor = 0
+    for start, end, label in ordered:
+        while open_ranges and open_ranges[-1][1] < start:
+            _, closed_end, closed_label = open_ranges.pop()
+            emit(cursor, closed_end, closed_label)
+            cursor = max(cursor, closed_end + 1)
+        if open_ranges:
+            emit(cursor, start - 1, open_ranges[-1][2])
+        cursor = start
+        open_ranges.append((start, end, label))
+    while open_ranges:
+        _, closed_end, closed_label = open_ranges.pop()
+        emit(cursor, closed_end, closed_label)
+        cursor = max(cursor, closed_end + 1)
+    return [(start.to_bytes(16, 'big'), end.to_bytes(16, 'big'), label) for start, end, label in ranges]
+
+
+def build_index(csv_path, index_path=None):
+    """
+    Compile a CIDR CSV dataset into a binary range index. Returns the path
+    of the index and the number of ranges written.
+    """
+    index_path = index_path or f'{csv_path}.idx'
+    labels = []
+    label_ids = {}
+    records = []
+
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith('#'):
+                continue
+            try:
+                start, end = network_range(row[0])
+            except ValueError:
+                # Header row or garbage
+                continue
+            cells = [c.strip() for c in row[1:4]] + [''] * (4 - len(row))
+            label = (cells[0].upper(), cells[1] or 'Unknown', cells[2] or 'Unknown')
+            if label not in label_ids:
+                label_ids[label] = len(labels)
+                labels.append(label)
+            records.append((start, end, label_ids[label]))
+
+    records = flatten_ranges(records)
+
+    # A private temporary file, as several workers may build the index at once
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(index_path)), prefix=f'{os.path.basename(index_path)}.', suffix='.tmp',
+    )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            labels_offset = INDEX_HEADER.size + INDEX_RECORD.size * len(records)
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(records), labels_offset))
+            for record in records:
+                f.write(INDEX_RECORD.pack(*record))
+            f.write(json.dumps(labels, ensure_ascii=False).encode('utf-8'))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return index_path, len(records)
+
+
+class HttpGeoResolver:
+    """The ipapi.co lookup, cached for 24 hours per address."""
+
+    def lookup(self, ip, user_agent=''):
+        cache_key = f'geoip_v2_{ip}'
+        cached_data = cache.get(cache_key)
+        if cached_data:
+            return (
+                cached_data.get('country_name', 'Unknown'),
+                cached_data.get('city', 'Unknown'),
+                cached_data.get('country_code', ''),
+            )
+
+        try:
+            # 2 second timeout is enough for backend task
+            req = Request(f"https://ipapi.co/{ip}/json/", headers={'User-Agent': user_agent})
+            with urlopen(req, timeout=2) as response:
+                data = json.loads(response.read().decode())
+        except (URLError, HTTPError, Exception):
+            return None
+
+        country = data.get('country_name', 'Unknown')
+        city = data.get('city', 'Unknown')
+        country_code = data.get('country', '') # ipapi.co returns ISO code in 'country' field
+        cache.set(cache_key, {
+            'country_name': country,
+            'city': city,
+            'country_code': country_code
+        }, 60 * 60 * 24)
+        return country, city, country_code
+
+
+class RangeIndexResolver:
+    """Binary search over a memory-mapped index built by build_index()."""
+
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, labels_offset = INDEX_HEADER.unpack_from(self._map, 0)
+        if magic != INDEX_MAGIC:
+            raise ImproperlyConfigured(f'{index_path} is not a GeoIP index file.')
+        self.labels = [tuple(label) for label in json.loads(self._map[labels_offset:].decode('utf-8'))]
+
+    def lookup(self, ip, user_agent=''):
+        try:
+            key = ip_key(ip)
+        except ValueError:
+            return None
+
+        # Rightmost range starting at or before the address; the ranges are
+        # disjoint (see flatten_ranges), so it is the only candidate
+        lo, hi = 0, self.count
+        size, base = INDEX_RECORD.size, INDEX_HEADER.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = base + mid * size
+            if self._map[offset:offset + 16] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+
+        start, end, label = INDEX_RECORD.unpack_from(self._map, base + (lo - 1) * size)
+        if key > end:
+            return None
+        country_code, country, city = self.labels[label]
+        return country, city, country_code
+
+
+class MaxMindResolver:
+    """Reads a GeoLite2/GeoIP2 City or Country .mmdb file."""
+
+    def __init__(self, path):
+        try:
+            import maxminddb
+        except ImportError:
+            raise ImproperlyConfigured('Reading .mmdb GeoIP datasets requires the maxminddb package.')
+        self._reader = maxminddb.open_database(str(path), maxminddb.MODE_MMAP)
+
+    def lookup(self, ip, user_agent=''):
+        try:
+            record = self._reader.get(ip)
+        except ValueError:
+            return None
+        if not record:
+            return None
+        country = record.get('country') or record.get('registered_country') or {}
+        city = record.get('city') or {}
+        return (
+            country.get('names', {}).get('en', 'Unknown'),
+            city.get('names', {}).get('en', 'Unknown'),
+            country.get('iso_code', ''),
+        )
+
+
+class LocalGeoResolver:
+    """
+    Offline resolver for ANALYTICS_GEOIP_DATASET. CSV datasets are compiled
+    into an index on first use, and again whenever the CSV is newer.
+    """
+
+    def __init__(self, dataset):
+        dataset = str(dataset)
+        if dataset.endswith('.mmdb'):
+            self._resolver = MaxMindResolver(dataset)
+            return
+
+        if dataset.endswith('.idx'):
+            index_path = dataset
+        else:
+            index_path = f'{dataset}.idx'
+            if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(dataset):
+                build_index(dataset, index_path)
+        self._resolver = RangeIndexResolver(index_path)
+
+    def lookup(self, ip, user_agent=''):
+        return self._resolver.lookup(ip, user_agent)
+
+
+class ChainedGeoResolver:
+    """Tries each resolver in turn until one knows the address."""
+
+    def __init__(self, resolvers):
+        self.resolvers = resolvers
+
+    def lookup(self, ip, user_agent=''):
+        for resolver in self.resolvers:
+            result = resolver.lookup(ip, user_agent)
+            if result:
+                return result
+        return None
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver():
+    """
+    Build the process-wide resolver from settings:
+
+    ANALYTICS_GEOIP_RESOLVER       dotted path of a custom resolver class
+    ANALYTICS_GEOIP_DATASET        local CSV / .idx / .mmdb dataset
+    ANALYTICS_GEOIP_HTTP_FALLBACK  use ipapi.co for addresses the dataset
+                                   does not cover
+    """
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                custom = getattr(settings, 'ANALYTICS_GEOIP_RESOLVER', None)
+                dataset = getattr(settings, 'ANALYTICS_GEOIP_DATASET', None)
+                if custom:
+                    _resolver = import_string(custom)()
+                elif dataset:
+                    resolvers = [LocalGeoResolver(dataset)]
+                    if getattr(settings, 'ANALYTICS_GEOIP_HTTP_FALLBACK', False):
+                        resolvers.append(HttpGeoResolver())
+                    _resolver = ChainedGeoResolver(resolvers)
+                else:
+                    _resolver = HttpGeoResolver()
+    return _resolver
+
+
+def resolve(ip, user_agent=''):
+    """Return (country, city, country_code) for an IP address."""
+    if not ip:
+        return UNKNOWN
+    return get_resolver().lookup(ip, user_agent) or UNKNOWN
@@ -0,0 +1,308 @@
+"""
+Page visit ingestion.
+
+AnalyticsMiddleware only collects the raw request data for a visit. Turning
+that into a PageVisit row (device detection, GeoIP lookup, INSERT) happens
+here, either inline ("sync" mode) or on a background thread that writes
+visits in batches ("buffered" mode, see ANALYTICS_INGEST_MODE).
+
+Each distinct User-Agent string is parsed and stored once in the UserAgent
+table; visits only reference it.
+"""
+import atexit
+import functools
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+
+from . import geoip, rollups
+from .models import PageVisit, UserAgent
+
+logger = logging.getLogger(__name__)
+
+# Longer User-Agent headers are cut off before they are stored
+MAX_USER_AGENT_LENGTH = 512
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_user_agent(user_agent):
+    """Return (device_type, browser, os) for a raw User-Agent string."""
+    ua = (user_agent or '').lower()
+
+    # Basic Device Detection
+    device_type = 'Desktop'
+    if 'mobile' in ua or 'iphone' in ua or 'android' in ua and 'mobile' in ua:
+        device_type = 'Mobile'
+    elif 'ipad' in ua or 'tablet' in ua:
+        device_type = 'Tablet'
+
+    # Basic Browser Detection
+    browser = 'Unknown'
+    if 'chrome' in ua and 'safari' in ua:
+        browser = 'Chrome'
+    elif 'firefox' in ua:
+        browser = 'Firefox'
+    elif 'safari' in ua and 'chrome' not in ua:
+        browser = 'Safari'
+    elif 'edg' in ua or 'edge' in ua:
+        browser = 'Edge'
+    elif 'opera' in ua or 'opr' in ua:
+        browser = 'Opera'
+    elif 'trident' in ua or 'msie' in ua:
+        browser = 'IE'
+
+    # Basic OS Detection
+    os_type = 'Unknown'
+    if 'windows' in ua:
+        os_type = 'Windows'
+    elif 'macintosh' in ua or 'mac os' in ua:
+        os_type = 'MacOS'
+    elif 'linux' in ua and 'android' not in ua:
+        os_type = 'Linux'
+    elif 'android' in ua:
+        os_type = 'Android'
+    elif 'ios' in ua or 'iphone' in ua or 'ipad' in ua:
+        os_type = 'iOS'
+
+    return device_type, browser, os_type
+
+
+def user_agent_hash(user_agent):
+    return hashlib.sha1(user_agent.encode('utf-8', 'replace')).hexdigest()
+
+
+# {User-Agent hash: UserAgent id} of rows known to be committed
+_agent_ids = {}
+MAX_CACHED_AGENTS = 4096
+
+
+def _remember_agent(ua_hash, agent_id):
+    if len(_agent_ids) >= MAX_CACHED_AGENTS:
+        _agent_ids.clear()
+    _agent_ids[ua_hash] = agent_id
+
+
+def get_user_agent_id(user_agent):
+    """The id of the (interned) UserAgent row for a raw User-Agent string."""
+    user_agent = (user_agent or '')[:MAX_USER_AGENT_LENGTH]
+    ua_hash = user_agent_hash(user_agent)
+    agent_id = _agent_ids.get(ua_hash)
+    if agent_id is None:
+        device_type, browser, os_type = parse_user_agent(user_agent)
+        agent_id = UserAgent.objects.get_or_create(
+            ua_hash=ua_hash,
+            defaults={'user_agent': user_agent, 'device_type': device_type, 'browser': browser, 'os': os_type},
+        )[0].pk
+        # Cached only once the row is committed: an id from a transaction
+        # that is rolled back would point at nothing.
+        transaction.on_commit(functools.partial(_remember_agent, ua_hash, agent_id))
+    return agent_id
+
+
+def build_page_visit(visit):
+    """
+    Build an unsaved PageVisit from the raw data collected by the middleware.
+    `visit` is a dict with user_id, path, ip_address, user_agent, referer and
+    timestamp keys. The browser, device and OS are only stored on the
+    UserAgent row; the PageVisit columns of the same names are left empty.
+    """
+    user_agent = visit.get('user_agent', '')
+    country, city, country_code = geoip.resolve(visit['ip_address'], user_agent)
+
+    return PageVisit(
+        user_id=visit.get('user_id'),
+        path=visit['path'],
+        ip_address=visit['ip_address'],
+        agent_id=get_user_agent_id(user_agent),
+        country=country,
+        country_code=country_code,
+        city=city,
+        referer=visit.get('referer', ''),
+        timestamp=visit['timestamp'],
+    )
+
+
+def save_visits(visits):
+    """Resolve and write a list of raw visits with a single bulk INSERT."""
+    objs = [build_page_visit(visit) for visit in visits]
+    try:
+        with transaction.atomic():
+            PageVisit.objects.bulk_create(objs)
+    except IntegrityError:
+        # A cached UserAgent row has gone away (it can only be rolled back,
+        # visits protect it from deletion): look the agents up again.
+        logger.warning("Stale User-Agent ids while writing page visits, retrying")
+        _agent_ids.clear()
+        for obj, visit in zip(objs, visits):
+            obj.pk = None
+            obj._state.adding = True
+            obj.agent_id = get_user_agent_id(visit.get('user_agent', ''))
+        PageVisit.objects.bulk_create(objs)
+    return objs
+
+
+class VisitBuffer:
+    """
+    In-process queue of raw visits drained by a background writer thread.
+
+    submit() never blocks: when the queue is full the visit is dropped and
+    counted. The writer flushes whenever `batch_size` visits are waiting or
+    `flush_interval` seconds have passed since the first one arrived, and
+    drains whatever is left when the buffer is stopped. Every
+    `stats_interval` seconds, and on stop, it logs the counters: as a
+    warning when visits were dropped or failed to write since the last time.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=5.0, max_size=10000, stats_interval=300.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats_interval = stats_interval
+        self.queue = queue.Queue(maxsize=max_size)
+        self.stats = {'submitted': 0, 'dropped': 0, 'written': 0, 'failed': 0, 'batches': 0}
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._next_report = time.monotonic() + stats_interval
+        self._reported_losses = 0
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def submit(self, visit):
+        """Queue a visit for writing. Returns False if it had to be dropped."""
+        self.start()
+        try:
+            self.queue.put_nowait(visit)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('submitted')
+        return True
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='analytics-visit-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stop the writer thread after it has flushed everything queued."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        # Anything submitted after the thread exited is written here
+        self.flush()
+        self.report_stats()
+
+    def flush(self):
+        """Write everything currently queued from the calling thread."""
+        while True:
+            batch = self._take(self.batch_size, block=False)
+            if not batch:
+                return
+            self._write(batch)
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+    def report_stats(self):
+        """Log the counters, as a warning if visits were lost since the last report."""
+        stats = self.get_stats()
+        losses = stats['dropped'] + stats['failed']
+        level = logging.WARNING if losses > self._reported_losses else logging.INFO
+        self._reported_losses = losses
+        self._next_report = time.monotonic() + self.stats_interval
+        logger.log(level, "Page visit buffer: %s", ', '.join(f'{key} {value}' for key, value in stats.items()))
+
+    def _take(self, limit, block=True):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < limit:
+            if block and not batch:
+                # Wait for the first visit of a batch, waking up regularly
+                # to notice a stop request.
+                timeout = 0.5
+            elif block:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            else:
+                timeout = None
+            try:
+                if timeout is None:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                if not block or batch or self._stop.is_set():
+                    break
+            else:
+                if len(batch) == 1:
+                    deadline = time.monotonic() + self.flush_interval
+        return batch
+
+    def _write(self, batch):
+        close_old_connections()
+        try:
+            save_visits(batch)
+        except Exception:
+            logger.exception("Failed to write %d page visits", len(batch))
+            self._count('failed', len(batch))
+        else:
+            self._count('written', len(batch))
+            self._count('batches')
+            if getattr(settings, 'ANALYTICS_ROLLUP_ON_INGEST', True):
+                rollups.rollup_if_due()
+        finally:
+            close_old_connections()
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._take(self.batch_size)
+            if batch:
+                self._write(batch)
+            if time.monotonic() >= self._next_report:
+                self.report_stats()
+        self.flush()
+
+
+_buffer = None
+_buffer_pid = None
+_buffer_lock = threading.Lock()
+
+
+def get_visit_buffer():
+    """
+    Return the process-wide VisitBuffer, creating it on first use. A forked
+    worker gets its own buffer (and writer thread) rather than the parent's.
+    """
+    global _buffer, _buffer_pid
+    pid = os.getpid()
+    if _buffer is None or _buffer_pid != pid:
+        with _buffer_lock:
+            if _buffer is None or _buffer_pid != pid:
+                _buffer = VisitBuffer(
+                    batch_size=getattr(settings, 'ANALYTICS_INGEST_BATCH_SIZE', 100),
+                    flush_interval=getattr(settings, 'ANALYTICS_INGEST_FLUSH_INTERVAL', 5.0),
+                    max_size=getattr(settings, 'ANALYTICS_INGEST_QUEUE_SIZE', 10000),
+                    stats_interval=getattr(settings, 'ANALYTICS_INGEST_STATS_INTERVAL', 300.0),
+                )
+                _buffer_pid = pid
+                atexit.register(_buffer.stop)
+    return _buffer
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from analytics.retention import archive_visits, month_start, purge_archive
+from analytics.rollups import rollup_pending
+
+class Command(BaseCommand):
+    help = 'Move page visits of past months into the archive table and drop expired archived months'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=3,
+                            help='Months of raw visits to keep in PageVisit, besides the current one (default: 3)')
+        parser.add_argument('--purge-months', type=int,
+                            help='Delete archived visits older than this many months (default: keep them)')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Visits moved or deleted per transaction (default: 5000)')
+
+    def handle(self, *args, **options):
+        keep_months = options['keep_months']
+        purge_months = options['purge_months']
+        if keep_months < 0 or options['batch_size'] < 1:
+            raise CommandError('--keep-months must be >= 0 and --batch-size >= 1')
+        if purge_months is not None and purge_months < keep_months:
+            raise CommandError('--purge-months must not be smaller than --keep-months')
+
+        # Only rolled-up days are archived, so bring the rollups up to date first
+        rollup_pending()
+
+        today = timezone.localdate()
+        archive_before = month_start(today, keep_months)
+        moved = archive_visits(archive_before, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {moved} visit(s) from before {archive_before}'))
+
+        if purge_months is not None:
+            purge_before = month_start(today, purge_months)
+            deleted = purge_archive(purge_before, options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} archived visit(s) from before {purge_before}'))
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from analytics.geoip import build_index
+import os
+
+class Command(BaseCommand):
+    help = 'Compile a CIDR GeoIP CSV dataset into the binary range index used for offline lookups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', nargs='?', help='CSV file (defaults to ANALYTICS_GEOIP_DATASET)')
+        parser.add_argument('--output', help='Index file to write (defaults to <dataset>.idx)')
+
+    def handle(self, *args, **options):
+        dataset = options['dataset'] or getattr(settings, 'ANALYTICS_GEOIP_DATASET', None)
+        if not dataset:
+            raise CommandError('No dataset given and ANALYTICS_GEOIP_DATASET is not set.')
+        dataset = str(dataset)
+        if not dataset.endswith('.csv'):
+            raise CommandError('Only CSV datasets need an index; .mmdb files are read directly.')
+        if not os.path.exists(dataset):
+            raise CommandError(f'Dataset not found: {dataset}')
+
+        index_path, count = build_index(dataset, options['output'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {count} ranges to {index_path}'))
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from analytics.models import PageVisit, PageVisitArchive
+from analytics.retention import export_visits
+from analytics.rollups import ONE_DAY, rollup_pending
+import time
+
+class Command(BaseCommand):
+    help = ('Roll up page visits older than N days, export them to gzip\'d NDJSON files '
+            'and delete them from the database in small batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'ANALYTICS_RETENTION_DAYS', 90),
+                            help='Days of raw visits to keep (default: ANALYTICS_RETENTION_DAYS)')
+        parser.add_argument('--output', default=getattr(settings, 'ANALYTICS_EXPORT_DIR', None),
+                            help='Directory for the export files (default: ANALYTICS_EXPORT_DIR)')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Visits deleted per statement (default: 5000)')
+        parser.add_argument('--every', type=float, metavar='HOURS',
+                            help='Keep running and prune again every HOURS hours')
+
+    def handle(self, *args, **options):
+        if options['days'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--days and --batch-size must be at least 1')
+        if not options['output']:
+            raise CommandError('No --output given and ANALYTICS_EXPORT_DIR is not set.')
+
+        while True:
+            self.prune(options)
+            if not options['every']:
+                return
+            time.sleep(options['every'] * 60 * 60)
+
+    def prune(self, options):
+        # Downsample first: only days covered by the rollups are exported
+        rolled = rollup_pending()
+        if rolled:
+            self.stdout.write(f'Rolled up {len(rolled)} day(s): {rolled[0]} to {rolled[-1]}')
+
+        before = timezone.localdate() - options['days'] * ONE_DAY
+        for model in (PageVisitArchive, PageVisit):
+            exported = export_visits(model, before, str(options['output']), options['batch_size'])
+            total = sum(count for path, count in exported)
+            self.stdout.write(self.style.SUCCESS(
+                f'{model._meta.object_name}: exported and deleted {total} visit(s) '
+                f'from before {before} into {len(exported)} file(s)'
+            ))
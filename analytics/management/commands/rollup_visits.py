@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+from analytics.models import PageVisit
+from analytics.retention import archived_through
+from analytics.rollups import rollup_day, rollup_pending, ONE_DAY, ROLLUP_GRACE
+import datetime
+
+class Command(BaseCommand):
+    help = 'Aggregate finished days of page visits into the dashboard rollup tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Recompute every day from this date (YYYY-MM-DD)')
+        parser.add_argument('--rebuild', action='store_true', help='Recompute every day since the first recorded visit')
+
+    def handle(self, *args, **options):
+        until = timezone.localdate(timezone.now() - ROLLUP_GRACE)
+
+        if options['since'] or options['rebuild']:
+            first_visit = PageVisit.objects.aggregate(Min('timestamp'))['timestamp__min']
+            if first_visit is None:
+                self.stdout.write('No page visits recorded yet.')
+                return
+            day = timezone.localdate(first_visit)
+
+            if options['since']:
+                try:
+                    since = datetime.datetime.strptime(options['since'], '%Y-%m-%d').date()
+                except ValueError:
+                    raise CommandError('--since must be a date in YYYY-MM-DD format')
+                # Days before the oldest raw visit have been archived or
+                # exported; recomputing them would wipe their rollups.
+                if since < day:
+                    self.stdout.write(self.style.WARNING(f'Visits before {day} are archived; their rollups are kept.'))
+                day = max(day, since)
+
+            # Some visits of the days up to the newest archived one may have
+            # been moved already; rebuilding them would shrink their counts.
+            archived = archived_through()
+            if archived is not None and day <= archived:
+                self.stdout.write(self.style.WARNING(f'Visits up to {archived} are archived; their rollups are kept.'))
+                day = archived + ONE_DAY
+
+            days = []
+            while day < until:
+                rollup_day(day)
+                days.append(day)
+                day += ONE_DAY
+        else:
+            days = rollup_pending(until)
+
+        if days:
+            self.stdout.write(self.style.SUCCESS(f'Rolled up {len(days)} day(s): {days[0]} to {days[-1]}'))
+        else:
+            self.stdout.write('Rollups are up to date.')
@@ -1,31 +1,13 @@
-from .models import PageVisit
-import re
+from django.conf import settings
 from django.http import HttpResponseForbidden
-import json
-from urllib.request import urlopen, Request
-from urllib.error import URLError, HTTPError
+from django.utils import timezone
+from . import waf
+from .ingest import get_visit_buffer, save_visits
 
 class WAFMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
-        self.sql_injection_patterns = [
-            r"union\s+select",
-            r"drop\s+table",
-            r"delete\s+from",
-            r"update\s+.*set",
-            r"insert\s+into",
-            r"exec\s*\(",
-        ]
-        self.xss_patterns = [
-            r"<script>",
-            r"javascript:",
-            r"onload\s*=",
-            r"onerror\s*=",
-        ]
-        self.traversal_patterns = [
-            r"\.\./",
-            r"\.\.\\",
-        ]
+        self.rule_set = waf.get_rule_set()
 
     def __call__(self, request):
         if self.check_request(request):
@@ -35,27 +17,11 @@ class WAFMiddleware:
         return response
 
     def check_request(self, request):
-        # Check GET params
-        for value in request.GET.values():
-            if self.is_suspicious(value):
-                return True
-        
-        # Check POST params
-        for value in request.POST.values():
-            if self.is_suspicious(value):
-                return True
-                
-        return False
+        # Path and GET/POST values, plus headers and JSON bodies if enabled
+        return waf.inspect_request(request, self.rule_set) is not None
 
     def is_suspicious(self, value):
-        if not isinstance(value, str):
-            return False
-        
-        value = value.lower()
-        for pattern in self.sql_injection_patterns + self.xss_patterns + self.traversal_patterns:
-            if re.search(pattern, value):
-                return True
-        return False
+        return self.rule_set.match(value) is not None
 
 
 class AnalyticsMiddleware:
@@ -65,8 +31,10 @@ class AnalyticsMiddleware:
     def __call__(self, request):
         response = self.get_response(request)
         
-        # Only track GET requests and successful responses
-        if request.method == 'GET' and response.status_code == 200:
+        # Only track GET requests and successful page responses (not JSON
+        # endpoints such as the search autocomplete)
+        if (request.method == 'GET' and response.status_code == 200
+                and not response.get('Content-Type', '').startswith('application/json')):
             # Skip admin and static files
             path = request.path
             if not path.startswith('/admin/') and not path.startswith('/static/') and not path.startswith('/media/'):
@@ -75,91 +43,21 @@ class AnalyticsMiddleware:
         return response
 
     def record_visit(self, request):
-        ip = self.get_client_ip(request)
-        user_agent = request.META.get('HTTP_USER_AGENT', '')
-        referer = request.META.get('HTTP_REFERER', '')
-        
-        # Basic Device Detection
-        ua = user_agent.lower()
-        device_type = 'Desktop'
-        if 'mobile' in ua or 'iphone' in ua or 'android' in ua and 'mobile' in ua:
-            device_type = 'Mobile'
-        elif 'ipad' in ua or 'tablet' in ua:
-            device_type = 'Tablet'
-            
-        # Basic Browser Detection
-        browser = 'Unknown'
-        if 'chrome' in ua and 'safari' in ua:
-            browser = 'Chrome'
-        elif 'firefox' in ua:
-            browser = 'Firefox'
-        elif 'safari' in ua and 'chrome' not in ua:
-            browser = 'Safari'
-        elif 'edg' in ua or 'edge' in ua:
-            browser = 'Edge'
-        elif 'opera' in ua or 'opr' in ua:
-            browser = 'Opera'
-        elif 'trident' in ua or 'msie' in ua:
-            browser = 'IE'
+        visit = {
+            'user_id': request.user.pk if request.user.is_authenticated else None,
+            'path': request.path,
+            'ip_address': self.get_client_ip(request),
+            'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+            'referer': request.META.get('HTTP_REFERER', ''),
+            'timestamp': timezone.now(),
+        }
 
-        # Basic OS Detection
-        os_type = 'Unknown'
-        if 'windows' in ua:
-            os_type = 'Windows'
-        elif 'macintosh' in ua or 'mac os' in ua:
-            os_type = 'MacOS'
-        elif 'linux' in ua and 'android' not in ua:
-            os_type = 'Linux'
-        elif 'android' in ua:
-            os_type = 'Android'
-        elif 'ios' in ua or 'iphone' in ua or 'ipad' in ua:
-            os_type = 'iOS'
-            
-        # GeoIP (lightweight, using ipapi.co; safe fallback to Unknown)
-        country, city, country_code = 'Unknown', 'Unknown', ''
-        
-        # Check cache first to avoid API spam
-        from django.core.cache import cache
-        cache_key = f'geoip_v2_{ip}'
-        cached_data = cache.get(cache_key)
-        
-        if cached_data:
-            country = cached_data.get('country_name', 'Unknown')
-            city = cached_data.get('city', 'Unknown')
-            country_code = cached_data.get('country_code', '')
+        # In buffered mode the device/GeoIP resolution and the INSERT happen
+        # on the background writer, so the response is never held up.
+        if getattr(settings, 'ANALYTICS_INGEST_MODE', 'buffered') == 'buffered':
+            get_visit_buffer().submit(visit)
         else:
-            try:
-                # 2 second timeout is enough for backend task
-                req = Request(f"https://ipapi.co/{ip}/json/", headers={'User-Agent': user_agent})
-                with urlopen(req, timeout=2) as response:
-                    data = json.loads(response.read().decode())
-                    country = data.get('country_name', 'Unknown')
-                    city = data.get('city', 'Unknown')
-                    country_code = data.get('country', '') # ipapi.co returns ISO code in 'country' field
-                    
-                    # Cache result for 24 hours
-                    cache.set(cache_key, {
-                        'country_name': country,
-                        'city': city,
-                        'country_code': country_code
-                    }, 60 * 60 * 24)
-                    
-            except (URLError, HTTPError, Exception):
-                pass
-        
-        PageVisit.objects.create(
-            user=request.user if request.user.is_authenticated else None,
-            path=request.path,
-            ip_address=ip,
-            user_agent=user_agent,
-            device_type=device_type,
-            browser=browser,
-            os=os_type,
-            country=country,
-            country_code=country_code,
-            city=city,
-            referer=referer,
-        )
+            save_visits([visit])
 
     def get_client_ip(self, request):
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.9 on 2026-10-17 14:33
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0006_pagevisit_country_code'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pagevisit',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='時間'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.9 on 2026-10-17 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0007_pagevisit_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyVisitorRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日期')),
+                ('ip_address', models.GenericIPAddressField(verbose_name='IP 地址')),
+                ('views', models.PositiveIntegerField(default=0, verbose_name='瀏覽次數')),
+                ('last_view', models.DateTimeField(verbose_name='最後瀏覽')),
+            ],
+            options={
+                'verbose_name': '每日訪客統計',
+                'verbose_name_plural': '每日訪客統計',
+                'ordering': ['-date', '-views'],
+                'unique_together': {('date', 'ip_address')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyVisitRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日期')),
+                ('dimension', models.CharField(choices=[('total', '總數'), ('browser', '瀏覽器'), ('device_type', '裝置類型'), ('os', '作業系統'), ('country', '國家')], max_length=20, verbose_name='維度')),
+                ('value', models.CharField(blank=True, max_length=100, verbose_name='值')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='次數')),
+            ],
+            options={
+                'verbose_name': '每日訪問統計',
+                'verbose_name_plural': '每日訪問統計',
+                'ordering': ['-date', 'dimension', '-count'],
+                'unique_together': {('date', 'dimension', 'value')},
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.9 on 2026-10-17 14:57
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0008_visit_rollups'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageVisitArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, verbose_name='路徑')),
+                ('ip_address', models.GenericIPAddressField(verbose_name='IP 地址')),
+                ('user_agent', models.TextField(blank=True, null=True, verbose_name='User Agent')),
+                ('referer', models.URLField(blank=True, null=True, verbose_name='來源')),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now, verbose_name='時間')),
+                ('country', models.CharField(blank=True, max_length=100, null=True, verbose_name='國家')),
+                ('country_code', models.CharField(blank=True, max_length=5, null=True, verbose_name='國家代碼')),
+                ('city', models.CharField(blank=True, max_length=100, null=True, verbose_name='城市')),
+                ('device_type', models.CharField(blank=True, max_length=50, null=True, verbose_name='裝置類型')),
+                ('browser', models.CharField(blank=True, max_length=100, null=True, verbose_name='瀏覽器')),
+                ('os', models.CharField(blank=True, max_length=100, null=True, verbose_name='作業系統')),
+                ('month', models.DateField(verbose_name='月份')),
+            ],
+            options={
+                'verbose_name': '訪客紀錄封存',
+                'verbose_name_plural': '訪客紀錄封存',
+                'ordering': ['-timestamp'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='pagevisit',
+            index=models.Index(fields=['ip_address', 'timestamp'], name='pagevisit_ip_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pagevisit',
+            index=models.Index(fields=['timestamp', 'ip_address', 'browser', 'os', 'device_type', 'country'], name='pagevisit_rollup_idx'),
+        ),
+        migrations.AddField(
+            model_name='pagevisitarchive',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='使用者'),
+        ),
+        migrations.AddIndex(
+            model_name='pagevisitarchive',
+            index=models.Index(fields=['month', 'timestamp'], name='pagevisitarchive_month_idx'),
+        ),
+    ]
@@ -0,0 +1,134 @@
+# Generated by Django 5.2.9 on 2026-10-17 15:02
+
+import hashlib
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Frozen copies of analytics.ingest as of this migration, so that later
+# changes there cannot alter what it does.
+MAX_USER_AGENT_LENGTH = 512
+
+
+def user_agent_hash(user_agent):
+    return hashlib.sha1(user_agent.encode('utf-8', 'replace')).hexdigest()
+
+
+def parse_user_agent(user_agent):
+    ua = (user_agent or '').lower()
+
+    device_type = 'Desktop'
+    if 'mobile' in ua or 'iphone' in ua or 'android' in ua and 'mobile' in ua:
+        device_type = 'Mobile'
+    elif 'ipad' in ua or 'tablet' in ua:
+        device_type = 'Tablet'
+
+    browser = 'Unknown'
+    if 'chrome' in ua and 'safari' in ua:
+        browser = 'Chrome'
+    elif 'firefox' in ua:
+        browser = 'Firefox'
+    elif 'safari' in ua and 'chrome' not in ua:
+        browser = 'Safari'
+    elif 'edg' in ua or 'edge' in ua:
+        browser = 'Edge'
+    elif 'opera' in ua or 'opr' in ua:
+        browser = 'Opera'
+    elif 'trident' in ua or 'msie' in ua:
+        browser = 'IE'
+
+    os_type = 'Unknown'
+    if 'windows' in ua:
+        os_type = 'Windows'
+    elif 'macintosh' in ua or 'mac os' in ua:
+        os_type = 'MacOS'
+    elif 'linux' in ua and 'android' not in ua:
+        os_type = 'Linux'
+    elif 'android' in ua:
+        os_type = 'Android'
+    elif 'ios' in ua or 'iphone' in ua or 'ipad' in ua:
+        os_type = 'iOS'
+
+    return device_type, browser, os_type
+
+
+def intern_user_agents(apps, schema_editor):
+    UserAgent = apps.get_model('analytics', 'UserAgent')
+    agents = {}
+
+    def agent_id(user_agent):
+        user_agent = (user_agent or '')[:MAX_USER_AGENT_LENGTH]
+        if user_agent not in agents:
+            device_type, browser, os_type = parse_user_agent(user_agent)
+            agents[user_agent] = UserAgent.objects.get_or_create(
+                ua_hash=user_agent_hash(user_agent),
+                defaults={'user_agent': user_agent, 'device_type': device_type, 'browser': browser, 'os': os_type},
+            )[0].pk
+        return agents[user_agent]
+
+    for model_name in ('PageVisit', 'PageVisitArchive'):
+        model = apps.get_model('analytics', model_name)
+        last_id = 0
+        while True:
+            batch = list(model.objects.filter(id__gt=last_id, agent__isnull=True).order_by('id').only('id', 'user_agent')[:2000])
+            if not batch:
+                break
+            for visit in batch:
+                visit.agent_id = agent_id(visit.user_agent)
+                visit.user_agent = None
+            model.objects.bulk_update(batch, ['agent', 'user_agent'])
+            last_id = batch[-1].id
+
+
+def restore_user_agents(apps, schema_editor):
+    for model_name in ('PageVisit', 'PageVisitArchive'):
+        model = apps.get_model('analytics', model_name)
+        for agent in apps.get_model('analytics', 'UserAgent').objects.all():
+            model.objects.filter(agent=agent, user_agent__isnull=True).update(user_agent=agent.user_agent)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0009_pagevisit_indexes_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ua_hash', models.CharField(max_length=40, unique=True, verbose_name='雜湊值')),
+                ('user_agent', models.TextField(blank=True, verbose_name='User Agent')),
+                ('device_type', models.CharField(blank=True, max_length=50, verbose_name='裝置類型')),
+                ('browser', models.CharField(blank=True, max_length=100, verbose_name='瀏覽器')),
+                ('os', models.CharField(blank=True, max_length=100, verbose_name='作業系統')),
+            ],
+            options={
+                'verbose_name': 'User Agent',
+                'verbose_name_plural': 'User Agent',
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='pagevisit',
+            name='pagevisit_rollup_idx',
+        ),
+        migrations.AddField(
+            model_name='pagevisit',
+            name='agent',
+            field=models.ForeignKey(blank=True, null=True, db_index=False, on_delete=django.db.models.deletion.PROTECT, to='analytics.useragent', verbose_name='User Agent'),
+        ),
+        migrations.AddField(
+            model_name='pagevisitarchive',
+            name='agent',
+            field=models.ForeignKey(blank=True, null=True, db_index=False, on_delete=django.db.models.deletion.PROTECT, to='analytics.useragent', verbose_name='User Agent'),
+        ),
+        migrations.AddIndex(
+            model_name='pagevisit',
+            index=models.Index(fields=['timestamp', 'ip_address', 'agent', 'country'], name='pagevisit_rollup_idx'),
+        ),
+        migrations.RunPython(intern_user_agents, restore_user_agents),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.9 on 2026-10-17 18:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0010_useragent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailyvisitorrollup',
+            name='latest_path',
+            field=models.CharField(blank=True, max_length=255, verbose_name='最後瀏覽頁面'),
+        ),
+        migrations.AddField(
+            model_name='dailyvisitorrollup',
+            name='referer',
+            field=models.URLField(blank=True, null=True, verbose_name='來源'),
+        ),
+        migrations.AddField(
+            model_name='dailyvisitorrollup',
+            name='city',
+            field=models.CharField(blank=True, max_length=100, null=True, verbose_name='城市'),
+        ),
+        migrations.AddField(
+            model_name='dailyvisitorrollup',
+            name='agent',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='analytics.useragent', verbose_name='User Agent'),
+        ),
+        migrations.AddField(
+            model_name='dailyvisitorrollup',
+            name='country',
+            field=models.CharField(blank=True, max_length=100, null=True, verbose_name='國家'),
+        ),
+        migrations.AddField(
+            model_name='dailyvisitorrollup',
+            name='country_code',
+            field=models.CharField(blank=True, max_length=5, null=True, verbose_name='國家代碼'),
+        ),
+    ]
@@ -1,13 +1,33 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 
-class PageVisit(models.Model):
+class UserAgent(models.Model):
+    """One row per distinct User-Agent string, parsed once."""
+    ua_hash = models.CharField(max_length=40, unique=True, verbose_name="雜湊值") # SHA-1 of user_agent
+    user_agent = models.TextField(blank=True, verbose_name="User Agent")
+    device_type = models.CharField(max_length=50, blank=True, verbose_name="裝置類型")
+    browser = models.CharField(max_length=100, blank=True, verbose_name="瀏覽器")
+    os = models.CharField(max_length=100, blank=True, verbose_name="作業系統")
+
+    class Meta:
+        verbose_name = "User Agent"
+        verbose_name_plural = "User Agent"
+
+    def __str__(self):
+        return self.user_agent
+
+
+class BasePageVisit(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="使用者")
     path = models.CharField(max_length=255, verbose_name="路徑")
     ip_address = models.GenericIPAddressField(verbose_name="IP 地址")
+    # Only set on visits recorded before the UserAgent table existed
     user_agent = models.TextField(blank=True, null=True, verbose_name="User Agent")
+    # Not indexed on its own: visits are always looked up by time first
+    agent = models.ForeignKey(UserAgent, on_delete=models.PROTECT, null=True, blank=True, db_index=False, verbose_name="User Agent")
     referer = models.URLField(blank=True, null=True, verbose_name="來源")
-    timestamp = models.DateTimeField(auto_now_add=True, verbose_name="時間")
+    timestamp = models.DateTimeField(default=timezone.now, verbose_name="時間")
     
     # Simple location tracking (Country/City) - could be populated by GeoIP later
     country = models.CharField(max_length=100, blank=True, null=True, verbose_name="國家")
@@ -19,13 +39,95 @@ class PageVisit(models.Model):
     browser = models.CharField(max_length=100, blank=True, null=True, verbose_name="瀏覽器")
     os = models.CharField(max_length=100, blank=True, null=True, verbose_name="作業系統")
 
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return f"{self.path} - {self.timestamp}"
+
+
+class PageVisit(BasePageVisit):
     class Meta:
         ordering = ['-timestamp']
         verbose_name = "訪客紀錄"
         verbose_name_plural = "訪客紀錄"
+        indexes = [
+            # Latest visits per IP (visitor details) and per-IP rollups
+            models.Index(fields=['ip_address', 'timestamp'], name='pagevisit_ip_time_idx'),
+            # Time-range scans; also covers the per-day GROUP BYs of the
+            # rollups so they never have to read the table rows.
+            models.Index(
+                fields=['timestamp', 'ip_address', 'agent', 'country'],
+                name='pagevisit_rollup_idx',
+            ),
+        ]
+
+
+class PageVisitArchive(BasePageVisit):
+    """
+    Visits moved out of PageVisit by the `archive_visits` command, keyed by
+    the month they belong to so whole months can be dropped at once.
+    """
+    month = models.DateField(verbose_name="月份")
+
+    class Meta:
+        ordering = ['-timestamp']
+        verbose_name = "訪客紀錄封存"
+        verbose_name_plural = "訪客紀錄封存"
+        indexes = [
+            models.Index(fields=['month', 'timestamp'], name='pagevisitarchive_month_idx'),
+        ]
+
+
+class DailyVisitRollup(models.Model):
+    """Visits per local day, in total and per browser/device/OS/country."""
+    DIMENSION_CHOICES = [
+        ('total', "總數"),
+        ('browser', "瀏覽器"),
+        ('device_type', "裝置類型"),
+        ('os', "作業系統"),
+        ('country', "國家"),
+    ]
+
+    date = models.DateField(verbose_name="日期")
+    dimension = models.CharField(max_length=20, choices=DIMENSION_CHOICES, verbose_name="維度")
+    value = models.CharField(max_length=100, blank=True, verbose_name="值")
+    count = models.PositiveIntegerField(default=0, verbose_name="次數")
+
+    class Meta:
+        unique_together = ('date', 'dimension', 'value')
+        ordering = ['-date', 'dimension', '-count']
+        verbose_name = "每日訪問統計"
+        verbose_name_plural = "每日訪問統計"
 
     def __str__(self):
-        return f"{self.path} - {self.timestamp}"
+        return f"{self.date} {self.dimension}={self.value}: {self.count}"
+
+
+class DailyVisitorRollup(models.Model):
+    """Visits per IP address per local day."""
+    date = models.DateField(verbose_name="日期")
+    ip_address = models.GenericIPAddressField(verbose_name="IP 地址")
+    views = models.PositiveIntegerField(default=0, verbose_name="瀏覽次數")
+    last_view = models.DateTimeField(verbose_name="最後瀏覽")
+
+    # The day's latest visit, kept for the dashboard once the visits are pruned
+    latest_path = models.CharField(max_length=255, blank=True, verbose_name="最後瀏覽頁面")
+    referer = models.URLField(blank=True, null=True, verbose_name="來源")
+    city = models.CharField(max_length=100, blank=True, null=True, verbose_name="城市")
+    agent = models.ForeignKey(UserAgent, on_delete=models.SET_NULL, null=True, blank=True, db_index=False, verbose_name="User Agent")
+    # The day's latest known location
+    country = models.CharField(max_length=100, blank=True, null=True, verbose_name="國家")
+    country_code = models.CharField(max_length=5, blank=True, null=True, verbose_name="國家代碼")
+
+    class Meta:
+        unique_together = ('date', 'ip_address')
+        ordering = ['-date', '-views']
+        verbose_name = "每日訪客統計"
+        verbose_name_plural = "每日訪客統計"
+
+    def __str__(self):
+        return f"{self.date} {self.ip_address}: {self.views}"
 
 
 class FileIntegrity(models.Model):
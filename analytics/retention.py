@@ -0,0 +1,185 @@
+"""
+Moving old page visits out of the PageVisit table.
+
+PageVisit only needs the recent days the dashboard reads raw. Older visits
+that are already covered by the daily rollups are moved, month by month, into
+PageVisitArchive, and whole archived months can later be dropped. Rows are
+moved and deleted in bounded batches, each in its own short transaction, so
+the ingestion writer is never blocked for long.
+
+Visits can also be exported and removed for good: export_visits() writes each
+day of a table to a gzip'd NDJSON file (a header line with the column names,
+then one JSON array per visit) and then deletes the exported rows.
+"""
+import datetime
+import glob
+import gzip
+import json
+import os
+import re
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import PageVisit, PageVisitArchive
+from .rollups import ONE_DAY, day_start, get_watermark
+
+ARCHIVED_FIELDS = (
+    'id', 'user_id', 'path', 'ip_address', 'user_agent', 'agent_id', 'referer', 'timestamp',
+    'country', 'country_code', 'city', 'device_type', 'browser', 'os',
+)
+
+# Export files carry the User-Agent string itself rather than an id
+EXPORTED_FIELDS = tuple(field for field in ARCHIVED_FIELDS if field != 'agent_id')
+
+# Read from the UserAgent row, or from the visit's own columns for visits
+# recorded before the UserAgent table existed
+AGENT_FIELDS = ('user_agent', 'device_type', 'browser', 'os')
+
+_export_name_re = re.compile(r'(?P<first>\d+)-(?P<last>\d+)\.ndjson\.gz')
+
+
+def month_start(day, months_back=0):
+    """First day of the month `months_back` months before `day`'s month."""
+    index = day.year * 12 + day.month - 1 - months_back
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def archive_visits(before, batch_size=5000):
+    """
+    Move visits from before the local day `before` into PageVisitArchive.
+    Only days already in the rollup tables are moved, so the dashboard totals
+    do not change. Returns the number of visits moved.
+    """
+    watermark = get_watermark()
+    if watermark is None:
+        return 0
+    cutoff = day_start(min(before, watermark + ONE_DAY))
+
+    moved = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                PageVisit.objects.filter(timestamp__lt=cutoff)
+                .order_by('timestamp').values(*ARCHIVED_FIELDS)[:batch_size]
+            )
+            if not batch:
+                return moved
+            PageVisitArchive.objects.bulk_create(
+                PageVisitArchive(month=month_start(timezone.localdate(row['timestamp'])), **row)
+                for row in batch
+            )
+            PageVisit.objects.filter(id__in=[row['id'] for row in batch]).delete()
+        moved += len(batch)
+
+
+def archived_through():
+    """
+    The newest local day with visits in PageVisitArchive, or None. The raw
+    visits left for that day and the days before it may be incomplete (an
+    interrupted archive_visits() stops part way through a day).
+    """
+    latest = PageVisitArchive.objects.aggregate(latest=Max('timestamp'))['latest']
+    return timezone.localdate(latest) if latest else None
+
+
+def purge_archive(before_month, batch_size=5000):
+    """
+    Delete archived visits of the months before `before_month` (a date, the
+    first of a month). Returns the number of visits deleted.
+    """
+    deleted = 0
+    while True:
+        ids = list(
+            PageVisitArchive.objects.filter(month__lt=before_month)
+            .order_by().values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        deleted += PageVisitArchive.objects.filter(id__in=ids).delete()[0]
+
+
+def export_visits(model, before, directory, batch_size=5000):
+    """
+    Export the visits of `model` (PageVisit or PageVisitArchive) from before
+    the local day `before` into one file per day under `directory`, deleting
+    each day's rows once its file is written. Only rolled-up days are
+    exported. Returns [(path, number of visits)].
+    """
+    watermark = get_watermark()
+    first_visit = model.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+    if watermark is None or first_visit is None:
+        return []
+    before = min(before, watermark + ONE_DAY)
+
+    os.makedirs(directory, exist_ok=True)
+    exported = []
+    day = timezone.localdate(first_visit)
+    while day < before:
+        visits = model.objects.filter(timestamp__gte=day_start(day), timestamp__lt=day_start(day + ONE_DAY))
+        if model is PageVisitArchive:
+            visits = visits.filter(month=month_start(day))
+        visits = visits.order_by('id')
+
+        # Files are named after the first and last visit in them. Rows an
+        # interrupted run exported but did not delete are deleted now rather
+        # than exported again, and the rest go to a new file.
+        prefix = os.path.join(directory, f'{model._meta.model_name}-{day}-')
+        done_id = _exported_up_to(prefix)
+        if done_id is not None:
+            _delete_batches(visits.filter(id__lte=done_id), batch_size)
+        while True:
+            first_id = visits.values_list('id', flat=True).first()
+            if first_id is None:
+                break
+            tmp_path = f'{prefix}{first_id}.ndjson.gz.tmp'
+            last_id, count = _write_export(visits, tmp_path, batch_size)
+            path = f'{prefix}{first_id}-{last_id}.ndjson.gz'
+            os.replace(tmp_path, path)
+            _delete_batches(visits.filter(id__lte=last_id), batch_size)
+            exported.append((path, count))
+        day += ONE_DAY
+    return exported
+
+
+def _exported_up_to(prefix):
+    """The highest visit id in the export files starting with `prefix`, or None."""
+    last_ids = []
+    for path in glob.glob(f'{glob.escape(prefix)}*.ndjson.gz'):
+        match = _export_name_re.fullmatch(path[len(prefix):])
+        if match:
+            last_ids.append(int(match.group('last')))
+    return max(last_ids, default=None)
+
+
+def _write_export(visits, path, batch_size):
+    last_id, count = None, 0
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps({'columns': EXPORTED_FIELDS}) + '\n')
+        rows = visits.annotate(
+            **{f'agent_{field}': Coalesce(f'agent__{field}', field) for field in AGENT_FIELDS}
+        ).values_list(*[f'agent_{field}' if field in AGENT_FIELDS else field for field in EXPORTED_FIELDS])
+        for row in rows.iterator(chunk_size=batch_size):
+            f.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+            last_id = row[0]
+            count += 1
+    return last_id, count
+
+
+def _delete_batches(visits, batch_size):
+    while True:
+        ids = list(visits.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        visits.model.objects.filter(id__in=ids).delete()
+
+
+def read_export(path):
+    """Yield the visits of an exported file as dicts."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        columns = json.loads(f.readline())['columns']
+        for line in f:
+            yield dict(zip(columns, json.loads(line)))
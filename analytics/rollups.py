@@ -0,0 +1,374 @@
+"""
+Daily rollups of PageVisit for the ShopStatistics dashboard.
+
+Complete local days are aggregated into DailyVisitRollup (visits per
+dimension value) and DailyVisitorRollup (visits per IP). The newest rolled-up
+day is the watermark: VisitStats reads the rollup tables up to it and only
+scans the raw PageVisit table for the days after it, normally just today.
+DailyVisitorRollup also keeps each IP's latest visit of the day, so the
+visitor details on the dashboard outlive the pruned visits.
+
+Rollups are produced by the `rollup_visits` management command and, once a
+day, by the buffered ingestion writer (ANALYTICS_ROLLUP_ON_INGEST).
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, router, transaction
+from django.db.models import Case, Count, F, Max, Min, Q, Sum, Value, When, Window
+from django.db.models.functions import FirstValue, RowNumber, TruncDate
+from django.utils import timezone
+
+from .models import PageVisit, DailyVisitRollup, DailyVisitorRollup, UserAgent
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ('browser', 'device_type', 'os', 'country')
+
+# Dimensions read through the UserAgent table
+AGENT_DIMENSIONS = ('browser', 'device_type', 'os')
+
+# A day is only rolled up once this long has passed since midnight, so that
+# visits still sitting in an ingestion buffer at midnight are included.
+ROLLUP_GRACE = datetime.timedelta(minutes=10)
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def day_start(day):
+    """Aware datetime of local midnight at the start of `day`."""
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def get_watermark():
+    """The newest day covered by the rollup tables, or None."""
+    return DailyVisitRollup.objects.filter(dimension='total').aggregate(Max('date'))['date__max']
+
+
+def dimension_counts(visits, dimensions=DIMENSIONS):
+    """
+    {dimension: {value: count}} for a queryset of visits, with None values
+    counted as ''. The User-Agent dimensions are counted per agent id and
+    then looked up in the (small) UserAgent table.
+    """
+    counts = {dimension: {} for dimension in dimensions}
+
+    def add(dimension, value, count):
+        value = value or ''
+        counts[dimension][value] = counts[dimension].get(value, 0) + count
+
+    agent_dimensions = [d for d in dimensions if d in AGENT_DIMENSIONS]
+    if agent_dimensions:
+        per_agent = dict(visits.values_list('agent_id').annotate(count=Count('id')))
+        agents = UserAgent.objects.in_bulk([agent_id for agent_id in per_agent if agent_id is not None])
+        for agent_id, count in per_agent.items():
+            if agent_id is not None:
+                for dimension in agent_dimensions:
+                    add(dimension, getattr(agents[agent_id], dimension), count)
+        if None in per_agent:
+            # Visits recorded without a UserAgent row
+            legacy = visits.filter(agent__isnull=True)
+            for dimension in agent_dimensions:
+                for entry in legacy.values(dimension).annotate(count=Count('id')):
+                    add(dimension, entry[dimension], entry['count'])
+
+    for dimension in dimensions:
+        if dimension not in AGENT_DIMENSIONS:
+            for entry in visits.values(dimension).annotate(count=Count('id')):
+                add(dimension, entry[dimension], entry['count'])
+    return counts
+
+
+def _known(value):
+    return value not in (None, '', 'Unknown')
+
+
+def latest_visits(visits):
+    """
+    {ip_address: details} of the latest of `visits` per IP, using one
+    windowed pass: its path, referer, city, agent and browser/device, plus
+    the latest *known* country and country code.
+    """
+    by_ip = F('ip_address')
+    newest_first = F('timestamp').desc()
+    country_unknown = Case(When(Q(country__isnull=True) | Q(country='Unknown'), then=Value(1)), default=Value(0))
+    country_code_unknown = Case(When(Q(country_code__isnull=True) | Q(country_code=''), then=Value(1)), default=Value(0))
+
+    latest = (
+        visits
+        .annotate(
+            row=Window(RowNumber(), partition_by=by_ip, order_by=newest_first),
+            known_country=Window(FirstValue('country'), partition_by=by_ip, order_by=[country_unknown.asc(), newest_first]),
+            known_country_code=Window(FirstValue('country_code'), partition_by=by_ip, order_by=[country_code_unknown.asc(), newest_first]),
+        )
+        .filter(row=1)
+        .values(
+            'ip_address', 'path', 'known_country', 'known_country_code', 'city', 'referer', 'agent_id',
+            'agent__browser', 'agent__device_type', 'browser', 'device_type',
+        )
+    )
+    return {
+        entry['ip_address']: {
+            'path': entry['path'],
+            'referer': entry['referer'],
+            'city': entry['city'],
+            'agent_id': entry['agent_id'],
+            # Visits recorded before the UserAgent table carry their own strings
+            'browser': entry['agent__browser'] if entry['agent_id'] else entry['browser'],
+            'device_type': entry['agent__device_type'] if entry['agent_id'] else entry['device_type'],
+            'country': entry['known_country'],
+            'country_code': entry['known_country_code'],
+        }
+        for entry in latest
+    }
+
+
+def rollup_day(day):
+    """(Re)compute the rollup rows for one local day."""
+    visits = PageVisit.objects.filter(timestamp__gte=day_start(day), timestamp__lt=day_start(day + ONE_DAY)).order_by()
+
+    rows = [DailyVisitRollup(date=day, dimension='total', value='', count=visits.count())]
+    for dimension, counts in dimension_counts(visits).items():
+        rows.extend(
+            DailyVisitRollup(date=day, dimension=dimension, value=value, count=count)
+            for value, count in counts.items()
+        )
+
+    details = latest_visits(visits)
+    visitors = []
+    for entry in visits.values('ip_address').annotate(views=Count('id'), last_view=Max('timestamp')):
+        latest = details[entry['ip_address']]
+        visitors.append(DailyVisitorRollup(
+            date=day, ip_address=entry['ip_address'], views=entry['views'], last_view=entry['last_view'],
+            latest_path=latest['path'], referer=latest['referer'], city=latest['city'], agent_id=latest['agent_id'],
+            country=latest['country'], country_code=latest['country_code'],
+        ))
+
+    with transaction.atomic():
+        DailyVisitRollup.objects.filter(date=day).delete()
+        DailyVisitorRollup.objects.filter(date=day).delete()
+        DailyVisitRollup.objects.bulk_create(rows)
+        DailyVisitorRollup.objects.bulk_create(visitors)
+    return rows[0].count
+
+
+def rollup_pending(until=None, max_days=None):
+    """
+    Roll up every complete day after the watermark (or since the first
+    recorded visit) and before `until`, or only the first `max_days` of them.
+    Returns the days rolled up.
+    """
+    until = until or timezone.localdate(timezone.now() - ROLLUP_GRACE)
+    watermark = get_watermark()
+    if watermark is None:
+        first_visit = PageVisit.objects.aggregate(Min('timestamp'))['timestamp__min']
+        if first_visit is None:
+            return []
+        day = timezone.localdate(first_visit)
+    else:
+        day = watermark + ONE_DAY
+
+    rolled = []
+    while day < until and (max_days is None or len(rolled) < max_days):
+        rollup_day(day)
+        rolled.append(day)
+        day += ONE_DAY
+    return rolled
+
+
+_last_rollup = None
+
+
+def rollup_if_due():
+    """
+    Cheap post-ingest hook: roll up pending days at most once per day per
+    process, and only in one process at a time. Catching up on a backlog of
+    days takes one day per call, so the ingestion writer is never held up for
+    long.
+    """
+    global _last_rollup
+    due = timezone.localdate(timezone.now() - ROLLUP_GRACE)
+    if _last_rollup == due:
+        return
+    if not cache.add(f'analytics_rollup_{due}', 1, 60 * 60):
+        # Another process is on it; look again after the next batch
+        return
+    try:
+        rolled = rollup_pending(due, max_days=1)
+    except Exception:
+        logger.exception("Failed to roll up page visits")
+        cache.delete(f'analytics_rollup_{due}')
+    else:
+        if rolled and rolled[-1] + ONE_DAY < due:
+            # More days to go; the next batch carries on
+            cache.delete(f'analytics_rollup_{due}')
+        else:
+            _last_rollup = due
+
+
+def _to_datetime(value):
+    """A timestamp read with a plain cursor, which skips the field converters (SQLite returns text)."""
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, datetime.timezone.utc)
+    return value
+
+
+class VisitStats:
+    """
+    Visit aggregates for the local days `start_date`..`end_date` (inclusive;
+    None means unbounded), served from the rollup tables up to the watermark
+    and from PageVisit after it.
+    """
+
+    def __init__(self, start_date=None, end_date=None):
+        self.start_date = start_date
+        self.end_date = end_date or timezone.localdate()
+        self.watermark = get_watermark()
+
+        if self.watermark is None:
+            self.raw_start = start_date
+        elif start_date is None:
+            self.raw_start = self.watermark + ONE_DAY
+        else:
+            self.raw_start = max(start_date, self.watermark + ONE_DAY)
+
+    def _rollups(self, model):
+        if self.watermark is None or (self.start_date and self.start_date > self.watermark):
+            return model.objects.none()
+        qs = model.objects.filter(date__lte=min(self.end_date, self.watermark)).order_by()
+        if self.start_date:
+            qs = qs.filter(date__gte=self.start_date)
+        return qs
+
+    def _period(self):
+        qs = PageVisit.objects.filter(timestamp__lt=day_start(self.end_date + ONE_DAY)).order_by()
+        if self.start_date:
+            qs = qs.filter(timestamp__gte=day_start(self.start_date))
+        return qs
+
+    def _raw(self):
+        if self.raw_start and self.raw_start > self.end_date:
+            return PageVisit.objects.none()
+        qs = PageVisit.objects.filter(timestamp__lt=day_start(self.end_date + ONE_DAY)).order_by()
+        if self.raw_start:
+            qs = qs.filter(timestamp__gte=day_start(self.raw_start))
+        return qs
+
+    def total(self):
+        rolled = self._rollups(DailyVisitRollup).filter(dimension='total').aggregate(total=Sum('count'))['total'] or 0
+        return rolled + self._raw().count()
+
+    def daily(self):
+        """[{'date': ..., 'count': ...}] for each day with visits, oldest first."""
+        counts = {}
+        for entry in self._rollups(DailyVisitRollup).filter(dimension='total', count__gt=0).values('date', 'count'):
+            counts[entry['date']] = entry['count']
+        raw = self._raw().annotate(date=TruncDate('timestamp')).values('date').annotate(count=Count('id'))
+        for entry in raw:
+            counts[entry['date']] = counts.get(entry['date'], 0) + entry['count']
+        return [{'date': date, 'count': counts[date]} for date in sorted(counts)]
+
+    def by_dimension(self, dimension):
+        """[{dimension: value, 'count': ...}] ordered by count, like a GROUP BY."""
+        counts = {}
+        rolled = (
+            self._rollups(DailyVisitRollup).filter(dimension=dimension)
+            .values('value').annotate(count=Sum('count'))
+        )
+        for entry in rolled:
+            value = entry['value'] or None
+            counts[value] = counts.get(value, 0) + entry['count']
+        for value, count in dimension_counts(self._raw(), [dimension])[dimension].items():
+            counts[value or None] = counts.get(value or None, 0) + count
+        return [
+            {dimension: value, 'count': count}
+            for value, count in sorted(counts.items(), key=lambda item: -item[1])
+        ]
+
+    def top_visitors(self, limit=20):
+        """
+        [{'ip_address', 'views', 'last_view'}] for the busiest IPs. The
+        rollup and raw per-IP counts are combined, summed, ordered and cut to
+        `limit` in one query, so only `limit` rows reach Python.
+        """
+        sources = [
+            self._rollups(DailyVisitorRollup).values('ip_address').annotate(views=Sum('views'), last_view=Max('last_view')),
+            self._raw().values('ip_address').annotate(views=Count('id'), last_view=Max('timestamp')),
+        ]
+        # The database the ORM queries here read from (the replica in reporting())
+        using = router.db_for_read(PageVisit)
+        parts, params = [], []
+        for source in sources:
+            if source.query.is_empty():
+                continue
+            query = source.values_list('ip_address', 'views', 'last_view').query
+            sql, source_params = query.get_compiler(using=using).as_sql()
+            parts.append(sql)
+            params.extend(source_params)
+        if not parts:
+            return []
+
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f"SELECT ip_address, SUM(views) AS views, MAX(last_view) AS last_view "
+                f"FROM ({' UNION ALL '.join(parts)}) visitors "
+                f"GROUP BY ip_address ORDER BY views DESC, last_view DESC LIMIT %s",
+                [*params, limit],
+            )
+            rows = cursor.fetchall()
+        return [
+            {'ip_address': ip_address, 'views': views, 'last_view': _to_datetime(last_view)}
+            for ip_address, views, last_view in rows
+        ]
+
+    def add_latest_details(self, visitors):
+        """
+        Fill in each visitor's latest page, referer, city, browser and device
+        within the period, plus the latest *known* country and country code.
+        They come from the raw visits still in PageVisit and, for days that
+        have been pruned or archived, from the visitor rollups.
+        """
+        if not visitors:
+            return visitors
+
+        ips = [v['ip_address'] for v in visitors]
+        details = latest_visits(self._period().filter(ip_address__in=ips))
+
+        rolled = (
+            self._rollups(DailyVisitorRollup).filter(ip_address__in=ips).order_by('-last_view')
+            .values('ip_address', 'latest_path', 'referer', 'city', 'country', 'country_code',
+                    'agent__browser', 'agent__device_type')
+        )
+        for entry in rolled:
+            current = details.get(entry['ip_address'])
+            if current is None:
+                # No raw visits left: the newest rollup row has the latest visit
+                details[entry['ip_address']] = {
+                    'path': entry['latest_path'] or None,
+                    'referer': entry['referer'],
+                    'city': entry['city'],
+                    'browser': entry['agent__browser'],
+                    'device_type': entry['agent__device_type'],
+                    'country': entry['country'],
+                    'country_code': entry['country_code'],
+                }
+                continue
+            if not _known(current['country']) and _known(entry['country']):
+                current['country'] = entry['country']
+            if not _known(current['country_code']) and _known(entry['country_code']):
+                current['country_code'] = entry['country_code']
+
+        for v in visitors:
+            entry = details.get(v['ip_address'], {})
+            v['latest_page'] = entry.get('path')
+            v['country'] = entry.get('country')
+            v['country_code'] = entry.get('country_code')
+            v['city'] = entry.get('city')
+            v['referer'] = entry.get('referer')
+            v['browser'] = entry.get('browser')
+            v['device_type'] = entry.get('device_type')
+        return visitors
@@ -1,3 +1,543 @@
-from django.test import TestCase
+import datetime
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import ingest, rollups
+from .geoip import RangeIndexResolver, build_index
+from .ingest import VisitBuffer, get_user_agent_id, save_visits, user_agent_hash
+from .models import PageVisit, PageVisitArchive, UserAgent
+from .retention import ARCHIVED_FIELDS, archive_visits, export_visits, month_start, purge_archive, read_export
+from .middleware import WAFMiddleware
+from .waf import DEFAULT_RULES, Rule, RuleSet
+from .rollups import VisitStats, day_start, rollup_if_due, rollup_pending
+
+
+def visit(i):
+    return {'path': f'/page-{i}/', 'ip_address': '10.0.0.1', 'user_agent': 'Mozilla/5.0', 'timestamp': None}
+
+
+@override_settings(ANALYTICS_ROLLUP_ON_INGEST=False)
+class VisitBufferTests(SimpleTestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.written = threading.Event()
+
+        def save_visits(batch):
+            self.batches.append([v['path'] for v in batch])
+            self.written.set()
+
+        patcher = mock.patch('analytics.ingest.save_visits', side_effect=save_visits)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_flush_on_batch_size(self):
+        buffer = VisitBuffer(batch_size=3, flush_interval=60)
+        self.addCleanup(buffer.stop)
+        for i in range(3):
+            buffer.submit(visit(i))
+        # Long before the 60s window closes
+        self.assertTrue(self.written.wait(5))
+        self.assertEqual(self.batches, [['/page-0/', '/page-1/', '/page-2/']])
+
+    def test_flush_on_interval(self):
+        buffer = VisitBuffer(batch_size=100, flush_interval=0.2)
+        self.addCleanup(buffer.stop)
+        started = time.monotonic()
+        buffer.submit(visit(0))
+        buffer.submit(visit(1))
+        self.assertTrue(self.written.wait(5))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(self.batches, [['/page-0/', '/page-1/']])
+
+    def test_drop_when_full_and_flush_on_stop(self):
+        buffer = VisitBuffer(batch_size=100, flush_interval=60, max_size=2)
+        # No writer thread, so the queue fills up
+        buffer.start = lambda: None
+        self.assertTrue(buffer.submit(visit(0)))
+        self.assertTrue(buffer.submit(visit(1)))
+        self.assertFalse(buffer.submit(visit(2)))
+        with self.assertLogs('analytics.ingest', 'WARNING') as logs:
+            buffer.stop()
+        self.assertEqual(self.batches, [['/page-0/', '/page-1/']])
+        stats = buffer.get_stats()
+        self.assertEqual((stats['submitted'], stats['dropped'], stats['written']), (2, 1, 2))
+        self.assertIn('dropped 1', logs.output[0])
+
+    def test_failed_batches_counted(self):
+        buffer = VisitBuffer(batch_size=100, flush_interval=60)
+        buffer.start = lambda: None
+        buffer.submit(visit(0))
+        with mock.patch('analytics.ingest.save_visits', side_effect=RuntimeError), \
+                self.assertLogs('analytics.ingest', 'WARNING') as logs:
+            buffer.stop()
+        self.assertEqual(buffer.get_stats()['failed'], 1)
+        self.assertIn('failed 1', logs.output[-1])
+
+
+@mock.patch('analytics.ingest.geoip.resolve', return_value=('Unknown', 'Unknown', ''))
+class UserAgentCacheTests(TransactionTestCase):
+
+    def setUp(self):
+        ingest._agent_ids.clear()
+        self.addCleanup(ingest._agent_ids.clear)
+
+    def test_cached_once_committed(self, resolve):
+        with transaction.atomic():
+            agent_id = get_user_agent_id('Mozilla/5.0 Firefox/121.0')
+            self.assertEqual(ingest._agent_ids, {})
+        self.assertEqual(list(ingest._agent_ids.values()), [agent_id])
+        with transaction.atomic():
+            get_user_agent_id('Mozilla/5.0 Chrome/120.0 Safari/537.36')
+            transaction.set_rollback(True)
+        self.assertEqual(list(ingest._agent_ids.values()), [agent_id])
+
+    def test_stale_id_is_looked_up_again(self, resolve):
+        ingest._agent_ids[user_agent_hash('Mozilla/5.0 Firefox/121.0')] = 12345
+        raw = {**visit(0), 'user_agent': 'Mozilla/5.0 Firefox/121.0', 'timestamp': timezone.now()}
+        with self.assertLogs('analytics.ingest', 'WARNING'):
+            save_visits([raw])
+        saved = PageVisit.objects.get()
+        self.assertEqual((saved.agent.browser, saved.browser), ('Firefox', None))
+
+
+class RangeIndexTests(SimpleTestCase):
+
+    def build(self, rows):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'geo.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('network,country_code,country,city\n')
+            f.writelines(f'{row}\n' for row in rows)
+        index_path, count = build_index(path)
+        # Only the index is left behind, no temporary files
+        self.assertEqual(sorted(os.listdir(directory)), ['geo.csv', 'geo.csv.idx'])
+        return RangeIndexResolver(index_path), count
+
+    def test_lookup(self):
+        resolver, count = self.build([
+            '1.2.3.0/24,AU,Australia,Sydney',
+            '2001:db8::/32,JP,Japan,Tokyo',
+        ])
+        self.assertEqual(count, 2)
+        self.assertEqual(resolver.lookup('1.2.3.4'), ('Australia', 'Sydney', 'AU'))
+        self.assertEqual(resolver.lookup('::ffff:1.2.3.200'), ('Australia', 'Sydney', 'AU'))
+        self.assertEqual(resolver.lookup('2001:db8:1::5'), ('Japan', 'Tokyo', 'JP'))
+        self.assertIsNone(resolver.lookup('1.2.4.0'))
+        self.assertIsNone(resolver.lookup('2001:db9::1'))
+        self.assertIsNone(resolver.lookup('not an address'))
+
+    def test_nested_ranges(self):
+        resolver, count = self.build([
+            '10.0.0.0/8,HK,Hong Kong,',
+            '10.0.1.0/24,TW,Taiwan,Taipei',
+            '10.0.1.128/25,JP,Japan,Osaka',
+            '10.200.0.0/16,HK,Hong Kong,',
+        ])
+        self.assertEqual(resolver.lookup('10.0.0.255'), ('Hong Kong', 'Unknown', 'HK'))
+        self.assertEqual(resolver.lookup('10.0.1.5'), ('Taiwan', 'Taipei', 'TW'))
+        self.assertEqual(resolver.lookup('10.0.1.200'), ('Japan', 'Osaka', 'JP'))
+        self.assertEqual(resolver.lookup('10.0.2.5'), ('Hong Kong', 'Unknown', 'HK'))
+        self.assertEqual(resolver.lookup('10.255.255.255'), ('Hong Kong', 'Unknown', 'HK'))
+        self.assertIsNone(resolver.lookup('11.0.0.0'))
+        # /8 split around the /24 (itself split around the /25); the /16
+        # inside the /8 with the same label merges into it
+        self.assertEqual(count, 4)
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class VisitStatsTests(TestCase):
+
+    def add_visits(self, day, ip_address, count, hour=12):
+        PageVisit.objects.bulk_create(
+            PageVisit(path='/', ip_address=ip_address, timestamp=day_start(day) + datetime.timedelta(hours=hour, minutes=i))
+            for i in range(count)
+        )
+
+    def test_top_visitors_across_rollups_and_raw(self):
+        today = timezone.localdate()
+        earlier = today - datetime.timedelta(days=3)
+        self.add_visits(earlier, '10.0.0.1', 3)
+        self.add_visits(earlier, '10.0.0.2', 4)
+        self.add_visits(earlier, '10.0.0.3', 1)
+        self.assertEqual(rollup_pending(today), [earlier + datetime.timedelta(days=i) for i in range(3)])
+        # Not rolled up yet
+        self.add_visits(today, '10.0.0.1', 2, hour=0)
+        self.add_visits(today, '10.0.0.4', 1, hour=0)
+
+        visitors = VisitStats(earlier, today).top_visitors(3)
+        self.assertEqual(
+            [(v['ip_address'], v['views']) for v in visitors],
+            [('10.0.0.1', 5), ('10.0.0.2', 4), ('10.0.0.4', 1)],
+        )
+        self.assertEqual(visitors[0]['last_view'], day_start(today) + datetime.timedelta(minutes=1))
+        self.assertEqual(visitors[1]['last_view'], day_start(earlier) + datetime.timedelta(hours=12, minutes=3))
+
+        # Only the rollups, only the raw visits, nothing
+        self.assertEqual(len(VisitStats(earlier, earlier).top_visitors()), 3)
+        self.assertEqual([v['views'] for v in VisitStats(today, today).top_visitors()], [2, 1])
+        self.assertEqual(VisitStats(today + datetime.timedelta(days=1), today + datetime.timedelta(days=2)).top_visitors(), [])
+
+    def test_top_visitors_reads_through_the_router(self):
+        self.add_visits(timezone.localdate(), '10.0.0.1', 2, hour=0)
+        with mock.patch('analytics.rollups.router.db_for_read', return_value='default') as db_for_read:
+            self.assertEqual(len(VisitStats().top_visitors()), 1)
+        db_for_read.assert_called_with(PageVisit)
+
+    def test_latest_details_after_pruning(self):
+        today = timezone.localdate()
+        earlier = today - datetime.timedelta(days=2)
+        agent = UserAgent.objects.create(ua_hash='a' * 40, user_agent='Firefox', browser='Firefox', device_type='Desktop')
+        start = day_start(earlier)
+        PageVisit.objects.bulk_create([
+            PageVisit(path='/a/', ip_address='10.0.0.1', timestamp=start + datetime.timedelta(hours=1),
+                      country='Taiwan', country_code='TW', city='Taipei'),
+            PageVisit(path='/b/', ip_address='10.0.0.1', timestamp=start + datetime.timedelta(hours=2),
+                      country='Unknown', agent=agent, referer='https://example.com/'),
+            PageVisit(path='/c/', ip_address='10.0.0.2', timestamp=start + datetime.timedelta(hours=3)),
+        ])
+        rollup_pending(today)
+        # Pruned; only today's visit of 10.0.0.2 is left, with no country
+        PageVisit.objects.all().delete()
+        PageVisit.objects.create(path='/d/', ip_address='10.0.0.2', timestamp=day_start(today))
+
+        stats = VisitStats(earlier, today)
+        visitors = {v['ip_address']: v for v in stats.add_latest_details(stats.top_visitors())}
+        first = visitors['10.0.0.1']
+        self.assertEqual(
+            (first['latest_page'], first['country'], first['country_code'], first['referer'], first['browser']),
+            ('/b/', 'Taiwan', 'TW', 'https://example.com/', 'Firefox'),
+        )
+        self.assertEqual(visitors['10.0.0.2']['latest_page'], '/d/')
+
+    def test_rollup_if_due_retries_after_failure(self):
+        self.addCleanup(setattr, rollups, '_last_rollup', None)
+        rollups._last_rollup = None
+        with mock.patch('analytics.rollups.rollup_pending', side_effect=RuntimeError) as failing, \
+                self.assertLogs('analytics.rollups', 'ERROR'):
+            rollup_if_due()
+        failing.assert_called_once()
+        with mock.patch('analytics.rollups.rollup_pending', return_value=[]) as pending:
+            rollup_if_due()
+            rollup_if_due()
+        # Tried again after the failure, then not again the same day
+        pending.assert_called_once()
+
+    def test_rollup_if_due_catches_up_one_day_at_a_time(self):
+        self.addCleanup(setattr, rollups, '_last_rollup', None)
+        # The per-day claim left in the cache
+        self.addCleanup(rollups.cache.clear)
+        rollups._last_rollup = None
+        today = timezone.localdate()
+        first = today - datetime.timedelta(days=3)
+        for i in range(3):
+            self.add_visits(first + datetime.timedelta(days=i), '10.0.0.1', 1)
+        for expected in (first, first + datetime.timedelta(days=1), first + datetime.timedelta(days=2)):
+            rollup_if_due()
+            self.assertEqual(rollups.get_watermark(), expected)
+        with mock.patch('analytics.rollups.rollup_day') as rollup_day:
+            rollup_if_due()
+        rollup_day.assert_not_called()
+
+
+class RuleSetTests(SimpleTestCase):
+    VALUES = [
+        'Some ordinary form value', '', 'Über straße ſelect', '/products/shampoo/',
+        "1' UNION SELECT password FROM auth_user --", "1' uNiOn\tsElEcT 1", 'unıon select',
+        'DROP TABLE store_product', 'delete  from x', 'update users set admin=1', 'INSERT INTO t',
+        'exec(', 'EXEC (', '<SCRIPT>alert(1)</script>', 'JavaScript:alert(1)', 'onload =x', 'x onerror=y',
+        '../../etc/passwd', '..\\windows', 'union', 'select', '..', 'onload', 'javascript',
+        'bad', 'abad', 'xbad', 'wicked', 'EVIL', 'ac', 'abbc', 'abbbc', 'aab', 'b',
+    ]
+
+    def assertSameAsLoop(self, rules):
+        rule_set = RuleSet(rules)
+        for value in self.VALUES:
+            expected = [rule for rule in rules if re.search(rule.pattern, value, re.IGNORECASE)]
+            matched = rule_set.match(value)
+            with self.subTest(value=value):
+                if expected:
+                    self.assertIn(matched, expected)
+                else:
+                    self.assertIsNone(matched)
+
+    def test_default_rules(self):
+        self.assertIsNotNone(RuleSet().prefixes)
+        self.assertSameAsLoop(DEFAULT_RULES)
+
+    def test_rules_without_a_fixed_start(self):
+        for pattern in (r'a?bad', r'evil|wicked', r'x*bad', r'ab{0,2}c', r'(?:ev|wick)il'):
+            with self.subTest(pattern=pattern):
+                self.assertSameAsLoop(DEFAULT_RULES + [Rule('edge', 'test', pattern)])
+        self.assertIsNone(RuleSet(DEFAULT_RULES + [Rule('edge', 'test', r'a?bad')]).prefixes)
+        self.assertEqual(RuleSet([Rule('edge', 'test', r'a+b')]).prefixes, ('a',))
+        self.assertEqual(RuleSet([Rule('edge', 'test', r'ab{0,2}c')]).prefixes, ('a',))
+
+
+class WAFMiddlewareTests(SimpleTestCase):
+
+    def post_webhook(self):
+        payload = '{"type": "charge.succeeded", "data": {"description": "Please update your billing address in settings"}}'
+        return RequestFactory().post('/webhook/stripe/', payload, content_type='application/json',
+                                     HTTP_USER_AGENT='Stripe/1.0 (+https://stripe.com/docs/webhooks)')
+
+    def test_json_body_not_inspected_by_default(self):
+        self.assertFalse(WAFMiddleware(lambda request: None).check_request(self.post_webhook()))
+
+    @override_settings(WAF_INSPECT_JSON=True)
+    def test_json_body_inspected_when_enabled(self):
+        self.assertTrue(WAFMiddleware(lambda request: None).check_request(self.post_webhook()))
+
+    def test_form_values_inspected(self):
+        request = RequestFactory().post('/search/', {'q': "1' UNION SELECT password FROM auth_user"})
+        self.assertTrue(WAFMiddleware(lambda request: None).check_request(request))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ExportVisitsTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.today = timezone.localdate()
+
+    def days_ago(self, days):
+        return self.today - datetime.timedelta(days=days)
+
+    def add_visits(self, day, count, **fields):
+        PageVisit.objects.bulk_create(
+            PageVisit(path=f'/page-{i}/', ip_address='10.0.0.1', timestamp=day_start(day) + datetime.timedelta(minutes=i), **fields)
+            for i in range(count)
+        )
+
+    def read(self, path):
+        return list(read_export(path))
+
+    def test_only_rolled_up_days(self):
+        for days in (5, 4, 3):
+            self.add_visits(self.days_ago(days), 2)
+        # Rolls up the days before three days ago
+        rollup_pending(self.days_ago(3))
+
+        exported = export_visits(PageVisit, self.days_ago(4), self.directory)
+        self.assertEqual([count for path, count in exported], [2])
+        self.assertIn(f'pagevisit-{self.days_ago(5)}-', exported[0][0])
+
+        exported = export_visits(PageVisit, self.today, self.directory)
+        self.assertEqual([count for path, count in exported], [2])
+        self.assertIn(f'pagevisit-{self.days_ago(4)}-', exported[0][0])
+        # Past the watermark
+        self.assertEqual(
+            [timezone.localdate(t) for t in PageVisit.objects.values_list('timestamp', flat=True)],
+            [self.days_ago(3)] * 2,
+        )
+
+    def test_round_trip(self):
+        day = self.days_ago(2)
+        user = User.objects.create_user('visitor')
+        agent = UserAgent.objects.create(ua_hash='a' * 40, user_agent='Mozilla/5.0 Firefox', browser='Firefox',
+                                         device_type='Desktop', os='Linux')
+        PageVisit.objects.create(path='/a/', ip_address='10.0.0.1', timestamp=day_start(day), user=user, agent=agent,
+                                 referer='https://example.com/', country='Taiwan', country_code='TW', city='Taipei')
+        # Recorded before the UserAgent table existed
+        PageVisit.objects.create(path='/b/', ip_address='10.0.0.2', timestamp=day_start(day) + datetime.timedelta(hours=1),
+                                 user_agent='Legacy/1.0', browser='Legacy', device_type='Mobile', os='Other')
+        rollup_pending(self.today)
+
+        [(path, count)] = export_visits(PageVisit, self.today, self.directory)
+        self.assertTrue(path.endswith('.ndjson.gz'))
+        first, second = self.read(path)
+        self.assertEqual(first['user_id'], user.pk)
+        self.assertEqual(
+            (first['user_agent'], first['browser'], first['device_type'], first['os']),
+            ('Mozilla/5.0 Firefox', 'Firefox', 'Desktop', 'Linux'),
+        )
+        self.assertEqual(
+            (first['path'], first['referer'], first['country_code'], first['city']),
+            ('/a/', 'https://example.com/', 'TW', 'Taipei'),
+        )
+        self.assertEqual(datetime.datetime.fromisoformat(first['timestamp']), day_start(day))
+        self.assertEqual(
+            (second['user_id'], second['user_agent'], second['browser'], second['device_type'], second['os']),
+            (None, 'Legacy/1.0', 'Legacy', 'Mobile', 'Other'),
+        )
+        self.assertFalse(PageVisit.objects.exists())
+
+    def test_deletes_in_batches(self):
+        self.add_visits(self.days_ago(2), 5)
+        rollup_pending(self.today)
+        with CaptureQueriesContext(connection) as queries:
+            [(path, count)] = export_visits(PageVisit, self.today, self.directory, batch_size=2)
+        deletes = [q for q in queries if q['sql'].startswith('DELETE FROM "analytics_pagevisit"')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(count, 5)
+        self.assertFalse(PageVisit.objects.exists())
+
+    def test_rerun_after_interrupted_delete(self):
+        day = self.days_ago(2)
+        self.add_visits(day, 5)
+        rollup_pending(self.today)
+        ids = list(PageVisit.objects.order_by('id').values_list('id', flat=True))
+
+
+        def interrupted(visits, batch_size):
+            # One batch gets through
+            PageVisit.objects.filter(id__in=ids[:2]).delete()
+            raise KeyboardInterrupt
+
+        with mock.patch('analytics.retention._delete_batches', side_effect=interrupted), \
+                self.assertRaises(KeyboardInterrupt):
+            export_visits(PageVisit, self.today, self.directory, batch_size=2)
+        [first_path] = os.listdir(self.directory)
+        first_path = os.path.join(self.directory, first_path)
+        with open(first_path, 'rb') as f:
+            first_file = f.read()
+        self.assertEqual([v['id'] for v in self.read(first_path)], ids)
+
+        # The rest of the exported rows are deleted, not exported again
+        self.assertEqual(export_visits(PageVisit, self.today, self.directory, batch_size=2), [])
+        self.assertFalse(PageVisit.objects.exists())
+
+        # Visits added to the day later go to a new file
+        self.add_visits(day, 2)
+        [(path, count)] = export_visits(PageVisit, self.today, self.directory)
+        self.assertNotEqual(path, first_path)
+        self.assertEqual(count, 2)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        with open(first_path, 'rb') as f:
+            self.assertEqual(f.read(), first_file)
+        self.assertTrue(set(v['id'] for v in self.read(path)).isdisjoint(ids))
+
+    def test_prune_command(self):
+        self.add_visits(self.days_ago(10), 3)
+        self.add_visits(self.days_ago(2), 1)
+        out = StringIO()
+        call_command('prune_visits', days=5, output=self.directory, stdout=out)
+        self.assertIn('PageVisit: exported and deleted 3 visit(s)', out.getvalue())
+        self.assertEqual(PageVisit.objects.count(), 1)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_prune_every(self):
+        from .management.commands import prune_visits
+
+        class Stop(Exception):
+            pass
+
+        with mock.patch.object(prune_visits.Command, 'prune') as prune, \
+                mock.patch.object(prune_visits.time, 'sleep', side_effect=[None, Stop]) as sleep, \
+                self.assertRaises(Stop):
+            call_command('prune_visits', output=self.directory, every=1.5)
+        self.assertEqual(prune.call_count, 2)
+        self.assertEqual(sleep.call_args_list, [mock.call(5400.0)] * 2)
+
+        with mock.patch.object(prune_visits.Command, 'prune') as prune, \
+                mock.patch.object(prune_visits.time, 'sleep') as sleep:
+            call_command('prune_visits', output=self.directory)
+        prune.assert_called_once()
+        sleep.assert_not_called()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ArchiveVisitsTests(TestCase):
+
+    def setUp(self):
+        self.today = timezone.localdate()
+
+    def add_visit(self, day, **fields):
+        return PageVisit.objects.create(path='/', ip_address='10.0.0.1', timestamp=day_start(day), **fields)
+
+    def test_moves_rolled_up_months(self):
+        old = month_start(self.today, 2) + datetime.timedelta(days=3)
+        last_month = month_start(self.today, 1)
+        kept = self.add_visit(self.today)
+        first = self.add_visit(old, country='Taiwan')
+        second = self.add_visit(last_month)
+        rollup_pending(self.today)
+
+        self.assertEqual(archive_visits(month_start(self.today), batch_size=1), 2)
+        self.assertEqual(list(PageVisit.objects.values_list('id', flat=True)), [kept.pk])
+        self.assertEqual(
+            list(PageVisitArchive.objects.order_by('id').values_list('id', 'month', 'country')),
+            [(first.pk, month_start(old), 'Taiwan'), (second.pk, last_month, None)],
+        )
+        # Nothing left to move
+        self.assertEqual(archive_visits(month_start(self.today)), 0)
+        self.assertEqual(PageVisitArchive.objects.count(), 2)
+
+    def test_stops_at_watermark(self):
+        day = month_start(self.today, 1)
+        for i in range(3):
+            self.add_visit(day + datetime.timedelta(days=i))
+        # Nothing rolled up, nothing moved
+        self.assertEqual(archive_visits(self.today), 0)
+
+        rollup_pending(day + datetime.timedelta(days=1))
+        self.assertEqual(archive_visits(self.today), 1)
+        self.assertEqual(
+            sorted(timezone.localdate(t) for t in PageVisit.objects.values_list('timestamp', flat=True)),
+            [day + datetime.timedelta(days=1), day + datetime.timedelta(days=2)],
+        )
+
+    def test_rebuild_keeps_archived_days(self):
+        day = self.today - datetime.timedelta(days=3)
+        first = self.add_visit(day)
+        self.add_visit(day)
+        self.add_visit(day + datetime.timedelta(days=1))
+        rollup_pending(self.today)
+        # As left by an interrupted archive_visits()
+        PageVisitArchive.objects.create(month=month_start(day), **PageVisit.objects.filter(pk=first.pk).values(*ARCHIVED_FIELDS).get())
+        first.delete()
+
+        out = StringIO()
+        call_command('rollup_visits', rebuild=True, stdout=out)
+        self.assertIn(f'Visits up to {day} are archived', out.getvalue())
+        self.assertEqual(VisitStats(day, day).total(), 2)
+        self.assertEqual(VisitStats(day + datetime.timedelta(days=1), self.today).total(), 1)
+
+    def test_purge(self):
+        months = [month_start(self.today, n) for n in (3, 2, 1)]
+        PageVisitArchive.objects.bulk_create(
+            PageVisitArchive(path='/', ip_address='10.0.0.1', timestamp=day_start(month), month=month)
+            for month in months for i in range(3)
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(purge_archive(months[2], batch_size=2), 6)
+        deletes = [q for q in queries if q['sql'].startswith('DELETE FROM "analytics_pagevisitarchive"')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(list(PageVisitArchive.objects.values_list('month', flat=True).distinct()), [months[2]])
+        self.assertEqual(purge_archive(months[2]), 0)
+        self.assertEqual(PageVisitArchive.objects.count(), 3)
+
+    def test_command(self):
+        self.add_visit(month_start(self.today, 3))
+        self.add_visit(month_start(self.today, 1))
+        out = StringIO()
+        call_command('archive_visits', keep_months=2, purge_months=2, stdout=out)
+        self.assertIn('Archived 1 visit(s)', out.getvalue())
+        self.assertIn('Deleted 1 archived visit(s)', out.getvalue())
+        self.assertEqual(PageVisit.objects.count(), 1)
+        self.assertFalse(PageVisitArchive.objects.exists())
+
+        # A second run finds nothing to do
+        out = StringIO()
+        call_command('archive_visits', keep_months=2, purge_months=2, stdout=out)
+        self.assertIn('Archived 0 visit(s)', out.getvalue())
+        self.assertIn('Deleted 0 archived visit(s)', out.getvalue())
+        self.assertEqual(PageVisit.objects.count(), 1)
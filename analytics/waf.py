@@ -0,0 +1,195 @@
+"""
+Request inspection rules for WAFMiddleware.
+
+All rules are compiled once into a single regular expression, one named
+group per rule, so each inspected value is scanned once whatever the number
+of rules; the group that matched tells which rule fired. Hits are counted per
+rule id.
+
+Even so, trying the alternation at every position of the value costs a few
+microseconds per value, and almost every value is clean. When every rule
+starts with some fixed text (its literal prefix), a value is only searched
+if it contains one of those prefixes, which plain substring checks rule out
+much faster. Non-ASCII values are always searched.
+"""
+import json
+import logging
+import re
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+Rule = namedtuple('Rule', ['id', 'category', 'pattern'])
+
+DEFAULT_RULES = [
+    Rule('sqli-union-select', 'sql_injection', r"union\s+select"),
+    Rule('sqli-drop-table', 'sql_injection', r"drop\s+table"),
+    Rule('sqli-delete-from', 'sql_injection', r"delete\s+from"),
+    Rule('sqli-update-set', 'sql_injection', r"update\s+.*set"),
+    Rule('sqli-insert-into', 'sql_injection', r"insert\s+into"),
+    Rule('sqli-exec', 'sql_injection', r"exec\s*\("),
+    Rule('xss-script-tag', 'xss', r"<script>"),
+    Rule('xss-javascript-uri', 'xss', r"javascript:"),
+    Rule('xss-onload', 'xss', r"onload\s*="),
+    Rule('xss-onerror', 'xss', r"onerror\s*="),
+    Rule('traversal-slash', 'traversal', r"\.\./"),
+    Rule('traversal-backslash', 'traversal', r"\.\.\\"),
+]
+
+
+def _literal_prefix(pattern):
+    """
+    The text every match of `pattern` starts with, or '' if there is none:
+    its leading plain (or escaped punctuation) characters, up to the first
+    one a following ?, * or {...} makes optional.
+    """
+    if '|' in pattern:
+        # An alternative may start with anything
+        return ''
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        if pattern[i] == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            literal, size = pattern[i + 1], 2
+        elif pattern[i] not in '\\.^$*+?{}[]|()':
+            literal, size = pattern[i], 1
+        else:
+            break
+        quantifier = pattern[i + size:i + size + 1]
+        if quantifier and quantifier in '?*{':
+            break
+        prefix.append(literal)
+        if quantifier == '+':
+            break
+        i += size
+    return ''.join(prefix)
+
+
+class RuleSet:
+    """A compiled set of rules with per-rule hit counters."""
+
+    def __init__(self, rules=DEFAULT_RULES):
+        self.rules = {}
+        groups = []
+        for number, rule in enumerate(rules):
+            group = f'r{number}'
+            self.rules[group] = rule
+            groups.append(f'(?P<{group}>{rule.pattern})')
+        self.regex = re.compile('|'.join(groups), re.IGNORECASE) if groups else None
+        prefixes = {_literal_prefix(rule.pattern).lower() for rule in rules}
+        # None: no prefilter, some rule can match without a fixed start
+        self.prefixes = tuple(sorted(prefixes)) if '' not in prefixes else None
+        self.hits = {rule.id: 0 for rule in rules}
+        self._lock = threading.Lock()
+
+    def match(self, value):
+        """The first rule matching a string, or None."""
+        if self.regex is None or not isinstance(value, str):
+            return None
+        # Only for ASCII: with IGNORECASE some other characters match ASCII
+        # letters ('ſ' matches 's') without lower() turning them into them
+        if self.prefixes is not None and value.isascii():
+            lowered = value.lower()
+            if not any(prefix in lowered for prefix in self.prefixes):
+                return None
+        found = self.regex.search(value)
+        if found is None:
+            return None
+        rule = self.rules[found.lastgroup]
+        with self._lock:
+            self.hits[rule.id] += 1
+        return rule
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.hits)
+
+
+def _json_strings(data):
+    """Every string (keys included) in a decoded JSON document."""
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            yield item
+        elif isinstance(item, dict):
+            for key, value in item.items():
+                yield key
+                stack.append(value)
+        elif isinstance(item, list):
+            stack.extend(item)
+
+
+def request_values(request):
+    """
+    (location, value) for every part of the request the WAF inspects: the
+    path and all GET and POST values, plus the headers in WAF_INSPECT_HEADERS
+    and, if WAF_INSPECT_JSON is set, the strings in a JSON body up to
+    WAF_MAX_JSON_BODY bytes.
+
+    Headers and JSON bodies are off by default: they carry free text from
+    third parties (Stripe webhook payloads, browser User-Agents) that the SQL
+    rules would block.
+    """
+    yield 'path', request.path
+    for header in getattr(settings, 'WAF_INSPECT_HEADERS', ()):
+        if header in request.META:
+            yield header, request.META[header]
+    for key, values in request.GET.lists():
+        for value in values:
+            yield f'GET:{key}', value
+
+    if request.method not in ('POST', 'PUT', 'PATCH'):
+        return
+    if request.content_type == 'application/json':
+        if not getattr(settings, 'WAF_INSPECT_JSON', False):
+            return
+        max_size = getattr(settings, 'WAF_MAX_JSON_BODY', 64 * 1024)
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if 0 < length <= max_size:
+            try:
+                data = json.loads(request.body)
+            except ValueError:
+                return
+            for value in _json_strings(data):
+                yield 'JSON', value
+    else:
+        for key, values in request.POST.lists():
+            for value in values:
+                yield f'POST:{key}', value
+
+
+_rule_set = None
+_rule_set_lock = threading.Lock()
+
+
+def get_rule_set():
+    """
+    The process-wide RuleSet: DEFAULT_RULES plus WAF_EXTRA_RULES, minus the
+    ids listed in WAF_DISABLED_RULES.
+    """
+    global _rule_set
+    if _rule_set is None:
+        with _rule_set_lock:
+            if _rule_set is None:
+                disabled = set(getattr(settings, 'WAF_DISABLED_RULES', ()))
+                rules = DEFAULT_RULES + [Rule(*rule) for rule in getattr(settings, 'WAF_EXTRA_RULES', ())]
+                _rule_set = RuleSet([rule for rule in rules if rule.id not in disabled])
+    return _rule_set
+
+
+def inspect_request(request, rule_set=None):
+    """Return (location, rule) for the first suspicious value, or None."""
+    rule_set = rule_set or get_rule_set()
+    for location, value in request_values(request):
+        rule = rule_set.match(value)
+        if rule is not None:
+            logger.warning("WAF rule %s matched %s of %s %s", rule.id, location, request.method, request.path)
+            return location, rule
+    return None
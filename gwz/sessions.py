@@ -0,0 +1,67 @@
+"""
+Session engine: sessions live in the shared cache, and only those of
+logged-in users are also written to the database.
+
+Anonymous visitors' sessions (carts, coupons, the language) are kept in the
+'sessions' cache alone, so browsing and filling a cart never writes to the
+database. A logged-in user's session is written through to django_session as
+well, as with Django's cached_db engine, so logins survive the cache being
+flushed. Without a cache server to hold them (SESSION_PERSIST_ANONYMOUS),
+anonymous sessions are written through to the database too.
+
+Either way a session is only written when its serialized data has changed
+since it was loaded, or when less than half of its expiry age is left, so
+requests that merely touch the session (request.session.modified = True
+with nothing new) cost no write while active sessions still have their
+expiry pushed back.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.contrib.sessions.backends.base import CreateError, UpdateError
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+
+# When the session was last written, as a Unix timestamp
+SAVED_AT_KEY = '_session_saved_at'
+
+
+class SessionStore(CachedDBStore):
+    cache_key_prefix = 'gwz.sessions'
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._saved_payload = None
+
+    def _payload(self, data):
+        return self.serializer().dumps({key: value for key, value in data.items() if key != SAVED_AT_KEY})
+
+    def load(self):
+        data = super().load()
+        self._saved_payload = self._payload(data)
+        return data
+
+    def _needs_refresh(self, data):
+        """Whether the stored copy of `data` expires within half its expiry age."""
+        saved_at = data.get(SAVED_AT_KEY)
+        return saved_at is None or time.time() - saved_at >= self.get_expiry_age() / 2
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        payload = self._payload(data)
+        if not must_create and payload == self._saved_payload and not self._needs_refresh(data):
+            return
+        data[SAVED_AT_KEY] = int(time.time())
+        if data.get(SESSION_KEY) or getattr(settings, 'SESSION_PERSIST_ANONYMOUS', False):
+            try:
+                super().save(must_create)
+            except UpdateError:
+                # The first write of a session kept in the cache until now
+                super().save(must_create=True)
+        else:
+            store = self._cache.add if must_create else self._cache.set
+            if not store(self.cache_key, data, self.get_expiry_age()) and must_create:
+                raise CreateError
+        self._saved_payload = payload
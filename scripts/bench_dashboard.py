@@ -0,0 +1,147 @@
+"""
+Benchmark the "Most Active Visitors" table of the ShopStatistics dashboard.
+
+Fills a throwaway test database with synthetic page visits and times:
+
+  legacy   GROUP BY ip_address with seven correlated "latest value" subqueries
+  window   VisitStats.top_visitors() + add_latest_details() on raw visits only
+  rollup   the same after rollup_pending(), as the dashboard runs it
+
+Usage:
+    python scripts/bench_dashboard.py --visits 1000000 --ips 20000 --days 365
+    python scripts/bench_dashboard.py --visits 50000 --legacy
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+import django
+
+sys.path.append(os.getcwd())
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gwz.settings')
+django.setup()
+
+from django.db import connection, transaction
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.utils import timezone
+
+from analytics.ingest import get_user_agent_id
+from analytics.models import PageVisit
+from analytics.rollups import VisitStats, rollup_pending
+
+
+def populate(visits, ips, days, seed=1):
+    rnd = random.Random(seed)
+    now = timezone.now()
+    addresses = [f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}' for i in range(ips)]
+    countries = [('Hong Kong', 'HK'), ('Taiwan', 'TW'), ('Japan', 'JP'), ('Unknown', '')]
+    agents = [get_user_agent_id(ua) for ua in (
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+        'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_2) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15',
+        'Mozilla/5.0 (iPhone; CPU iPhone OS 17_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+        'Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Mobile Safari/537.36',
+        'Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0',
+    )]
+    batch = []
+    with transaction.atomic():
+        for i in range(visits):
+            country, code = rnd.choice(countries)
+            batch.append(PageVisit(
+                path=f'/product/item-{rnd.randint(1, 500)}/',
+                # Skewed so that some addresses are much busier than others
+                ip_address=addresses[int(ips * rnd.random() ** 2)],
+                agent_id=rnd.choice(agents),
+                referer='',
+                country=country,
+                country_code=code,
+                city='Unknown',
+                timestamp=now - datetime.timedelta(seconds=rnd.randint(0, days * 86400)),
+            ))
+            if len(batch) == 10000:
+                PageVisit.objects.bulk_create(batch)
+                batch = []
+        PageVisit.objects.bulk_create(batch)
+
+
+def legacy_most_active(start_date):
+    latest = lambda field: Subquery(
+        PageVisit.objects.filter(ip_address=OuterRef('ip_address')).order_by('-timestamp').values(field)[:1]
+    )
+    latest_country_sq = PageVisit.objects.filter(
+        ip_address=OuterRef('ip_address')
+    ).exclude(country='Unknown').exclude(country__isnull=True).order_by('-timestamp').values('country')[:1]
+    latest_country_code_sq = PageVisit.objects.filter(
+        ip_address=OuterRef('ip_address')
+    ).exclude(country_code='').exclude(country_code__isnull=True).order_by('-timestamp').values('country_code')[:1]
+    return list(
+        PageVisit.objects.filter(timestamp__date__gte=start_date)
+        .values('ip_address')
+        .annotate(
+            views=Count('id'),
+            last_view=Max('timestamp'),
+            latest_page=latest('path'),
+            country=Subquery(latest_country_sq),
+            country_code=Subquery(latest_country_code_sq),
+            city=latest('city'),
+            referer=latest('referer'),
+            browser=latest('agent__browser'),
+            device_type=latest('agent__device_type'),
+        )
+        .order_by('-views')[:20]
+    )
+
+
+def windowed_most_active(start_date):
+    stats = VisitStats(start_date)
+    return stats.add_latest_details(stats.top_visitors(20))
+
+
+def timed(label, func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{label:<10} {best * 1000:10.1f} ms')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--visits', type=int, default=1000000)
+    parser.add_argument('--ips', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--legacy', action='store_true', help='Also time the old correlated-subquery version')
+    args = parser.parse_args()
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        started = time.perf_counter()
+        populate(args.visits, args.ips, args.days)
+        print(f'Inserted {args.visits} visits from {args.ips} IPs over {args.days} days '
+              f'in {time.perf_counter() - started:.1f} s')
+
+        start_date = timezone.localdate().replace(month=1, day=1)
+        if args.legacy:
+            legacy = timed('legacy', legacy_most_active, start_date, repeat=1)
+        window = timed('window', windowed_most_active, start_date)
+
+        started = time.perf_counter()
+        rollup_pending()
+        print(f'rollup_pending() took {time.perf_counter() - started:.1f} s')
+        rollup = timed('rollup', windowed_most_active, start_date)
+
+        if args.legacy:
+            assert [v['views'] for v in legacy] == [v['views'] for v in rollup], 'visitor counts differ'
+        assert [v['views'] for v in window] == [v['views'] for v in rollup], 'rollup counts differ'
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
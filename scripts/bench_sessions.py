@@ -0,0 +1,124 @@
+"""
+Benchmark session storage under cart-heavy traffic.
+
+Runs the same visits against a throwaway test database with Django's
+database session engine and with gwz.sessions, and reports the time per
+request and the number of writes to django_session. Each visitor browses the
+cart, adds a few products (some twice), removes one and views the cart again;
+--logged-in of them are logged in first.
+
+Sessions use the configured 'sessions' cache: Redis when REDIS_URL is set,
+where only logged-in visitors' sessions reach the database, otherwise none,
+where every changed session does. The time per request depends on that
+store and is reported for comparison, not as a speedup.
+
+Usage:
+    python scripts/bench_sessions.py --visitors 200 --logged-in 0.2
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+import django
+
+sys.path.append(os.getcwd())
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gwz.settings')
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from analytics.ingest import get_visit_buffer
+from store.models import Product
+
+ENGINES = {
+    'database': 'django.contrib.sessions.backends.db',
+    'gwz.sessions': 'gwz.sessions',
+}
+
+
+def populate(products, visitors):
+    for i in range(products):
+        Product.objects.create(name=f'Product {i}', slug=f'product-{i}', sku=f'SKU-{i}',
+                               price=Decimal('10.00'), stock=1000000)
+    for i in range(visitors):
+        User.objects.create_user(f'visitor{i}', password='secret')
+
+
+def visit(client, product_ids, rnd):
+    client.get(reverse('cart_view'))
+    chosen = rnd.sample(product_ids, 3)
+    for pid in chosen + chosen[:1]:
+        client.post(reverse('cart_add', args=[pid]), {'quantity': 1})
+    client.post(reverse('cart_remove', args=[chosen[1]]))
+    client.get(reverse('cart_view'))
+    return 7
+
+
+def run(engine, visitors, logged_in, seed=1):
+    rnd = random.Random(seed)
+    product_ids = list(Product.objects.values_list('pk', flat=True))
+    users = list(User.objects.order_by('pk')[:visitors])
+    requests = writes = 0
+    with override_settings(SESSION_ENGINE=engine):
+        for cache in caches.all():
+            cache.clear()
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as context:
+            for i in range(visitors):
+                client = Client()
+                if rnd.random() < logged_in:
+                    client.force_login(users[i])
+                requests += visit(client, product_ids, rnd)
+        elapsed = time.perf_counter() - started
+    for query in context.captured_queries:
+        sql = query['sql'].lstrip().upper()
+        if 'DJANGO_SESSION' in sql and sql.startswith(('INSERT', 'UPDATE')):
+            writes += 1
+    return elapsed / requests * 1000, writes, requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--visitors', type=int, default=200)
+    parser.add_argument('--products', type=int, default=50)
+    parser.add_argument('--logged-in', type=float, default=0.2, help='Share of visitors who log in')
+    args = parser.parse_args()
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                            'LOCATION': os.path.join(cache_dir, 'default')},
+                'sessions': settings.CACHES['sessions'],
+            },
+            # Page visits are written in the background, not during the requests
+            ANALYTICS_INGEST_MODE='buffered',
+            ALLOWED_HOSTS=['testserver'],
+        ):
+            populate(args.products, args.visitors)
+            print(f'{args.visitors} visitors, {args.logged_in:.0%} logged in, '
+                  f'sessions cache: {settings.CACHES["sessions"]["BACKEND"].rsplit(".", 1)[-1]}')
+            print(f'{"engine":<14} {"ms/request":>10} {"session writes":>15}')
+            for label, engine in ENGINES.items():
+                per_request, writes, requests = run(engine, args.visitors, args.logged_in)
+                print(f'{label:<14} {per_request:10.2f} {writes:8d} / {requests}')
+                # Write the queued visits now rather than during the next
+                # engine's run, and while the test database is still there
+                get_visit_buffer().stop()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+if __name__ == '__main__':
+    main()
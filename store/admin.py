@@ -5,6 +5,7 @@ from django.contrib.auth.admin import UserAdmin
 from django_recaptcha.fields import ReCaptchaField
 from django_recaptcha.widgets import ReCaptchaV2Checkbox
 from .models import Product, ProductImage, Order, OrderItem, SiteSettings, Page, Coupon, OrderNote, Category, Customer, PaymentMethod, SalesDashboard, HeroSlide, UserProfile
+from .catalogue import catalogue_cards
 from django.db.models import Sum, Count, Avg
 from django.db.models.functions import TruncDate
 from django.template.response import TemplateResponse
@@ -25,6 +26,8 @@ from django.conf import settings
 from openpyxl import Workbook
 from django.urls import path
 from django.shortcuts import redirect
+from django.utils.decorators import method_decorator
+from gwz.db import read_from_replica
 from django.core.files import File
 import zipfile
 import tempfile
@@ -329,8 +332,15 @@ class ProductResource(resources.ModelResource):
                 instance.image_url = urls[0]
                 instance.save(update_fields=['image_url'])
 
+class ReplicaExportMixin:
+    """Builds the import-export exports, form and file, from the read replica."""
+
+    @method_decorator(read_from_replica(methods=('GET', 'HEAD', 'POST')))
+    def export_action(self, request):
+        return super().export_action(request)
+
 @admin.register(Product)
-class ProductAdmin(ImportExportModelAdmin, TranslationAdmin):
+class ProductAdmin(ReplicaExportMixin, ImportExportModelAdmin, TranslationAdmin):
     list_per_page = 20
     resource_class = ProductResource
     list_display = ('product_thumbnail', 'name', 'sku', 'stock_status', 'price', 'discount_price', 'get_categories', 'is_active', 'updated_at')
@@ -436,23 +446,20 @@ class ProductAdmin(ImportExportModelAdmin, TranslationAdmin):
         from django.template.response import TemplateResponse
         return TemplateResponse(request, 'admin/store/product/upload_images.html', context)
 
+    def get_queryset(self, request):
+        # Thumbnails and categories for the whole changelist page in two queries
+        return catalogue_cards(super().get_queryset(request))
+
     def get_categories(self, obj):
         return ", ".join([c.name for c in obj.categories.all()])
     get_categories.short_description = _('Categories')
 
     def product_thumbnail(self, obj):
         from django.utils.html import format_html
-        if obj.image:
-            return format_html('<img src="{}" style="width: 50px; height: 50px; object-fit: cover;" />', obj.image.url)
-        elif obj.image_url:
-             return format_html('<img src="{}" style="width: 50px; height: 50px; object-fit: cover;" />', obj.image_url)
-        # Fallback to the first related image if main image is not set
-        elif obj.images.exists():
-            first_img = obj.images.first()
-            if first_img.image_url:
-                return format_html('<img src="{}" style="width: 50px; height: 50px; object-fit: cover;" />', first_img.image_url)
-            elif first_img.image:
-                return format_html('<img src="{}" style="width: 50px; height: 50px; object-fit: cover;" />', first_img.image.url)
+        # Uploaded image, image URL or the first related image
+        url = obj.primary_image_url
+        if url:
+            return format_html('<img src="{}" style="width: 50px; height: 50px; object-fit: cover;" />', url)
         return "-"
     product_thumbnail.short_description = _('Image')
 
@@ -542,7 +549,7 @@ class OrderResource(resources.ModelResource):
         return timezone.localtime(order.created_at).strftime('%Y-%m-%d %H:%M')
 
 @admin.register(Order)
-class OrderAdmin(ImportExportModelAdmin):
+class OrderAdmin(ReplicaExportMixin, ImportExportModelAdmin):
     list_per_page = 20
     resource_class = OrderResource
     change_form_template = 'admin/store/order/change_form.html'
@@ -796,7 +803,7 @@ class CustomerResource(resources.ModelResource):
              pass
 
 @admin.register(Customer)
-class CustomerAdmin(ImportExportModelAdmin, UserAdmin):
+class CustomerAdmin(ReplicaExportMixin, ImportExportModelAdmin, UserAdmin):
     list_per_page = 20
     resource_class = CustomerResource
     form = CustomerChangeForm
@@ -869,6 +876,7 @@ class SalesDashboardAdmin(admin.ModelAdmin):
     def has_change_permission(self, request, obj=None):
         return False
 
+    @method_decorator(read_from_replica)
     def changelist_view(self, request, extra_context=None):
         # Date Range Filtering
         period = request.GET.get('period', '30days')
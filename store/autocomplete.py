@@ -0,0 +1,202 @@
+"""
+In-memory prefix trie for search-as-you-type suggestions.
+
+Every worker keeps a trie of the active products' names (all languages) and
+SKUs and of the category names, keyed by the normalized text from each word
+(and each CJK character) onwards, so "sham" finds "Restoring Shampoo" and
+"洗髮" finds "修護洗髮水". Lookups never touch the database.
+
+Product and category changes bump the 'autocomplete' version (see
+store.signals). A worker that sees a new version re-reads only the products
+updated since its last refresh, drops the ones that are gone or inactive and
+reloads the (few) categories.
+"""
+import datetime
+import re
+import threading
+import unicodedata
+from urllib.parse import urlencode
+
+from django.urls import reverse
+from django.utils import timezone, translation
+from modeltranslation.utils import build_localized_fieldname
+
+from .cache import get_version
+from .models import Category, Product
+from .search import CJK, get_languages, localized
+
+_start_re = re.compile(rf'[{CJK}]|(?<![^\W_])[^\W_]')
+
+# Allowance for clock differences between workers when asking for the
+# products updated since the last refresh
+REFRESH_OVERLAP = datetime.timedelta(minutes=1)
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def suffixes(text):
+    """The text from each word start and each CJK character onwards."""
+    text = normalize(text)
+    return {text[match.start():] for match in _start_re.finditer(text)}
+
+
+class PrefixTrie:
+    """Maps every key to a set of entries; finds entries by key prefix."""
+
+    def __init__(self):
+        self.root = {}
+        self.keys = {}
+
+    def add(self, entry, keys):
+        self.remove(entry)
+        self.keys[entry] = keys
+        for key in keys:
+            node = self.root
+            for char in key:
+                node = node.setdefault(char, {})
+            node.setdefault(None, set()).add(entry)
+
+    def remove(self, entry):
+        for key in self.keys.pop(entry, ()):
+            path = [self.root]
+            for char in key:
+                path.append(path[-1].get(char))
+                if path[-1] is None:
+                    break
+            else:
+                path[-1].get(None, set()).discard(entry)
+                # Prune the branches left empty
+                for depth in range(len(key), 0, -1):
+                    node = path[depth]
+                    if node.get(None) == set():
+                        del node[None]
+                    if node:
+                        break
+                    del path[depth - 1][key[depth - 1]]
+
+    def find(self, prefix, limit, accept=None):
+        """
+        Up to `limit` distinct entries under `prefix`, shortest completions
+        first. `accept` filters the entries.
+        """
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        found = {}
+        level = [node]
+        while level and len(found) < limit:
+            next_level = []
+            for node in level:
+                for child, value in node.items():
+                    if child is None:
+                        for entry in sorted(value):
+                            if entry not in found and (accept is None or accept(entry)):
+                                found[entry] = None
+                    else:
+                        next_level.append(value)
+            level = next_level
+        return list(found)[:limit]
+
+
+class Suggestions:
+    """Trie of products and categories plus their labels and URLs."""
+
+    def __init__(self):
+        self.trie = PrefixTrie()
+        self.labels = {}
+        self.urls = {}
+        self.version = None
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def _add_product(self, product):
+        entry = ('product', product.pk)
+        names = {language: localized(product, 'name', language) for language in get_languages()}
+        keys = set()
+        for name in names.values():
+            keys |= suffixes(name)
+        keys |= suffixes(product.sku)
+        self.trie.add(entry, keys)
+        self.labels[entry] = names
+        self.urls[entry] = product.slug
+
+    def _add_category(self, category):
+        entry = ('category', category.pk)
+        names = {language: localized(category, 'name', language) for language in get_languages()}
+        keys = set()
+        for name in names.values():
+            keys |= suffixes(name)
+        self.trie.add(entry, keys)
+        self.labels[entry] = names
+        self.urls[entry] = None
+
+    def _drop(self, entry):
+        self.trie.remove(entry)
+        self.labels.pop(entry, None)
+        self.urls.pop(entry, None)
+
+    def refresh(self):
+        """Bring the trie up to date with the current version."""
+        version = get_version('autocomplete')
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            started = timezone.now()
+            products = Product.objects.filter(is_active=True).only(
+                'pk', 'slug', 'sku', *[build_localized_fieldname('name', language) for language in get_languages()]
+            )
+            if self.refreshed_at is not None:
+                active = set(Product.objects.filter(is_active=True).values_list('pk', flat=True))
+                for entry in [entry for entry in self.labels if entry[0] == 'product' and entry[1] not in active]:
+                    self._drop(entry)
+                products = products.filter(updated_at__gte=self.refreshed_at - REFRESH_OVERLAP)
+            for product in products:
+                self._add_product(product)
+
+            for entry in [entry for entry in self.labels if entry[0] == 'category']:
+                self._drop(entry)
+            for category in Category.objects.all():
+                self._add_category(category)
+
+            self.version = version
+            self.refreshed_at = started
+
+    def suggest(self, query, products=8, categories=5):
+        self.refresh()
+        prefix = normalize(query).strip()
+        if not prefix:
+            return {'products': [], 'categories': []}
+        language = translation.get_language()
+        with self.lock:
+            product_entries = self.trie.find(prefix, products, lambda entry: entry[0] == 'product')
+            category_entries = self.trie.find(prefix, categories, lambda entry: entry[0] == 'category')
+            product_entries = [(self.labels[entry], self.urls[entry]) for entry in product_entries]
+            category_entries = [self.labels[entry] for entry in category_entries]
+
+        def label(names):
+            return names.get(language) or next(iter(names.values()))
+
+        return {
+            'products': [
+                {'name': label(names), 'url': reverse('product_detail', args=[slug])}
+                for names, slug in product_entries
+            ],
+            'categories': [
+                {'name': label(names), 'url': '%s?%s' % (reverse('product_list'), urlencode({'category': label(names)}))}
+                for names in category_entries
+            ],
+        }
+
+
+_suggestions = Suggestions()
+
+
+def suggest(query, products=8, categories=5):
+    """Top product and category suggestions for a search-box prefix."""
+    return _suggestions.suggest(query, products, categories)
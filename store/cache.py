@@ -0,0 +1,157 @@
+"""
+Per-process snapshots of rarely changing store data, invalidated through
+version counters kept in the shared cache.
+
+Each snapshot belongs to a named version. Reading a snapshot costs one cache
+lookup for the version number; the data is only re-read from the database
+when the number differs from the one the snapshot was built with. Signal
+handlers bump the version whenever an admin saves or deletes the underlying
+rows, once the change commits, so every worker picks up the change on its
+next request. The time of
+each bump is kept next to the number (see get_changed_at()) for HTTP
+Last-Modified headers.
+
+Bumping relies on the cache's incr() being atomic, which holds for Redis and
+Memcached (and the per-process local-memory cache) but not for the file
+cache, where two workers bumping at once can both write the same number.
+With such a backend the counters are kept in the CacheVersion table and
+updated there; the cache then only holds a copy of each number for
+DB_VERSION_TIMEOUT seconds.
+"""
+import datetime
+import threading
+import time
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.core.cache.backends.redis import RedisCache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import translation
+
+from .models import CacheVersion, Category, HeroSlide, SiteSettings
+
+# Cache backends with an atomic incr()
+ATOMIC_BACKENDS = (RedisCache, BaseMemcachedCache, LocMemCache)
+
+# Seconds a number read from CacheVersion is kept in the cache. Also bounds
+# how long two racing bumps can leave the older number there.
+DB_VERSION_TIMEOUT = 30
+
+_snapshots = {}
+_lock = threading.Lock()
+
+
+def _version_key(name):
+    return f'store_version_{name}'
+
+
+def _changed_key(name):
+    return f'store_version_{name}_changed'
+
+
+def get_changed_at(*names):
+    """
+    Aware datetime of the latest bump of any of the named versions, or None
+    if that is not known (never bumped, or evicted from the cache).
+    """
+    changed = cache.get_many([_changed_key(name) for name in names])
+    if len(changed) < len(names):
+        return None
+    return datetime.datetime.fromtimestamp(max(changed.values()), tz=datetime.timezone.utc)
+
+
+def _counts_in_cache():
+    return isinstance(caches['default'], ATOMIC_BACKENDS)
+
+
+def get_version(name):
+    """Current number of the named version (0 until first bumped)."""
+    key = _version_key(name)
+    number = cache.get(key)
+    if number is None:
+        if _counts_in_cache():
+            return 0
+        number = CacheVersion.objects.filter(name=name).values_list('number', flat=True).first() or 0
+        cache.set(key, number, DB_VERSION_TIMEOUT)
+    return number
+
+
+def bump_version(name):
+    """
+    Invalidate every snapshot built from the named version, once the
+    caller's transaction commits: a worker reading the new number earlier
+    would rebuild its snapshot from the old rows and keep it.
+    """
+    key = _version_key(name)
+    if not _counts_in_cache():
+        # Counters start from the clock rather than 1, see _increment()
+        start = time.time_ns() // 1000000
+        number = _bump_counter(name, start)
+
+        def publish():
+            cache.set(key, number, DB_VERSION_TIMEOUT)
+            cache.set(_changed_key(name), start / 1000, None)
+        transaction.on_commit(publish)
+    else:
+        transaction.on_commit(lambda: _increment(name))
+
+
+def _increment(name):
+    key = _version_key(name)
+    # Counters start from the clock rather than 1, so a counter that was
+    # evicted from the cache never comes back with a number some worker
+    # still has a snapshot for.
+    start = time.time_ns() // 1000000
+    cache.set(_changed_key(name), start / 1000, None)
+    if cache.add(key, start, None):
+        return
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr()
+        cache.set(key, start, None)
+
+
+def _bump_counter(name, start):
+    with transaction.atomic():
+        if not CacheVersion.objects.filter(name=name).update(number=F('number') + 1):
+            try:
+                with transaction.atomic():
+                    CacheVersion.objects.create(name=name, number=start)
+            except IntegrityError:
+                # Created by a concurrent bump
+                CacheVersion.objects.filter(name=name).update(number=F('number') + 1)
+        return CacheVersion.objects.values_list('number', flat=True).get(name=name)
+
+
+def snapshot(key, version, build, per_language=False):
+    """
+    Return build()'s result, kept under `key` for as long as the named
+    `version` does not change. `per_language` keeps a separate copy for each
+    active language (for translated orderings).
+    """
+    if per_language:
+        key = (key, translation.get_language())
+    current = get_version(version)
+    cached = _snapshots.get(key)
+    if cached is not None and cached[0] == current:
+        return cached[1]
+    value = build()
+    with _lock:
+        _snapshots[key] = (current, value)
+    return value
+
+
+def get_site_settings():
+    return snapshot('site_settings', 'site', SiteSettings.objects.first)
+
+
+def get_hero_slides():
+    return snapshot('hero_slides', 'site', lambda: list(HeroSlide.objects.filter(is_active=True)))
+
+
+def get_categories():
+    """All categories ordered by their name in the active language."""
+    return snapshot('categories', 'categories', lambda: list(Category.objects.order_by('name')), per_language=True)
@@ -0,0 +1,137 @@
+"""
+The shopping cart.
+
+The session holds only a {product id: quantity} map under 'cart', so adding
+or removing a line changes one small entry instead of re-serialising a copy
+of each product's name, price and image. The displayed names, prices and
+images are hydrated from the products when the cart is shown: each
+product's details are kept in the shared cache for a short while
+(STORE_CART_PRICE_TIMEOUT) under the 'content' version, which any product
+change bumps, and the products missing from the cache are read in one query.
+
+Carts stored by earlier versions as {id: {'name', 'price', 'qty', 'image'}}
+are converted on first read.
+"""
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import translation
+
+from .cache import get_version
+from .models import Product
+
+PRICE_TIMEOUT = 60
+
+
+@dataclass
+class CartLine:
+    id: int
+    name: str
+    price: Decimal
+    qty: int
+    image: str = ''
+
+    @property
+    def subtotal(self):
+        return self.price * self.qty
+
+
+def _product_key(pid):
+    return f'store_cart_product_{get_version("content")}_{translation.get_language()}_{pid}'
+
+
+def product_details(product_ids):
+    """{id: {'name', 'price', 'image'}} for the existing products among `product_ids`."""
+    keys = {_product_key(pid): pid for pid in product_ids}
+    details = {keys[key]: value for key, value in cache.get_many(list(keys)).items()}
+    missing = [pid for pid in product_ids if pid not in details]
+    if missing:
+        # Products that no longer exist are cached as {} too
+        fetched = dict.fromkeys(missing, {})
+        products = Product.objects.filter(pk__in=missing).only('name', 'price', 'discount_price', 'primary_image_url')
+        for product in products:
+            fetched[product.pk] = {
+                'name': product.name,
+                'price': str(product.effective_price()),
+                'image': product.primary_image_url,
+            }
+        cache.set_many(
+            {_product_key(pid): value for pid, value in fetched.items()},
+            getattr(settings, 'STORE_CART_PRICE_TIMEOUT', PRICE_TIMEOUT),
+        )
+        details.update(fetched)
+    return {pid: value for pid, value in details.items() if value}
+
+
+class Cart:
+    """The cart in `session`. Use get_cart() in views."""
+
+    def __init__(self, session):
+        self.session = session
+        self._lines = None
+        stored = session.get('cart') or {}
+        if any(isinstance(value, dict) for value in stored.values()):
+            stored = {pid: int(value['qty']) if isinstance(value, dict) else value for pid, value in stored.items()}
+            session['cart'] = stored
+
+    @property
+    def quantities(self):
+        """{product id: quantity}"""
+        return {int(pid): qty for pid, qty in (self.session.get('cart') or {}).items()}
+
+    def __bool__(self):
+        return bool(self.session.get('cart'))
+
+    def __len__(self):
+        return len(self.session.get('cart') or {})
+
+    @property
+    def count(self):
+        return sum((self.session.get('cart') or {}).values())
+
+    def quantity(self, product_id):
+        return (self.session.get('cart') or {}).get(str(product_id), 0)
+
+    def add(self, product_id, qty):
+        stored = self.session.setdefault('cart', {})
+        stored[str(product_id)] = stored.get(str(product_id), 0) + qty
+        self._changed()
+
+    def remove(self, product_id):
+        stored = self.session.get('cart') or {}
+        if str(product_id) in stored:
+            del stored[str(product_id)]
+            self._changed()
+
+    def clear(self):
+        if self.session.get('cart'):
+            self.session['cart'] = {}
+        self._lines = None
+
+    def _changed(self):
+        self.session.modified = True
+        self._lines = None
+
+    def lines(self):
+        """CartLines with the current names and prices; products that no longer exist are left out."""
+        if self._lines is None:
+            quantities = self.quantities
+            details = product_details(list(quantities))
+            self._lines = [
+                CartLine(pid, details[pid]['name'], Decimal(details[pid]['price']), qty, details[pid]['image'])
+                for pid, qty in quantities.items() if pid in details
+            ]
+        return self._lines
+
+    @property
+    def total(self):
+        return sum((line.subtotal for line in self.lines()), Decimal('0'))
+
+
+def get_cart(request):
+    """The request's Cart, shared by the views and the context processor."""
+    if not hasattr(request, '_cart'):
+        request._cart = Cart(request.session)
+    return request._cart
@@ -0,0 +1,24 @@
+"""
+Product queries for catalogue cards (the storefront grid, the wishlist and
+the admin changelist).
+
+catalogue_cards() loads a page of products in a fixed number of queries,
+however many rows it has: the image comes from the stored
+Product.primary_image_url and the categories are prefetched in one more
+query.
+"""
+from django.db.models import Prefetch
+
+from .models import Category, Product
+
+
+def catalogue_cards(queryset=None, categories=True):
+    """
+    `queryset` (by default all products) ready to render as cards. Pass
+    `categories=False` where the cards do not show the categories.
+    """
+    if queryset is None:
+        queryset = Product.objects.all()
+    if categories:
+        queryset = queryset.prefetch_related(Prefetch('categories', queryset=Category.objects.order_by('name')))
+    return queryset
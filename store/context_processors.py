@@ -1,49 +1,42 @@
-from .models import SiteSettings, Category
-from decimal import Decimal
+from django.conf import settings as django_settings
+from .cache import get_categories, get_site_settings, get_version
+from .cart import get_cart
 
 def site_settings(request):
     """
     Context processor to make SiteSettings and Categories available to all templates.
+    Both come from per-process snapshots (see store.cache).
     """
     try:
-        settings = SiteSettings.objects.first()
+        settings = get_site_settings()
     except Exception:
         settings = None
         
-    categories = Category.objects.all().order_by('name')
+    categories = get_categories()
     return {
         'site_settings': settings,
         'categories': categories
     }
 
+def fragment_cache(request):
+    """
+    Stamp for the {% cache %} fragments of the shared chrome (header menus,
+    footer, tracking pixels, home page sections). Signal handlers bump the
+    'content' version whenever the site settings, hero slides, categories or
+    products change, so the fragments never outlive their content.
+    """
+    return {
+        'content_version': get_version('content'),
+        'fragment_cache_timeout': getattr(django_settings, 'STORE_FRAGMENT_CACHE_TIMEOUT', 60 * 60 * 24),
+    }
+
 def cart_processor(request):
     """
     Context processor to make cart item count and details available to all templates.
     """
-    cart = request.session.get('cart', {})
-    
-    cart_items = []
-    cart_total_price = Decimal('0')
-    cart_item_count = 0
-    
-    for pid, item in cart.items():
-        # Create a copy to avoid modifying the session directly if mutable
-        # and inject the ID which is the key in the cart dictionary
-        item_data = item.copy()
-        item_data['id'] = pid
-        
-        qty = int(item.get('qty', 0))
-        try:
-            price = Decimal(str(item.get('price', '0')))
-        except:
-            price = Decimal('0')
-        
-        cart_items.append(item_data)
-        cart_item_count += qty
-        cart_total_price += price * qty
-        
+    cart = get_cart(request)
     return {
-        'cart_item_count': cart_item_count,
-        'cart_items': cart_items,
-        'cart_total_price': cart_total_price
+        'cart_item_count': cart.count,
+        'cart_items': cart.lines(),
+        'cart_total_price': cart.total,
     }
@@ -0,0 +1,64 @@
+"""
+Category facet counts (number of active products per category) for the
+product list sidebar.
+
+The storewide counts are one GROUP BY kept as a per-process snapshot of the
+'facets' version; the counts for a search are cached in the shared cache per
+query and language under the same version. Product, Category and
+product-category changes bump the version (see store.signals).
+"""
+import copy
+import hashlib
+
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import translation
+
+from .cache import get_categories, get_version, snapshot
+from .models import Product
+
+SEARCH_FACETS_TIMEOUT = 60 * 10
+
+
+def _count_by_category(products):
+    rows = (
+        Product.objects.filter(pk__in=products.values('pk'))
+        .values_list('categories').annotate(count=Count('pk')).order_by()
+    )
+    return {category_id: count for category_id, count in rows if category_id is not None}
+
+
+def get_category_counts():
+    """{category id: number of active products} for the whole store."""
+    return snapshot('category_counts', 'facets', lambda: _count_by_category(Product.objects.filter(is_active=True)))
+
+
+def get_search_category_counts(products, query):
+    """
+    {category id: count} for `products`, the active products matching the
+    search `query`.
+    """
+    digest = hashlib.md5(query.encode('utf-8')).hexdigest()
+    key = f'store_search_facets_{get_version("facets")}_{translation.get_language()}_{digest}'
+    counts = cache.get(key)
+    if counts is None:
+        counts = _count_by_category(products)
+        cache.set(key, counts, SEARCH_FACETS_TIMEOUT)
+    return counts
+
+
+def get_category_facets(products=None, query=''):
+    """
+    Categories (ordered by name) that have products, each with a `count`
+    attribute. With a search `query` the counts are for the matching
+    `products` only.
+    """
+    counts = get_search_category_counts(products, query) if query else get_category_counts()
+    facets = []
+    for category in get_categories():
+        if counts.get(category.pk):
+            # The categories are shared with other requests; annotate a copy
+            category = copy.copy(category)
+            category.count = counts[category.pk]
+            facets.append(category)
+    return facets
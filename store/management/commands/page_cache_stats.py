@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from store.page_cache import get_stats, reset_stats
+
+class Command(BaseCommand):
+    help = 'Show the anonymous page cache hit/miss/bypass counters (written by each worker every 30 seconds)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after showing them')
+
+    def handle(self, *args, **options):
+        stats = get_stats()
+        served = stats['hit'] + stats['miss']
+        ratio = stats['hit'] / served * 100 if served else 0
+        self.stdout.write(f"Hits: {stats['hit']}  Misses: {stats['miss']}  Bypassed: {stats['bypass']}  Hit ratio: {ratio:.1f}%")
+        if options['reset']:
+            reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
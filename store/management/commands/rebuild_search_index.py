@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from store.search import get_backend
+
+class Command(BaseCommand):
+    help = 'Rebuild the product search index from the active products'
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        count = backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} product(s) with {type(backend).__name__}'))
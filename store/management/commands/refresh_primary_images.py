@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
+from store.models import Product, ProductImage
+
+class Command(BaseCommand):
+    help = 'Recompute the stored primary image URL of every product'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Products read and updated per batch')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        products = Product.objects.only('pk', 'image', 'image_url', 'primary_image_url').prefetch_related(
+            Prefetch('images', queryset=ProductImage.objects.order_by('sort_order', 'id'))
+        )
+        changed = []
+        total = 0
+        for product in products.iterator(chunk_size=batch_size):
+            url = product.resolve_primary_image_url()
+            if url != product.primary_image_url:
+                product.primary_image_url = url
+                changed.append(product)
+                total += 1
+            if len(changed) >= batch_size:
+                Product.objects.bulk_update(changed, ['primary_image_url'])
+                changed = []
+        Product.objects.bulk_update(changed, ['primary_image_url'])
+        self.stdout.write(self.style.SUCCESS(f'Updated the primary image of {total} product(s)'))
@@ -0,0 +1,79 @@
+import html
+
+from django.conf import settings
+from django.db import migrations
+from django.utils.html import strip_tags
+from modeltranslation.utils import build_localized_fieldname
+
+
+# Frozen copy of store.search as of this migration, so that later changes
+# there cannot alter what it does.
+FTS_TABLE = 'store_product_fts'
+
+
+def localized(obj, field, language):
+    languages = [code for code, name in settings.LANGUAGES]
+    for code in [language] + [code for code in languages if code != language]:
+        value = getattr(obj, build_localized_fieldname(field, code), None)
+        if value:
+            return value
+    return ''
+
+
+def html_to_text(value):
+    return ' '.join(html.unescape(strip_tags(value or '')).split())
+
+
+def document_rows(product):
+    categories = list(product.categories.all())
+    return [
+        (
+            product.pk,
+            language,
+            localized(product, 'name', language),
+            html_to_text(localized(product, 'description', language)),
+            html_to_text(localized(product, 'specs', language)),
+            ' '.join(localized(category, 'name', language) for category in categories),
+        )
+        for language, name in settings.LANGUAGES
+    ]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    Product = apps.get_model('store', 'Product')
+    insert = f'INSERT INTO {FTS_TABLE} VALUES (%s, %s, %s, %s, %s, %s)'
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5('
+            f'product_id UNINDEXED, language UNINDEXED, name, description, specs, categories, '
+            f"tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        batch = []
+        for product in Product.objects.filter(is_active=True).prefetch_related('categories').iterator(chunk_size=500):
+            batch.extend(document_rows(product))
+            if len(batch) >= 1000:
+                cursor.executemany(insert, batch)
+                batch = []
+        cursor.executemany(insert, batch)
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0035_sitesettings_menu_about_text_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
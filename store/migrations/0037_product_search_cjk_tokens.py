@@ -0,0 +1,99 @@
+import html
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db import migrations
+from django.utils.html import strip_tags
+from modeltranslation.utils import build_localized_fieldname
+
+
+# Frozen copy of store.search as of this migration, so that later changes
+# there cannot alter what it does.
+FTS_TABLE = 'store_product_fts'
+
+CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_token_re = re.compile(
+    rf'(?P<cjk>[{CJK}]+)'
+    rf'|(?P<word>[^\W_{CJK}]+(?:[-_./][^\W_{CJK}]+)*)'
+)
+_code_separator_re = re.compile(r'[-_./]')
+
+
+def index_text(text):
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    terms = []
+    for match in _token_re.finditer(text):
+        run = match.group('cjk')
+        if run:
+            if len(run) == 1:
+                terms.append(run)
+            else:
+                terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+                terms.append(run[-1])
+        else:
+            parts = _code_separator_re.split(match.group('word'))
+            terms.extend([''.join(parts)] + parts if len(parts) > 1 else parts)
+    return ' '.join(terms)
+
+
+def localized(obj, field, language):
+    languages = [code for code, name in settings.LANGUAGES]
+    for code in [language] + [code for code in languages if code != language]:
+        value = getattr(obj, build_localized_fieldname(field, code), None)
+        if value:
+            return value
+    return ''
+
+
+def html_to_text(value):
+    return ' '.join(html.unescape(strip_tags(value or '')).split())
+
+
+def document_rows(product):
+    categories = list(product.categories.all())
+    rows = []
+    for language, name in settings.LANGUAGES:
+        texts = (
+            localized(product, 'name', language),
+            product.sku,
+            html_to_text(localized(product, 'description', language)),
+            html_to_text(localized(product, 'specs', language)),
+            ' '.join(localized(category, 'name', language) for category in categories),
+        )
+        rows.append((product.pk, language) + tuple(index_text(text) for text in texts))
+    return rows
+
+
+def rebuild_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    Product = apps.get_model('store', 'Product')
+    insert = f'INSERT INTO {FTS_TABLE} VALUES (%s, %s, %s, %s, %s, %s, %s)'
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5('
+            f'product_id UNINDEXED, language UNINDEXED, name, sku, description, specs, categories, '
+            f"tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        batch = []
+        for product in Product.objects.filter(is_active=True).prefetch_related('categories').iterator(chunk_size=500):
+            batch.extend(document_rows(product))
+            if len(batch) >= 1000:
+                cursor.executemany(insert, batch)
+                batch = []
+        cursor.executemany(insert, batch)
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0036_product_search_index'),
+    ]
+
+    operations = [
+        # New sku column and pre-tokenized (CJK bigram) text
+        migrations.RunPython(rebuild_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+from django.db.models import Prefetch
+
+
+def backfill_primary_image_url(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    ProductImage = apps.get_model('store', 'ProductImage')
+    products = Product.objects.using(schema_editor.connection.alias).prefetch_related(
+        Prefetch('images', queryset=ProductImage.objects.order_by('sort_order', 'id'))
+    )
+    changed = []
+    for product in products.iterator(chunk_size=500):
+        images = list(product.images.all()[:1])
+        if product.image:
+            url = product.image.url
+        elif product.image_url:
+            url = product.image_url
+        elif images:
+            url = images[0].image.url if images[0].image else images[0].image_url
+        else:
+            continue
+        product.primary_image_url = url
+        changed.append(product)
+    Product.objects.using(schema_editor.connection.alias).bulk_update(changed, ['primary_image_url'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0038_product_catalogue_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='primary_image_url',
+            field=models.CharField(blank=True, editable=False, max_length=500, verbose_name='Primary Image URL'),
+        ),
+        migrations.RunPython(backfill_primary_image_url, migrations.RunPython.noop),
+    ]
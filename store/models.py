@@ -47,6 +47,8 @@ class Product(models.Model):
     specs = RichTextField(blank=True, verbose_name=_("Specifications"))
     image = models.ImageField(upload_to='products/', blank=True, null=True, verbose_name=_("Product Image"))
     image_url = models.URLField(blank=True, verbose_name=_("Image URL"))
+    # Maintained by store.signals from image, image_url and the gallery
+    primary_image_url = models.CharField(max_length=500, blank=True, editable=False, verbose_name=_("Primary Image URL"))
     is_active = models.BooleanField(default=True, verbose_name=_("Active"))
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Created At"))
     updated_at = models.DateTimeField(auto_now=True, verbose_name=_("Updated At"))
@@ -54,6 +56,11 @@ class Product(models.Model):
     class Meta:
         verbose_name = _("Product")
         verbose_name_plural = _("Products")
+        indexes = [
+            # Catalogue sorts, walked by the keyset pagination
+            models.Index(fields=['created_at', 'id'], condition=models.Q(is_active=True), name='product_active_created_idx'),
+            models.Index(fields=['price', 'id'], condition=models.Q(is_active=True), name='product_active_price_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -69,6 +76,30 @@ class Product(models.Model):
     def effective_price(self):
         return self.discount_price if self.discount_price is not None else self.price
 
+    def resolve_primary_image_url(self):
+        """
+        URL of the image shown for the product: the uploaded image, the image
+        URL, or else the first gallery image. Stored in primary_image_url.
+        """
+        if self.image:
+            return self.image.url
+        if self.image_url:
+            return self.image_url
+        if self.pk:
+            # Uses prefetched images when there are any
+            first = self.images.all()[:1]
+            if first:
+                return first[0].image.url if first[0].image else first[0].image_url
+        return ''
+
+    def refresh_primary_image_url(self):
+        """Store the current primary image URL if it changed."""
+        url = self.resolve_primary_image_url()
+        if url != self.primary_image_url:
+            self.primary_image_url = url
+            self.updated_at = timezone.now()
+            Product.objects.filter(pk=self.pk).update(primary_image_url=url, updated_at=self.updated_at)
+
     def __str__(self):
         return self.name
 
@@ -176,11 +207,26 @@ class Order(models.Model):
     def __str__(self):
         return f'{self.order_number} - {self.customer_name}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The status as stored, for the status transitions in store.signals
+        if 'status' in instance.__dict__:
+            instance._saved_status = instance.status
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        # A partial refresh, such as a deferred field load, keeps the pending status
+        if 'status' in self.__dict__ and (fields is None or 'status' in fields):
+            self._saved_status = self.status
+
     def save(self, *args, **kwargs):
         if not self.order_number:
             dt = self.created_at or timezone.now()
             self.order_number = f"ORD-{dt.strftime('%Y%m%d')}-{uuid.uuid4().hex[:6].upper()}"
         super().save(*args, **kwargs)
+        self._saved_status = self.status
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE, verbose_name=_("Order"))
@@ -319,6 +365,18 @@ class Wishlist(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.product.name}"
 
+class CacheVersion(models.Model):
+    """Version counters of store.cache, when the cache itself cannot count atomically."""
+    name = models.CharField(max_length=50, unique=True, verbose_name=_("Name"))
+    number = models.BigIntegerField(default=0, verbose_name=_("Number"))
+
+    class Meta:
+        verbose_name = _("Cache Version")
+        verbose_name_plural = _("Cache Versions")
+
+    def __str__(self):
+        return f"{self.name}: {self.number}"
+
 class SalesDashboard(models.Model):
     class Meta:
         managed = False
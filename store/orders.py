@@ -0,0 +1,50 @@
+"""
+Order assembly for checkout.
+
+assemble_order() builds the order and its items in memory from the cart
+lines and works out the totals once; save_order() writes the order, then all
+its items and notes with bulk_create(), in one transaction. bulk_create()
+does not send post_save, so the update_order_total signal handler (which
+re-aggregates the items on every save) only runs for items edited in the
+admin.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+
+from .models import Order, OrderItem, OrderNote
+
+
+def assemble_order(lines, products, coupon=None, **fields):
+    """
+    An unsaved Order for the cart `lines` (see Cart.lines()) with its
+    unsaved items, priced at the lines' prices and discounted by `coupon`.
+    `products` maps product ids to products (see stock.reserve_stock);
+    `fields` are the Order's other fields.
+    """
+    order = Order(coupon=coupon, **fields)
+    items = []
+    total = Decimal('0')
+    for line in lines:
+        items.append(OrderItem(
+            order=order, product=products[line.id], unit_price=line.price, quantity=line.qty, subtotal=line.subtotal,
+        ))
+        total += line.subtotal
+
+    discount = coupon.calculate_discount(total) if coupon else Decimal('0')
+    discount = min(discount, total)
+    order.discount_amount = discount
+    order.total_amount = total - discount
+    return order, items
+
+
+def save_order(order, items, notes=()):
+    """Insert an assembled order with its items and note messages."""
+    with transaction.atomic():
+        order.save()
+        for item in items:
+            # Picks up the primary key the order got on insert
+            item.order = order
+        OrderItem.objects.bulk_create(items)
+        OrderNote.objects.bulk_create([OrderNote(order=order, message=message) for message in notes])
+    return order
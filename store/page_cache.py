@@ -0,0 +1,215 @@
+"""
+Full-page cache for anonymous visitors.
+
+Pages decorated with @anonymous_page_cache are stored in the shared cache per
+path, language, 'content' version (bumped by the signal handlers in
+store.signals whenever products, pages, categories, hero slides or the site
+settings change) and, for views that read the query string, the parameters
+they read, normalised to what the page shows (see `key_params`). Other
+parameters, such as campaign tags, share the same entry; requests whose
+values no link produces, or that are free-text searches, are not cached, so
+they cannot push the real pages out of the cache. Requests from logged-in users, with items in
+the session cart or with flash messages pending are passed straight to the
+view, and so are responses that set cookies or messages.
+
+The CSRF token of a cached page's forms is swapped for a placeholder when
+the page is stored and for the visitor's own token when it is served.
+
+Responses carry an ETag (a digest of the cached body, or the view's own, see
+visitor_etag()) and a Last-Modified from the newest content behind the
+page, so conditional GETs get a 304. Hits, misses and bypasses are reported in an
+X-Page-Cache header and counted per process, the counts being added to the
+shared cache every STATS_FLUSH_INTERVAL seconds (see get_stats()).
+"""
+import functools
+import hashlib
+import json
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils import translation
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag, urlencode
+
+from .cache import get_version
+
+CSRF_PLACEHOLDER = '__store_page_cache_csrf_token__'
+_csrf_input_re = re.compile(r'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+
+COUNTERS = ('hit', 'miss', 'bypass')
+
+
+# Seconds between writes of a process's counts to the shared cache: writing
+# on every request would cost more than a hit (the file cache culls its
+# directory on each write)
+STATS_FLUSH_INTERVAL = 30
+
+_pending = dict.fromkeys(COUNTERS, 0)
+_pending_lock = threading.Lock()
+_flushed_at = time.monotonic()
+
+
+def _count(counter):
+    global _flushed_at
+    with _pending_lock:
+        _pending[counter] += 1
+        now = time.monotonic()
+        if now - _flushed_at < STATS_FLUSH_INTERVAL:
+            return
+        pending = dict(_pending)
+        _pending.update(dict.fromkeys(COUNTERS, 0))
+        _flushed_at = now
+    _flush(pending)
+
+
+def _flush(pending):
+    for counter, count in pending.items():
+        if not count:
+            continue
+        key = f'store_page_cache_{counter}'
+        if not cache.add(key, count, None):
+            try:
+                cache.incr(key, count)
+            except ValueError:
+                cache.set(key, count, None)
+
+
+def get_stats():
+    """
+    {'hit': n, 'miss': n, 'bypass': n}: the counts other workers have
+    written to the shared cache so far, plus this process's own.
+    """
+    values = cache.get_many([f'store_page_cache_{counter}' for counter in COUNTERS])
+    with _pending_lock:
+        return {counter: values.get(f'store_page_cache_{counter}', 0) + _pending[counter] for counter in COUNTERS}
+
+
+def reset_stats():
+    with _pending_lock:
+        _pending.update(dict.fromkeys(COUNTERS, 0))
+    cache.delete_many([f'store_page_cache_{counter}' for counter in COUNTERS])
+
+
+def is_anonymous_visitor(request):
+    """
+    True for a visitor who sees the pages everyone sees: not logged in, an
+    empty cart and no flash messages pending (they would be rendered into
+    the page).
+    """
+    if request.user.is_authenticated or request.session.get('cart'):
+        return False
+    return not len(get_messages(request))
+
+
+def is_cacheable_request(request):
+    if not getattr(settings, 'STORE_PAGE_CACHE', True):
+        return False
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    return is_anonymous_visitor(request)
+
+
+def visitor_etag(request, *parts):
+    """
+    ETag for a page built from `parts` (e.g. the object's updated_at) plus
+    everything else it shows: the language, the shared content (site
+    settings, categories, ...) and the visitor's user and cart. None while
+    flash messages are pending.
+    """
+    if len(get_messages(request)):
+        return None
+    state = [*parts, translation.get_language(), get_version('content')]
+    if request.user.is_authenticated:
+        state.append(request.user.pk)
+    cart = request.session.get('cart')
+    if cart:
+        state.append(json.dumps(cart, sort_keys=True))
+    return hashlib.md5(repr(state).encode('utf-8')).hexdigest()
+
+
+def is_cacheable_response(request, response):
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return False
+    messages = get_messages(request)
+    return not (request.session.modified or getattr(messages, 'used', False) or len(messages))
+
+
+def _cache_key(request, params, tag=None):
+    query = urlencode(params)
+    # The view's own ETag, if it has one, so that a change it sees (such as
+    # a product's updated_at moved by a checkout) is a different entry
+    digest = hashlib.md5(f'{request.path}?{query}#{tag or ""}'.encode('utf-8')).hexdigest()
+    return f'store_page_{get_version("content")}_{translation.get_language()}_{digest}'
+
+
+def _finish(request, response, entry, status):
+    response['ETag'] = entry['etag']
+    if entry['last_modified']:
+        response['Last-Modified'] = http_date(entry['last_modified'])
+    response['X-Page-Cache'] = status
+    _count(status.lower())
+    return get_conditional_response(
+        request, etag=entry['etag'], last_modified=entry['last_modified'], response=response,
+    )
+
+
+def anonymous_page_cache(last_modified=None, etag=None, key_params=None):
+    """
+    Serve the view from the page cache for anonymous visitors.
+    `last_modified(request, *args, **kwargs)` returns the datetime of the
+    newest content behind the page (or None); `etag(request, *args,
+    **kwargs)` the page's ETag, by default a digest of the body. An entry is
+    only served while the view's ETag is unchanged. `key_params(request)`
+    returns the [(name, value)] query parameters the page varies on, or None
+    not to cache the request; without it the query string is ignored.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            params = None
+            if is_cacheable_request(request):
+                params = key_params(request) if key_params else []
+            if params is None:
+                response = view(request, *args, **kwargs)
+                response['X-Page-Cache'] = 'BYPASS'
+                _count('bypass')
+                return response
+
+            tag = etag(request, *args, **kwargs) if etag else None
+            key = _cache_key(request, params, tag)
+            entry = cache.get(key)
+            if entry is not None:
+                content = entry['content']
+                if CSRF_PLACEHOLDER in content:
+                    content = content.replace(CSRF_PLACEHOLDER, get_token(request))
+                response = HttpResponse(content, content_type=entry['content_type'])
+                return _finish(request, response, entry, 'HIT')
+
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render') and callable(response.render):
+                response = response.render()
+            if not is_cacheable_response(request, response):
+                response['X-Page-Cache'] = 'BYPASS'
+                _count('bypass')
+                return response
+
+            content = response.content.decode(response.charset)
+            if request.META.get('CSRF_COOKIE_NEEDS_UPDATE'):
+                content = _csrf_input_re.sub(rf'\g<1>{CSRF_PLACEHOLDER}\g<2>', content)
+            modified = last_modified(request, *args, **kwargs) if last_modified else None
+            entry = {
+                'content': content,
+                'content_type': response['Content-Type'],
+                'etag': quote_etag(tag or hashlib.md5(content.encode('utf-8')).hexdigest()),
+                'last_modified': int(modified.timestamp()) if modified else None,
+            }
+            cache.set(key, entry, getattr(settings, 'STORE_PAGE_CACHE_TIMEOUT', 60 * 60))
+            return _finish(request, response, entry, 'MISS')
+        return wrapper
+    return decorator
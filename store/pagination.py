@@ -0,0 +1,170 @@
+"""
+Catalogue pagination.
+
+CachedCountPaginator keeps the total of a filtered queryset in the shared
+cache under the 'facets' version (bumped on every product change), so paging
+through a listing runs the COUNT(*) once rather than on every page.
+
+KeysetPaginator adds seek pagination for listings sorted on a column plus
+the primary key, e.g. ('-created_at', '-id') or ('price', 'id'). Each page
+carries signed, opaque `next_cursor` / `previous_cursor` tokens holding the
+sort values of its last / first product; following one fetches the adjacent
+page with a WHERE on those values instead of an OFFSET, so deep pages cost
+the same as the first. Numbered links still use the page number (and the
+cached count), which the tokens carry along for the elided page range.
+"""
+import hashlib
+
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Page, Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from .cache import get_version
+
+COUNT_TIMEOUT = 60 * 10
+
+CURSOR_SALT = 'store.pagination.cursor'
+
+
+def cached_count(queryset, timeout=COUNT_TIMEOUT):
+    """queryset.count(), cached until the next product change."""
+    digest = hashlib.md5(str(queryset.query).encode('utf-8')).hexdigest()
+    key = f'store_count_{get_version("facets")}_{digest}'
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+
+    @cached_property
+    def count(self):
+        return cached_count(self.object_list)
+
+
+class KeysetPage(Page):
+
+    def __init__(self, object_list, number, paginator, has_previous=None, has_next=None):
+        super().__init__(object_list, number, paginator)
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def has_previous(self):
+        if self._has_previous is not None:
+            return self._has_previous
+        return super().has_previous()
+
+    def has_next(self):
+        if self._has_next is not None:
+            return self._has_next
+        return super().has_next()
+
+    def next_page_number(self):
+        return min(self.number + 1, self.paginator.num_pages)
+
+    def previous_page_number(self):
+        return max(self.number - 1, 1)
+
+    @cached_property
+    def next_cursor(self):
+        if not self.has_next() or not self.object_list:
+            return None
+        return self.paginator.make_cursor(self.object_list[-1], 'next', self.number + 1)
+
+    @cached_property
+    def previous_cursor(self):
+        if not self.has_previous() or not self.object_list:
+            return None
+        return self.paginator.make_cursor(self.object_list[0], 'previous', self.number - 1)
+
+
+def is_cursor(token):
+    """True for a cursor token this site signed (it may still be stale)."""
+    try:
+        signing.loads(token, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+class KeysetPaginator(CachedCountPaginator):
+    """
+    Paginator over `object_list` ordered by `ordering`, a list of field names
+    (with '-' for descending) that ends with a unique field.
+    """
+
+    def __init__(self, object_list, per_page, ordering, **kwargs):
+        self.ordering = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+        self.fields = [object_list.model._meta.get_field(name) for name, descending in self.ordering]
+        super().__init__(object_list.order_by(*ordering), per_page, **kwargs)
+
+    def _get_page(self, *args, **kwargs):
+        return KeysetPage(*args, **kwargs)
+
+    def make_cursor(self, obj, direction, number):
+        values = [field.value_to_string(obj) for field in self.fields]
+        return signing.dumps({'v': values, 'd': direction, 'p': number, 'o': self._signature()}, salt=CURSOR_SALT)
+
+    def _signature(self):
+        return ','.join(f'{"-" if descending else ""}{name}' for name, descending in self.ordering)
+
+    def read_cursor(self, cursor):
+        """(values, direction, page number) from a token, or None if it is invalid."""
+        try:
+            data = signing.loads(cursor, salt=CURSOR_SALT)
+            if data['o'] != self._signature() or data['d'] not in ('next', 'previous'):
+                return None
+            values = [field.to_python(value) for field, value in zip(self.fields, data['v'], strict=True)]
+            return values, data['d'], int(data['p'])
+        except (signing.BadSignature, ValidationError, KeyError, TypeError, ValueError):
+            return None
+
+    def _seek_condition(self, values, forward):
+        """Rows after (`forward`) or before the row with the given sort values."""
+        condition = Q()
+        for i, ((name, descending), value) in enumerate(zip(self.ordering, values)):
+            lookup = 'lt' if descending == forward else 'gt'
+            step = Q(**{f'{name}__{lookup}': value})
+            for (previous, _), previous_value in zip(self.ordering[:i], values[:i]):
+                step &= Q(**{previous: previous_value})
+            condition |= step
+        # The same bound on the leading column alone, which an index on it
+        # can use as a range
+        name, descending = self.ordering[0]
+        lookup = 'lte' if descending == forward else 'gte'
+        return Q(**{f'{name}__{lookup}': values[0]}) & condition
+
+    def seek(self, cursor):
+        """The page a cursor token points at, or None for an invalid token."""
+        parsed = self.read_cursor(cursor)
+        if parsed is None:
+            return None
+        values, direction, number = parsed
+        forward = direction == 'next'
+        queryset = self.object_list.filter(self._seek_condition(values, forward))
+        if not forward:
+            queryset = queryset.reverse()
+        rows = list(queryset[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if not forward:
+            rows.reverse()
+        if not rows:
+            return None
+        number = max(1, min(number, self.num_pages))
+        if forward:
+            return self._get_page(rows, number, self, has_previous=True, has_next=more)
+        return self._get_page(rows, number, self, has_previous=more, has_next=True)
+
+    def get_page(self, number, cursor=None):
+        page = self.seek(cursor) if cursor else None
+        if page is None:
+            page = super().get_page(number)
+            # Fetch the rows now so the cursors can be taken from them
+            page.object_list = list(page.object_list)
+        return page
@@ -0,0 +1,299 @@
+"""
+Product search.
+
+On SQLite the active products are indexed in an FTS5 table with one row per
+product and language: the (fallback-aware) translated name, the SKU, the
+description and specs with their HTML stripped, and the names of the
+product's categories. A search matches all languages at once and returns
+product ids ranked by bm25, with the name weighted highest.
+
+Text is tokenized here rather than by FTS5, which would treat a whole run of
+Chinese characters as one word: CJK runs are split into overlapping bigrams
+(plus the run's last character, so that every character starts a token),
+while Latin words, numbers and SKU-like codes such as "LJ-M404dn" are kept
+whole, the code also being indexed joined up ("ljm404dn") and in parts.
+Queries are tokenized the same way, a CJK run becoming a phrase of its
+bigrams.
+
+The index is kept up to date by the signal handlers in store.signals and can
+be rebuilt with the `rebuild_search_index` command; until it exists (or if
+it cannot be read) searches fall back to BasicSearchBackend, the previous
+`icontains` search over every translated column, which other databases use
+all the time. STORE_SEARCH_BACKEND can point at a custom backend class.
+
+A search returns at most MAX_RESULTS products, the best matches; callers
+can ask for one more to tell whether the results were cut off.
+"""
+import contextlib
+import html
+import logging
+import re
+import threading
+import unicodedata
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Q
+from django.utils.html import strip_tags
+from django.utils.module_loading import import_string
+from modeltranslation.utils import build_localized_fieldname
+
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'store_product_fts'
+
+# Ids returned for one search at most
+MAX_RESULTS = 500
+
+CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_token_re = re.compile(
+    rf'(?P<cjk>[{CJK}]+)'
+    rf'|(?P<word>[^\W_{CJK}]+(?:[-_./][^\W_{CJK}]+)*)'
+)
+_code_separator_re = re.compile(r'[-_./]')
+
+
+def _bigrams(run):
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(text):
+    """
+    [(kind, tokens)] for each CJK run ('cjk', bigrams) or word ('word',
+    [word] or, for a code, [joined, part, part, ...]) in `text`.
+    """
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    tokens = []
+    for match in _token_re.finditer(text):
+        if match.group('cjk'):
+            tokens.append(('cjk', _bigrams(match.group('cjk'))))
+        else:
+            parts = _code_separator_re.split(match.group('word'))
+            tokens.append(('word', [''.join(parts)] + parts if len(parts) > 1 else parts))
+    return tokens
+
+
+def index_text(text):
+    """The space-separated tokens stored in the index for `text`."""
+    terms = []
+    for kind, tokens in tokenize(text):
+        terms.extend(tokens)
+        if kind == 'cjk' and len(tokens[-1]) > 1:
+            terms.append(tokens[-1][-1])
+    return ' '.join(terms)
+
+
+def get_languages():
+    return [code for code, name in settings.LANGUAGES]
+
+
+def localized(obj, field, language):
+    """
+    The value of a translated field in `language`, falling back to the other
+    languages the way the storefront displays it.
+    """
+    languages = get_languages()
+    for code in [language] + [code for code in languages if code != language]:
+        value = getattr(obj, build_localized_fieldname(field, code), None)
+        if value:
+            return value
+    return ''
+
+
+def html_to_text(value):
+    return ' '.join(html.unescape(strip_tags(value or '')).split())
+
+
+def product_documents(product, languages=None):
+    """[(language, name, sku, description, specs, categories)] for a product."""
+    categories = list(product.categories.all())
+    documents = []
+    for language in languages or get_languages():
+        documents.append((
+            language,
+            localized(product, 'name', language),
+            product.sku,
+            html_to_text(localized(product, 'description', language)),
+            html_to_text(localized(product, 'specs', language)),
+            ' '.join(localized(category, 'name', language) for category in categories),
+        ))
+    return documents
+
+
+class BasicSearchBackend:
+    """Unindexed search: `icontains` over every translated column."""
+
+    def search(self, query, limit=MAX_RESULTS):
+        condition = Q()
+        for language in get_languages():
+            for field in ('name', 'description', 'specs', 'categories__name'):
+                condition |= Q(**{f'{build_localized_fieldname(field, language)}__icontains': query})
+        return list(
+            Product.objects.filter(is_active=True).filter(condition)
+            .order_by('-created_at').values_list('pk', flat=True).distinct()[:limit]
+        )
+
+    def index_products(self, products):
+        pass
+
+    def remove_products(self, product_ids):
+        pass
+
+    def rebuild(self, products=None):
+        return 0
+
+
+class SqliteFTSBackend:
+    """FTS5 index of the active products, one row per product and language."""
+
+    # bm25 weights: product_id, language, name, sku, description, specs, categories
+    weights = (0, 0, 10.0, 8.0, 2.0, 1.0, 4.0)
+    tokenize = 'unicode61 remove_diacritics 2'
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    def create_table(self, cursor):
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5('
+            f'product_id UNINDEXED, language UNINDEXED, name, sku, description, specs, categories, '
+            f"tokenize = '{self.tokenize}')"
+        )
+
+    def drop_table(self, cursor):
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+    def document_rows(self, product):
+        return [
+            (product.pk, language) + tuple(index_text(text) for text in texts)
+            for language, *texts in product_documents(product)
+        ]
+
+    def index_products(self, products):
+        """(Re)index the given products; inactive ones are removed."""
+        products = list(products)
+        rows = []
+        for product in products:
+            if product.is_active:
+                rows.extend(self.document_rows(product))
+        with connections[self.using].cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE product_id = %s', [(p.pk,) for p in products])
+            cursor.executemany(f'INSERT INTO {FTS_TABLE} VALUES (%s, %s, %s, %s, %s, %s, %s)', rows)
+
+    def remove_products(self, product_ids):
+        with connections[self.using].cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE product_id = %s', [(pk,) for pk in product_ids])
+
+    def rebuild(self, products=None):
+        """
+        Recreate the index from scratch. `products` defaults to all active
+        products (a migration passes its historical model's queryset).
+        Returns the number of products indexed.
+        """
+        if products is None:
+            products = Product.objects.filter(is_active=True)
+        count = 0
+        with connections[self.using].cursor() as cursor:
+            self.drop_table(cursor)
+            self.create_table(cursor)
+            batch = []
+            for product in products.prefetch_related('categories').iterator(chunk_size=500):
+                batch.extend(self.document_rows(product))
+                count += 1
+                if len(batch) >= 1000:
+                    cursor.executemany(f'INSERT INTO {FTS_TABLE} VALUES (%s, %s, %s, %s, %s, %s, %s)', batch)
+                    batch = []
+            cursor.executemany(f'INSERT INTO {FTS_TABLE} VALUES (%s, %s, %s, %s, %s, %s, %s)', batch)
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+        return count
+
+    def match_expression(self, query):
+        """
+        All of the query's words (each allowed to be a prefix, codes in their
+        joined form) and CJK runs (as a phrase of bigrams, the last one
+        allowed to be a prefix so that a single character matches too).
+        """
+        terms = []
+        for kind, tokens in tokenize(query):
+            if kind == 'cjk':
+                terms.append('"%s"*' % ' '.join(tokens))
+            else:
+                terms.append(f'"{tokens[0]}"*')
+        return ' '.join(terms)
+
+    def search(self, query, limit=MAX_RESULTS):
+        expression = self.match_expression(query)
+        if not expression:
+            return []
+        weights = ', '.join(str(weight) for weight in self.weights)
+        connection = connections[self.using]
+        # Outside a transaction the read needs none: BEGIN would take the
+        # write lock (transaction_mode IMMEDIATE) and queue the search behind
+        # checkouts. Inside one, a savepoint lets the fallback run after an
+        # error.
+        atomic = transaction.atomic(using=self.using) if connection.in_atomic_block else contextlib.nullcontext()
+        try:
+            with atomic, connection.cursor() as cursor:
+                cursor.execute(
+                    f'SELECT product_id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+                    f'ORDER BY bm25({FTS_TABLE}, {weights}) LIMIT %s',
+                    [expression, limit * len(get_languages())],
+                )
+                # A product can match once per language; keep its best rank
+                ids = dict.fromkeys(row[0] for row in cursor.fetchall())
+        except DatabaseError:
+            # Typically the index has not been built yet
+            logger.exception("Product search index unavailable, searching without it; run rebuild_search_index")
+            return BasicSearchBackend().search(query, limit)
+        return list(ids)[:limit]
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                custom = getattr(settings, 'STORE_SEARCH_BACKEND', None)
+                if custom:
+                    _backend = import_string(custom)()
+                elif connections['default'].vendor == 'sqlite':
+                    _backend = SqliteFTSBackend()
+                else:
+                    _backend = BasicSearchBackend()
+    return _backend
+
+
+def search_products(query, limit=MAX_RESULTS):
+    """Ids of the active products matching `query`, best match first."""
+    return get_backend().search(query, limit)
+
+
+def index_products(products):
+    """Bring the index up to date for products that were saved or recategorised."""
+    try:
+        with transaction.atomic():
+            get_backend().index_products(products)
+    except DatabaseError:
+        # Never fail an admin save over the search index; the
+        # rebuild_search_index command repairs it.
+        logger.exception("Failed to update the product search index")
+
+
+def remove_products(product_ids):
+    try:
+        with transaction.atomic():
+            get_backend().remove_products(product_ids)
+    except DatabaseError:
+        logger.exception("Failed to update the product search index")
+
+
+def rebuild_index():
+    return get_backend().rebuild()
@@ -49,49 +49,43 @@ from django.db.models.signals import pre_save, post_save, post_delete
 from django.db.models import Sum
 from .models import Order, OrderItem, UserProfile
 
+CLOSED_STATUSES = ['canceled', 'refunded', 'returned']
+
 @receiver(pre_save, sender=Order)
-def restore_stock_on_cancel(sender, instance, **kwargs):
-    if not instance.pk:
+def apply_status_transition(sender, instance, update_fields=None, raw=False, **kwargs):
+    """
+    When an order's status changes: give its stock back on cancellation
+    (take it again if re-opened) and log the change in an order note. The
+    previous status comes from the instance as loaded (see Order.from_db),
+    so saves that leave the status alone cost no queries.
+    """
+    from .models import OrderNote
+    from .stock import adjust_order_stock
+
+    if raw or not instance.pk or (update_fields is not None and 'status' not in update_fields):
         return
-        
     try:
-        old_order = Order.objects.get(pk=instance.pk)
-    except Order.DoesNotExist:
+        previous = instance._saved_status
+    except AttributeError:
+        previous = Order.objects.filter(pk=instance.pk).values_list('status', flat=True).first()
+        if previous is None:
+            return
+    if instance.status == previous:
         return
-        
+
     # If changing TO canceled/refunded/returned FROM valid status
-    if instance.status in ['canceled', 'refunded', 'returned'] and old_order.status not in ['canceled', 'refunded', 'returned']:
-        for item in instance.items.all():
-            product = item.product
-            product.stock += item.quantity
-            product.save()
-            
+    if instance.status in CLOSED_STATUSES and previous not in CLOSED_STATUSES:
+        adjust_order_stock(instance, 1)
     # If changing FROM canceled/refunded/returned TO valid status (re-opening order)
-    elif old_order.status in ['canceled', 'refunded', 'returned'] and instance.status not in ['canceled', 'refunded', 'returned']:
-        for item in instance.items.all():
-            product = item.product
-            # Allow stock to go negative if manually re-opened by admin
-            product.stock -= item.quantity
-            product.save()
+    elif previous in CLOSED_STATUSES and instance.status not in CLOSED_STATUSES:
+        adjust_order_stock(instance, -1)
 
-@receiver(pre_save, sender=Order)
-def log_status_change(sender, instance, **kwargs):
-    from .models import OrderNote
-    
-    if not instance.pk:
-        return
-        
-    try:
-        old_order = Order.objects.get(pk=instance.pk)
-    except Order.DoesNotExist:
-        return
-        
-    if instance.status != old_order.status:
-        message = f"Order status changed from '{old_order.get_status_display()}' to '{instance.get_status_display()}'."
-        OrderNote.objects.create(
-            order=instance,
-            message=message
-        )
+    previous_display = dict(Order.STATUS_CHOICES).get(previous, previous)
+    message = f"Order status changed from '{previous_display}' to '{instance.get_status_display()}'."
+    OrderNote.objects.create(
+        order=instance,
+        message=message
+    )
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -128,3 +122,104 @@ def update_order_total(sender, instance, **kwargs):
         # So we should include 'updated_at' if we want it updated, but Order model has auto_now=True for updated_at.
         # To be safe and simple, just save().
         order.save(update_fields=['total_amount', 'updated_at'])
+
+from django.db.models.signals import m2m_changed
+from .cache import bump_version
+from .models import Category, HeroSlide, Page, Product, ProductImage, SiteSettings
+
+@receiver([post_save, post_delete], sender=SiteSettings)
+@receiver([post_save, post_delete], sender=HeroSlide)
+def invalidate_site_snapshot(sender, **kwargs):
+    """Make every worker re-read SiteSettings and the hero slides."""
+    bump_version('site')
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category_snapshot(sender, **kwargs):
+    bump_version('categories')
+    bump_version('facets')
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_category_facets(sender, **kwargs):
+    """Products were added, removed, (de)activated or re-categorised."""
+    bump_version('facets')
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def invalidate_category_facets_m2m(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version('facets')
+
+@receiver([post_save, post_delete], sender=SiteSettings)
+@receiver([post_save, post_delete], sender=HeroSlide)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductImage)
+@receiver([post_save, post_delete], sender=Page)
+def invalidate_fragments(sender, **kwargs):
+    """
+    Re-render the cached template fragments (see
+    context_processors.fragment_cache) and pages (see store.page_cache).
+    """
+    bump_version('content')
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_autocomplete(sender, **kwargs):
+    """Make every worker refresh its autocomplete trie (see store.autocomplete)."""
+    bump_version('autocomplete')
+
+from django.db.models.signals import pre_delete
+from . import search
+
+@receiver(post_save, sender=Product)
+def index_saved_product(sender, instance, **kwargs):
+    search.index_products([instance])
+
+@receiver(post_delete, sender=Product)
+def unindex_deleted_product(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def index_recategorised_products(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        search.index_products([instance])
+    elif pk_set:
+        search.index_products(Product.objects.filter(pk__in=pk_set).prefetch_related('categories'))
+    else:
+        # post_clear from the category side does not say which products
+        search.rebuild_index()
+
+@receiver(post_save, sender=Category)
+def index_category_products(sender, instance, created, **kwargs):
+    if not created:
+        search.index_products(instance.products.prefetch_related('categories'))
+
+@receiver(pre_delete, sender=Category)
+def remember_category_products(sender, instance, **kwargs):
+    instance._product_ids = list(instance.products.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Category)
+def index_uncategorised_products(sender, instance, **kwargs):
+    product_ids = getattr(instance, '_product_ids', None)
+    if product_ids:
+        search.index_products(Product.objects.filter(pk__in=product_ids).prefetch_related('categories'))
+
+
+@receiver(post_save, sender=Product)
+def refresh_primary_image(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Keep Product.primary_image_url in step with image and image_url."""
+    if raw:
+        return
+    if update_fields is not None and not {'image', 'image_url'} & set(update_fields):
+        return
+    instance.refresh_primary_image_url()
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def refresh_gallery_primary_image(sender, instance, raw=False, **kwargs):
+    """The first gallery image is the fallback primary image."""
+    if raw:
+        return
+    product = Product.objects.filter(pk=instance.product_id).first()
+    if product is not None:
+        product.refresh_primary_image_url()
@@ -0,0 +1,82 @@
+"""
+Stock reservation for checkout, and its return when an order is cancelled.
+
+reserve_stock() takes every line of an order in one transaction: the products
+are read in a single query and each line is taken with a conditional UPDATE
+(`stock >= qty`), so two checkouts racing for the last units can never both
+succeed. If any line cannot be filled, nothing is taken and InsufficientStock
+lists every line that failed.
+
+The UPDATEs bypass Product.save() and its signals. No cached page, fragment,
+count or cart detail shows stock levels, so no cache version is bumped: a
+checkout only moves the products' `updated_at`, and with it the conditional
+GET validators of those products' pages.
+"""
+from dataclasses import dataclass
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.utils import timezone
+
+from .models import OrderItem, Product
+
+
+@dataclass
+class StockShortage:
+    product_id: int
+    name: str
+    requested: int
+    available: int
+
+
+class InsufficientStock(Exception):
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__(', '.join(f'{s.name or s.product_id} ({s.requested} > {s.available})' for s in shortages))
+
+
+def reserve_stock(quantities):
+    """
+    Take `quantities` ({product id: qty}) out of stock atomically and return
+    the products, {id: Product}. Raises InsufficientStock, having taken
+    nothing, when a product is missing or short. Joins the caller's
+    transaction, so the stock is given back if the order fails later on.
+    """
+    quantities = {int(pid): int(qty) for pid, qty in quantities.items()}
+    with transaction.atomic():
+        products = Product.objects.in_bulk(list(quantities))
+        shortages = []
+        # In id order, so concurrent checkouts lock rows in the same order
+        for pid, qty in sorted(quantities.items()):
+            if pid not in products:
+                shortages.append(StockShortage(pid, '', qty, 0))
+                continue
+            taken = Product.objects.filter(pk=pid, stock__gte=qty).update(
+                stock=F('stock') - qty, updated_at=timezone.now(),
+            )
+            if not taken:
+                shortages.append(StockShortage(pid, products[pid].name, qty, 0))
+        if shortages:
+            short = [s.product_id for s in shortages if s.product_id in products]
+            available = dict(Product.objects.filter(pk__in=short).values_list('pk', 'stock'))
+            for shortage in shortages:
+                shortage.available = available.get(shortage.product_id, 0)
+            raise InsufficientStock(shortages)
+    for pid, product in products.items():
+        product.stock -= quantities[pid]
+    return products
+
+
+def adjust_order_stock(order, sign):
+    """
+    Put the quantities of `order`'s items back into stock (`sign` 1) or take
+    them out again (-1), in one UPDATE.
+    """
+    quantities = (
+        OrderItem.objects.filter(order=order, product=OuterRef('pk'))
+        .values('product').annotate(total=Sum('quantity')).values('total')
+    )
+    Product.objects.filter(pk__in=OrderItem.objects.filter(order=order).values('product')).update(
+        stock=F('stock') + sign * Subquery(quantities), updated_at=timezone.now(),
+    )
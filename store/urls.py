@@ -4,6 +4,7 @@ from . import views
 urlpatterns = [
     path('', views.product_list, name='product_list'),
     path('shop/', views.product_list, {'is_shop': True}, name='shop'),
+    path('search/autocomplete/', views.autocomplete, name='autocomplete'),
     path('product/<slug:slug>/', views.product_detail, name='product_detail'),
     path('cart/', views.cart_view, name='cart_view'),
     path('cart/add/<int:product_id>/', views.cart_add, name='cart_add'),
@@ -1,15 +1,28 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.urls import reverse
 from django.utils.translation import gettext as _
-from .models import Product, Order, OrderItem, Coupon, PaymentMethod, OrderNote, UserProfile, HeroSlide, Page, Wishlist
+from .models import Product, Order, OrderItem, Coupon, PaymentMethod, OrderNote, UserProfile, Page, Wishlist
+from .cache import get_categories, get_changed_at, get_hero_slides
+from .catalogue import catalogue_cards
+from .facets import get_category_facets
+from .pagination import CachedCountPaginator, KeysetPaginator, is_cursor
+from .page_cache import anonymous_page_cache, is_anonymous_visitor, visitor_etag
+from .search import MAX_RESULTS as MAX_SEARCH_RESULTS, search_products
+from .stock import InsufficientStock, reserve_stock
+from .cart import get_cart
+from .orders import assemble_order, save_order
+from .autocomplete import suggest
 from decimal import Decimal
 from django.utils import timezone
 from .forms import CouponApplyForm, RegisterForm
 from django.contrib import messages
 from django.contrib.auth import login
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.http import HttpResponse, JsonResponse
+from django.utils.cache import patch_cache_control
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
 
 @csrf_exempt
 def stripe_webhook(request):
@@ -53,7 +66,7 @@ def stripe_webhook(request):
 
     return HttpResponse(status=200)
 
-from django.db.models import Q, Count
+from django.db.models import Case, When, Value, Prefetch, Max
 from django.conf import settings
 import stripe
 
@@ -92,17 +105,106 @@ def coupon_apply(request):
         
     return redirect('cart_view')
 
+def _catalogue_last_modified(request, *args, **kwargs):
+    # Besides the products (inactive ones too: hiding one changes the
+    # listing), the page shows the categories, hero slides and site settings
+    changed_at = get_changed_at('content', 'categories', 'site')
+    if changed_at is None:
+        return None
+    latest = Product.objects.aggregate(latest=Max('updated_at'))['latest']
+    return max(latest, changed_at) if latest else changed_at
+
+def _updated_at(request, model, slug):
+    # Looked up once per request for both validators
+    if not hasattr(request, '_updated_at'):
+        request._updated_at = {}
+    memo = request._updated_at
+    if (model, slug) not in memo:
+        memo[model, slug] = model.objects.filter(slug=slug, is_active=True).values_list('updated_at', flat=True).first()
+    return memo[model, slug]
+
+# Validators for conditional GETs. Last-Modified only stands for the object
+# and the shared content, so it is only sent to visitors who see nothing of
+# their own (user bar, cart, wishlist); for the others the ETag covers all of
+# it.
+
+def _detail_last_modified(request, model, slug):
+    if not is_anonymous_visitor(request):
+        return None
+    updated_at = _updated_at(request, model, slug)
+    # The page also shows the site settings, categories and footer; while
+    # it is not known when those last changed, there is no Last-Modified
+    changed_at = get_changed_at('content', 'categories', 'site')
+    if updated_at is None or changed_at is None:
+        return None
+    return max(updated_at, changed_at)
+
+def _product_last_modified(request, slug):
+    return _detail_last_modified(request, Product, slug)
+
+def _product_etag(request, slug):
+    updated_at = _updated_at(request, Product, slug)
+    if updated_at is None:
+        return None
+    wishlisted = request.user.is_authenticated and Wishlist.objects.filter(user=request.user, product__slug=slug).exists()
+    return visitor_etag(request, 'product', slug, updated_at.isoformat(), wishlisted)
+
+def _page_last_modified(request, slug='tutorial'):
+    return _detail_last_modified(request, Page, slug)
+
+def _page_etag(request, slug):
+    updated_at = _updated_at(request, Page, slug)
+    if updated_at is None:
+        return None
+    return visitor_etag(request, 'page', slug, updated_at.isoformat())
+
+CATALOGUE_SORTS = ('default', 'price_low', 'price_high')
+GRID_COLUMNS = ('2', '3', '4')
+PER_PAGE_CHOICES = (9, 12, 18, 24)
+
+def _per_page(value):
+    try:
+        per_page = int(value)
+    except (TypeError, ValueError):
+        return PER_PAGE_CHOICES[0]
+    return per_page if per_page in PER_PAGE_CHOICES else PER_PAGE_CHOICES[0]
+
+def _catalogue_cache_params(request):
+    # The parameters product_list shows, as it reads them. Searches and
+    # values no link produces (unknown categories, made-up sorts or cursors)
+    # are not cached: each would take a cache entry of its own.
+    params = request.GET
+    if params.get('q'):
+        return None
+    category = params.get('category', '')
+    sort = params.get('sort', 'default')
+    cols = params.get('cols', '3')
+    page = params.get('page', '')
+    cursor = params.get('cursor', '')
+    if sort not in CATALOGUE_SORTS or cols not in GRID_COLUMNS or not (page == '' or page.isdigit()):
+        return None
+    if category and category not in {c.name for c in get_categories()}:
+        return None
+    if cursor and not is_cursor(cursor):
+        return None
+    return [('category', category), ('sort', sort), ('cols', cols),
+            ('per_page', _per_page(params.get('per_page'))), ('page', page), ('cursor', cursor)]
+
+@anonymous_page_cache(_catalogue_last_modified, key_params=_catalogue_cache_params)
 def product_list(request, is_shop=False):
-    products = Product.objects.filter(is_active=True)
+    products = catalogue_cards(Product.objects.filter(is_active=True), categories=False)
     
     # Search functionality
     query = request.GET.get('q')
+    search_capped = False
     if query:
-        products = products.filter(
-            Q(name__icontains=query) | 
-            Q(description__icontains=query) |
-            Q(categories__name__icontains=query)
-        ).distinct()
+        # Ranked ids from the search index (see store.search); one more
+        # than are shown tells whether there were too many matches
+        search_ids = search_products(query, MAX_SEARCH_RESULTS + 1)
+        search_capped = len(search_ids) > MAX_SEARCH_RESULTS
+        search_ids = search_ids[:MAX_SEARCH_RESULTS]
+        products = products.filter(pk__in=search_ids)
+    search_results = products
     
     # Filter by category
     category_filter = request.GET.get('category')
@@ -111,39 +213,43 @@ def product_list(request, is_shop=False):
         
     # Sorting Logic
     sort_by = request.GET.get('sort', 'default')
+    ordering = None
     if sort_by == 'price_low':
-        products = products.order_by('price')
+        ordering = ['price', 'id']
     elif sort_by == 'price_high':
-        products = products.order_by('-price')
+        ordering = ['-price', '-id']
+    elif query and search_ids:
+        # Best matches first
+        products = products.order_by(Case(*[When(pk=pk, then=Value(rank)) for rank, pk in enumerate(search_ids)]))
     else:
-        products = products.order_by('-created_at')
+        ordering = ['-created_at', '-id']
     
     # Grid Layout (Columns)
     grid_cols = request.GET.get('cols', '3')
     
-    # Get categories with count
-    # Old: Product.objects.filter(is_active=True).values('category').annotate(count=Count('id')).order_by('category')
-    # New: Query Category model directly
-    from .models import Category
-    from django.core.paginator import Paginator
-    categories = Category.objects.annotate(
-        count=Count('products', filter=Q(products__is_active=True))
-    ).filter(count__gt=0).order_by('name')
+    # Categories with their number of active products (of the search
+    # results when searching), from the cached facet counts
+    if query:
+        category_facets = get_category_facets(search_results, query)
+    else:
+        category_facets = get_category_facets()
     
-    hero_slides = HeroSlide.objects.filter(is_active=True)
+    hero_slides = get_hero_slides()
 
     # Pagination Logic
-    per_page = request.GET.get('per_page', '9') # Default to 9
-    try:
-        per_page = int(per_page)
-        if per_page not in [9, 12, 18, 24]:
-            per_page = 9
-    except ValueError:
-        per_page = 9
+    per_page = _per_page(request.GET.get('per_page'))
         
-    paginator = Paginator(products, per_page)
+    # Column sorts page with cursor tokens (see store.pagination); the
+    # search ranking only by page number. Either way the total is cached.
     page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    if ordering and getattr(settings, 'STORE_KEYSET_PAGINATION', True):
+        paginator = KeysetPaginator(products, per_page, ordering)
+        page_obj = paginator.get_page(page_number, request.GET.get('cursor'))
+    else:
+        if ordering:
+            products = products.order_by(*ordering)
+        paginator = CachedCountPaginator(products, per_page)
+        page_obj = paginator.get_page(page_number)
     
     # Elided pagination
     custom_page_range = paginator.get_elided_page_range(page_obj.number, on_each_side=2, on_ends=1)
@@ -156,7 +262,9 @@ def product_list(request, is_shop=False):
         'products': page_obj, 
         'custom_page_range': custom_page_range,
         'search_query': query,
-        'categories': categories,
+        'search_capped': search_capped,
+        'max_search_results': MAX_SEARCH_RESULTS,
+        'category_facets': category_facets,
         'current_category': category_filter,
         'is_shop_page': is_shop,
         'hero_slides': hero_slides,
@@ -167,10 +275,22 @@ def product_list(request, is_shop=False):
     })
 
 
+def autocomplete(request):
+    """Search-as-you-type suggestions for the search box, as JSON."""
+    query = request.GET.get('q', '')[:100]
+    response = JsonResponse(suggest(query))
+    # Suggestions are the same for everyone; let browsers and proxies reuse them
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'STORE_AUTOCOMPLETE_MAX_AGE', 60 * 5))
+    return response
+
+
+@condition(etag_func=_page_etag, last_modified_func=_page_last_modified)
+@anonymous_page_cache(_page_last_modified, _page_etag)
 def page_detail(request, slug):
     page = get_object_or_404(Page, slug=slug, is_active=True)
     return render(request, 'store/page_detail.html', {'page': page})
 
+@anonymous_page_cache(_page_last_modified)
 def tutorial(request):
     try:
         page = Page.objects.get(slug='tutorial', is_active=True)
@@ -179,6 +299,8 @@ def tutorial(request):
     return render(request, 'store/tutorial.html', {'page': page})
 
 
+@condition(etag_func=_product_etag, last_modified_func=_product_last_modified)
+@anonymous_page_cache(_product_last_modified, _product_etag)
 def product_detail(request, slug):
     product = get_object_or_404(Product, slug=slug, is_active=True)
     is_wishlisted = False
@@ -217,10 +339,6 @@ def wishlist_view(request):
     return render(request, 'store/wishlist.html', {'wishlist_items': wishlist_items})
 
 
-def _get_cart(session):
-    return session.setdefault('cart', {})
-
-
 def _get_client_ip(request):
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
     if x_forwarded_for:
@@ -240,48 +358,28 @@ def cart_add(request, product_id):
         # Redirect back to product detail or list
         return redirect(request.META.get('HTTP_REFERER', 'product_list'))
 
-    cart = _get_cart(request.session)
-    
-    # Determine image URL
-    img_url = ''
-    if product.image:
-        img_url = product.image.url
-    elif product.image_url:
-        img_url = product.image_url
-        
-    item = cart.get(str(product.id), {'name': product.name, 'price': str(product.effective_price()), 'qty': 0, 'image': img_url})
+    cart = get_cart(request)
     
     # Check if total quantity exceeds stock
-    new_qty = item['qty'] + qty
-    if product.stock < new_qty:
-        messages.error(request, _("Sorry, %(name)s is out of stock (current cart: %(qty)s, remaining: %(stock)s)") % {'name': product.name, 'qty': item['qty'], 'stock': product.stock})
+    in_cart = cart.quantity(product.id)
+    if product.stock < in_cart + qty:
+        messages.error(request, _("Sorry, %(name)s is out of stock (current cart: %(qty)s, remaining: %(stock)s)") % {'name': product.name, 'qty': in_cart, 'stock': product.stock})
         return redirect('cart_view')
         
-    item['qty'] = new_qty
-    item['image'] = img_url  # Ensure image is set/updated
-    cart[str(product.id)] = item
-    request.session.modified = True
+    cart.add(product.id, qty)
     messages.success(request, _("Added %(name)s to cart") % {'name': product.name})
     return redirect('cart_view')
 
 
 def cart_remove(request, product_id):
-    cart = _get_cart(request.session)
-    cart.pop(str(product_id), None)
-    request.session.modified = True
+    get_cart(request).remove(product_id)
     return redirect('cart_view')
 
 
 def cart_view(request):
-    cart = _get_cart(request.session)
-    items = []
-    total = Decimal('0')
-    for pid, item in cart.items():
-        price = Decimal(item['price'])
-        qty = int(item['qty'])
-        subtotal = price * qty
-        items.append({'id': int(pid), 'name': item['name'], 'price': price, 'qty': qty, 'subtotal': subtotal})
-        total += subtotal
+    cart = get_cart(request)
+    items = cart.lines()
+    total = cart.total
     
     # Coupon logic
     coupon_id = request.session.get('coupon_id')
@@ -312,7 +410,7 @@ def cart_view(request):
 
 @login_required
 def checkout(request):
-    cart = _get_cart(request.session)
+    cart = get_cart(request)
     if not cart:
         return redirect('product_list')
     
@@ -333,114 +431,74 @@ def checkout(request):
         notes = request.POST.get('notes', '').strip()
         payment_method_id = request.POST.get('payment_method')
         
-        # First check stock
-        for pid, item in cart.items():
-            product = get_object_or_404(Product, id=int(pid))
-            if product.stock < int(item['qty']):
-                from django.contrib import messages
-                messages.error(request, f"抱歉，{product.name} 庫存不足 (僅剩 {product.stock})，請調整數量。")
-                return redirect('cart_view')
-
         # Validate Payment Method BEFORE creating order
+        payment_method = None
         if payment_method_id:
             try:
-                pm_check = PaymentMethod.objects.get(id=payment_method_id)
-                if pm_check.code == 'credit_card' and not request.POST.get('stripe_payment_intent'):
+                payment_method = PaymentMethod.objects.get(id=payment_method_id)
+                if payment_method.code == 'credit_card' and not request.POST.get('stripe_payment_intent'):
                     messages.error(request, "信用卡付款未完成或失敗，請確認信用卡資訊並重試。")
                     return redirect('checkout')
             except PaymentMethod.DoesNotExist:
                 pass
 
-        # Create Order (initial)
-        ip_address = _get_client_ip(request)
-        order = Order.objects.create(
-            customer_name=name, email=email, phone=phone, address=address, notes=notes, status='created',
-            coupon=coupon, discount_amount=0, # Will update later
-            user=request.user if request.user.is_authenticated else None,
-            ip_address=ip_address
-        )
-        
         # Handle Payment Method
-        if payment_method_id:
-            try:
-                pm = PaymentMethod.objects.get(id=payment_method_id)
-                order.payment_method = pm
-                
-                # If Payment Method requires proof, check for file upload
-                if pm.requires_proof and 'payment_proof' in request.FILES:
-                    order.payment_proof = request.FILES['payment_proof']
-                    # Add a note that proof was uploaded
-                    OrderNote.objects.create(order=order, message=f"Customer uploaded payment proof ({pm.name} Receipt).")
-                # If Credit Card, capture masked info in order note (do not store card)
-                if pm.code == 'credit_card':
-                    intent_id = request.POST.get('stripe_payment_intent')
-                    if intent_id:
-                        OrderNote.objects.create(order=order, message=f"Stripe PaymentIntent confirmed: {intent_id}")
-                    else:
-                        # If no payment intent, and it's credit card, this is an invalid attempt (unless testing)
-                        # But since we already created the order, we should probably mark it as 'created' or 'cancelled' 
-                        # instead of 'paid'.
-                        # Better yet, prevent order creation if payment failed?
-                        # For now, let's just ensure status is NOT 'paid'
-                        pass
-                    
-            except PaymentMethod.DoesNotExist:
-                pass
-        
-        total = Decimal('0')
-        for pid, item in cart.items():
-            product = get_object_or_404(Product, id=int(pid))
-            price = Decimal(item['price'])
-            qty = int(item['qty'])
-            
-            # Deduct stock
-            product.stock -= qty
-            product.save()
-            
-            subtotal = price * qty
-            OrderItem.objects.create(order=order, product=product, unit_price=price, quantity=qty, subtotal=subtotal)
-            total += subtotal
-        
-        # Calculate Discount
-        discount = Decimal('0')
-        if coupon:
-            discount = coupon.calculate_discount(total)
+        payment_proof = None
+        order_notes = []
+        if payment_method:
+            # If Payment Method requires proof, check for file upload
+            if payment_method.requires_proof and 'payment_proof' in request.FILES:
+                payment_proof = request.FILES['payment_proof']
+                # Add a note that proof was uploaded
+                order_notes.append(f"Customer uploaded payment proof ({payment_method.name} Receipt).")
+            # If Credit Card, capture masked info in order note (do not store card)
+            if payment_method.code == 'credit_card':
+                intent_id = request.POST.get('stripe_payment_intent')
+                if intent_id:
+                    order_notes.append(f"Stripe PaymentIntent confirmed: {intent_id}")
 
-        # Apply discount to total
-        if total < discount:
-            discount = total
-        
-        order.discount_amount = discount
-        order.total_amount = total - discount
-        
         # Status logic
-        if order.payment_method and order.payment_method.requires_proof:
-            order.status = 'created' # Wait for verification
-        elif order.payment_method and order.payment_method.code == 'cod':
-            order.status = 'fulfilling' # Confirmed but not yet paid
-        elif order.payment_method and order.payment_method.code == 'credit_card':
+        if payment_method and payment_method.requires_proof:
+            status = 'created' # Wait for verification
+        elif payment_method and payment_method.code == 'cod':
+            status = 'fulfilling' # Confirmed but not yet paid
+        elif payment_method and payment_method.code == 'credit_card':
             if request.POST.get('stripe_payment_intent'):
-                order.status = 'paid'
+                status = 'paid'
             else:
-                order.status = 'created' # Payment failed or not completed
+                status = 'created' # Payment failed or not completed
         else:
-            order.status = 'paid' # Assume instant payment for others
-            
-        order.save()
-        request.session['cart'] = {}
+            status = 'paid' # Assume instant payment for others
+
+        try:
+            with transaction.atomic():
+                # Take the stock and create the order together, so a failed
+                # order gives the stock back
+                products = reserve_stock(cart.quantities)
+                order, items = assemble_order(
+                    cart.lines(), products, coupon,
+                    customer_name=name, email=email, phone=phone, address=address, notes=notes, status=status,
+                    payment_method=payment_method, payment_proof=payment_proof,
+                    user=request.user if request.user.is_authenticated else None,
+                    ip_address=_get_client_ip(request),
+                )
+                save_order(order, items, order_notes)
+        except InsufficientStock as e:
+            for shortage in e.shortages:
+                if shortage.name:
+                    messages.error(request, f"抱歉，{shortage.name} 庫存不足 (僅剩 {shortage.available})，請調整數量。")
+                else:
+                    messages.error(request, f"抱歉，商品 #{shortage.product_id} 已下架，請從購物車移除。")
+            return redirect('cart_view')
+
+        cart.clear()
         request.session['coupon_id'] = None
         request.session.modified = True
         return redirect(reverse('order_success', kwargs={'order_id': order.id}))
     
     # GET Request: Calculate totals for display
-    items = []
-    total = Decimal('0')
-    for pid, item in cart.items():
-        price = Decimal(item['price'])
-        qty = int(item['qty'])
-        subtotal = price * qty
-        items.append({'id': int(pid), 'name': item['name'], 'price': price, 'qty': qty, 'subtotal': subtotal})
-        total += subtotal
+    items = cart.lines()
+    total = cart.total
     
     discount = Decimal('0')
     if coupon:
@@ -571,7 +629,10 @@ def profile_view(request):
 
 @login_required
 def user_order_detail(request, order_id):
-    order = get_object_or_404(Order, id=order_id, user=request.user)
+    order = get_object_or_404(
+        Order.objects.prefetch_related(Prefetch('items', queryset=OrderItem.objects.select_related('product'))),
+        id=order_id, user=request.user,
+    )
     return render(request, 'store/user_order_detail.html', {'order': order})
 
 def contact_view(request):